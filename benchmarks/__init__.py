@@ -0,0 +1,9 @@
+""" Microbenchmarks for the Slackr server.
+
+Each module can be run from the project folder, e.g.
+
+    python3 -m benchmarks.hydration
+
+The benchmarks build their data in memory, and never touch the project's
+data.p. Those that save the data change to a temporary folder first.
+"""
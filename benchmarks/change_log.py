@@ -0,0 +1,88 @@
+""" Compares loading and saving the server data, as every request does, with
+    each channel's change log as long as it used to be against its current
+    length, for a workspace with many busy channels.
+
+Run from the project folder with:
+
+    python3 -m benchmarks.change_log
+"""
+
+import datetime
+import os
+import tempfile
+import timeit
+
+from server import data
+
+N_CHANNELS = 500
+N_MESSAGES_PER_CHANNEL = 20
+N_CHANGES_PER_CHANNEL = 1000
+OLD_CHANGE_LOG_SIZE = 1000
+REPEATS = 5
+
+def build_server_data():
+    """ Builds a server with one user, who is in many channels that contain a
+        few messages, which have each changed many times.
+    """
+
+    server_data = data.ServerData()
+    u_id = server_data.get_new_u_id()
+    user = data.User(u_id, "user@example.com", "password123", "First", "Last")
+    server_data.register_user(user)
+    for _ in range(N_CHANNELS):
+        channel_id = server_data.get_new_channel_id()
+        channel = data.Channel(channel_id, u_id, f"channel {channel_id}", True)
+        server_data.register_channel(channel)
+        user.add_channel(channel_id)
+        message_ids = []
+        for i in range(N_MESSAGES_PER_CHANNEL):
+            message_id = server_data.get_new_message_id()
+            time_sent = datetime.datetime.now()
+            server_data.register_message(data.Message(
+                message_id, u_id, channel_id, f"Message number {i}",
+                time_sent))
+            channel.add_message(message_id, time_sent)
+            server_data.post_message(message_id)
+            message_ids.append(message_id)
+        for i in range(N_CHANGES_PER_CHANNEL):
+            channel.record_change(message_ids[i % len(message_ids)])
+    return server_data
+
+def round_trip():
+    """ Loads and saves the server data, like a request that writes to it. """
+
+    data.save_data(data.load_data())
+
+def measure(change_log_size):
+    """ Builds the benchmark server with a given change log size, and returns
+        the size of data.p and the time taken to load and save it.
+    """
+
+    data.Channel.CHANGE_LOG_SIZE = change_log_size
+    data.save_data(build_server_data())
+    size = os.path.getsize(data.ServerData.DATA_FILENAME)
+    round_trip_time = min(timeit.repeat(round_trip, number=REPEATS,
+                                        repeat=3)) / REPEATS
+    return size, round_trip_time
+
+def main():
+    """ Runs the benchmark. Changes to a temporary folder first, so that
+        data.p is not overwritten.
+    """
+
+    os.chdir(tempfile.mkdtemp())
+    change_log_size = data.Channel.CHANGE_LOG_SIZE
+    print(f"{N_CHANNELS} channels, {N_CHANGES_PER_CHANNEL} changes to "
+          f"{N_MESSAGES_PER_CHANNEL} messages in each")
+    results = {
+        OLD_CHANGE_LOG_SIZE: measure(OLD_CHANGE_LOG_SIZE),
+        change_log_size: measure(change_log_size),
+        0: measure(0),
+    }
+    for log_size, (size, round_trip_time) in results.items():
+        print(f"{log_size:>5} changes logged: "
+              f"data.p {size / 2 ** 20:6.2f} MiB, "
+              f"load and save {round_trip_time * 1e3:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+""" Compares serialising pages of messages and members one accessor call at a
+    time against the bulk return_messages() and return_users() accessors.
+
+Run from the project folder with:
+
+    python3 -m benchmarks.hydration
+"""
+
+import datetime
+import timeit
+
+from server import data
+from server import message
+
+N_USERS = 2000
+N_MESSAGES = 5000
+REPEATS = 200
+
+def build_server_data():
+    """ Builds a server with one channel that every user is a member of, and
+        that contains many reacted messages.
+    """
+
+    server_data = data.ServerData()
+    for _ in range(N_USERS):
+        u_id = server_data.get_new_u_id()
+        user = data.User(u_id, f"user{u_id}@example.com", "password123",
+                         "First", "Last")
+        user.set_handle(f"handle{u_id}")
+        user.set_pfp_filename(data.ServerData.DEFAULT_PFP_FILENAME)
+        server_data.register_user(user)
+    channel_id = server_data.get_new_channel_id()
+    channel = data.Channel(channel_id, 1, "benchmark", True)
+    for u_id in range(2, N_USERS + 1):
+        channel.add_member(u_id)
+    server_data.register_channel(channel)
+    for i in range(N_MESSAGES):
+        message_id = server_data.get_new_message_id()
+        time_sent = datetime.datetime.now()
+        message_obj = data.Message(message_id, i % N_USERS + 1, channel_id,
+                                   f"Message number {i}", time_sent)
+        message_obj.add_react(i % N_USERS + 1, 1)
+        server_data.register_message(message_obj)
+        channel.add_message(message_id, time_sent)
+    return server_data, channel
+
+def page_per_accessor(server_data, message_page, user_id):
+    """ Serialises a page of messages the way channel_messages() used to. """
+
+    msg_obj = server_data.return_message
+    return [{
+        "message_id": id,
+        "u_id": msg_obj(id).get_u_id(),
+        "message": msg_obj(id).get_message_body(),
+        "time_created": msg_obj(id).get_time_sent().timestamp(),
+        "reacts": [{
+            "react_id": react_id,
+            "u_ids": u_ids,
+            "is_this_user_reacted": user_id in u_ids,
+        } for react_id, u_ids in msg_obj(id).get_reacts().items()],
+        "is_pinned": msg_obj(id).is_pinned(),
+    } for id in message_page]
+
+def page_bulk(server_data, message_page, user_id):
+    """ Serialises a page of messages the way channel_messages() does now. """
+
+    return [message.message_info(view, user_id)
+            for view in server_data.return_messages(message_page)]
+
+def members_per_accessor(server_data, members):
+    """ Serialises the members of a channel the way channel_details() used to.
+    """
+
+    user_obj = server_data.return_user
+    return [{
+        "u_id": u_id,
+        "name_first": user_obj(u_id).get_name_first(),
+        "name_last": user_obj(u_id).get_name_last(),
+        "profile_img_url": "static/" + user_obj(u_id).get_pfp_filename(),
+    } for u_id in members]
+
+def members_bulk(server_data, members):
+    """ Serialises the members of a channel the way channel_details() does now.
+    """
+
+    return [{
+        "u_id": view.u_id,
+        "name_first": view.name_first,
+        "name_last": view.name_last,
+        "profile_img_url": "static/" + view.pfp_filename,
+    } for view in server_data.return_users(members)]
+
+def report(name, old, new):
+    """ Prints the time per call of the old and new versions of a serialiser.
+    """
+
+    old_time = min(timeit.repeat(old, number=REPEATS, repeat=3)) / REPEATS
+    new_time = min(timeit.repeat(new, number=REPEATS, repeat=3)) / REPEATS
+    print(f"{name}: {old_time * 1e6:9.1f} us -> {new_time * 1e6:9.1f} us "
+          f"({old_time / new_time:.1f}x)")
+
+def main():
+    """ Runs the benchmark. """
+
+    server_data, channel = build_server_data()
+    message_page = channel.get_messages(0, 50)
+    members = channel.get_members()
+    assert (page_per_accessor(server_data, message_page, 1) ==
+            page_bulk(server_data, message_page, 1))
+    assert (members_per_accessor(server_data, members) ==
+            members_bulk(server_data, members))
+    report("50 message page",
+           lambda: page_per_accessor(server_data, message_page, 1),
+           lambda: page_bulk(server_data, message_page, 1))
+    report(f"{len(members)} members",
+           lambda: members_per_accessor(server_data, members),
+           lambda: members_bulk(server_data, members))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+""" Compares ranking the matches of a broad query by relevance serially
+    against splitting the candidates into partitions of whole channels ranked
+    in parallel on the process pool.
+
+Both go through rank_messages(), so both find the candidates first. The
+speedup depends on the number of CPU cores; at least two workers are used
+even on one core. The server data is saved to data.p in a temporary folder,
+as workers load it themselves.
+
+Run from the project folder with:
+
+    python3 -m benchmarks.parallel_search
+"""
+
+import os
+import timeit
+
+from server import data
+from server import search
+from benchmarks import search as search_benchmark
+
+REPEATS = 5
+QUERY_STR = "word"
+WORKERS = max(2, os.cpu_count() or 1)
+
+def main():
+    """ Runs the benchmark. """
+
+    server_data, user = search_benchmark.build_server_data()
+    data.save_data(server_data)
+    channel_ids = search.searched_channels(user, {})
+    channel_candidates = search.find_candidates(server_data, channel_ids,
+                                                QUERY_STR, {})
+    n_candidates = sum(map(len, channel_candidates.values()))
+
+    def rank(workers):
+        search.PARALLEL_WORKERS = workers
+        search.PARALLEL_MIN_CANDIDATES = 0
+        return search.rank_messages(server_data, user, QUERY_STR, 50)
+
+    def serial():
+        return rank(1)
+
+    def parallel():
+        return rank(WORKERS)
+
+    # Warms up the worker processes, which each load data.p once.
+    for _ in range(WORKERS):
+        assert parallel() == serial()
+    print(f"{os.cpu_count()} cores, {WORKERS} workers, {n_candidates} "
+          f"candidates for {QUERY_STR!r}")
+    serial_time = min(timeit.repeat(serial, number=REPEATS, repeat=3)) / REPEATS
+    parallel_time = min(timeit.repeat(parallel, number=REPEATS,
+                                      repeat=3)) / REPEATS
+    print(f"top 50 by relevance: {serial_time * 1e3:8.1f} ms serial -> "
+          f"{parallel_time * 1e3:8.1f} ms parallel "
+          f"({serial_time / parallel_time:.2f}x)")
+    search.shutdown_search_pool()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+""" Compares searching every message in a user's channels against searching
+    with the search index.
+
+Run from the project folder with:
+
+    python3 -m benchmarks.search
+"""
+
+import datetime
+import os
+import random
+import tempfile
+import timeit
+
+from server import data
+from server import search
+
+N_CHANNELS = 50
+N_MESSAGES_PER_CHANNEL = 2000
+WORDS_PER_MESSAGE = 12
+VOCABULARY_SIZE = 20000
+REPEATS = 5
+QUERIES = ["word123", "word4567 word", "ord99", "zzz"]
+
+def build_server_data():
+    """ Builds a server with one user, who is in many channels that contain
+        many messages made of random words.
+
+    Changes to a temporary folder first, as the search index writes its
+    sealed segments next to data.p.
+    """
+
+    os.chdir(tempfile.mkdtemp())
+    rng = random.Random(1531)
+    vocabulary = [f"word{i}" for i in range(VOCABULARY_SIZE)]
+    server_data = data.ServerData()
+    u_id = server_data.get_new_u_id()
+    user = data.User(u_id, "user@example.com", "password123", "First", "Last")
+    server_data.register_user(user)
+    for _ in range(N_CHANNELS):
+        channel_id = server_data.get_new_channel_id()
+        channel = data.Channel(channel_id, u_id, f"channel {channel_id}", True)
+        server_data.register_channel(channel)
+        user.add_channel(channel_id)
+        for _ in range(N_MESSAGES_PER_CHANNEL):
+            message_id = server_data.get_new_message_id()
+            time_sent = datetime.datetime.now()
+            body = " ".join(rng.choices(vocabulary, k=WORDS_PER_MESSAGE))
+            server_data.register_message(data.Message(message_id, u_id,
+                                                      channel_id, body,
+                                                      time_sent))
+            channel.add_message(message_id, time_sent)
+            server_data.post_message(message_id)
+    return server_data, user
+
+def scan_messages(server_data, user, query_str):
+    """ Searches every message in the user's channels, the way search() used
+        to.
+    """
+
+    return [msg_id for channel_id in user.get_channels()
+            for msg_id in server_data.return_channel(channel_id)
+            if query_str in server_data.return_message(msg_id).get_message_body()]
+
+def main():
+    """ Runs the benchmark. """
+
+    server_data, user = build_server_data()
+    print(f"{N_CHANNELS * N_MESSAGES_PER_CHANNEL} messages")
+    for query_str in QUERIES:
+        scanned = scan_messages(server_data, user, query_str)
+        assert scanned == list(search.find_messages(server_data, user, query_str))
+        scan_time = min(timeit.repeat(
+            lambda: scan_messages(server_data, user, query_str),
+            number=REPEATS, repeat=3)) / REPEATS
+        index_time = min(timeit.repeat(
+            lambda: list(search.find_messages(server_data, user, query_str)),
+            number=REPEATS, repeat=3)) / REPEATS
+        print(f"{query_str!r:>16} ({len(scanned):5} hits): "
+              f"{scan_time * 1e3:8.2f} ms -> {index_time * 1e3:8.3f} ms "
+              f"({scan_time / index_time:.0f}x)")
+
+if __name__ == "__main__":
+    main()
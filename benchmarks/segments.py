@@ -0,0 +1,60 @@
+""" Compares loading and saving the server data, as every request does, with
+    the whole search index kept in data.p against keeping only its mutable
+    segment there, and the rest in sealed segments next to it.
+
+Run from the project folder with:
+
+    python3 -m benchmarks.segments
+"""
+
+import os
+import timeit
+
+from server import data
+from server import search_index
+from benchmarks import search as search_benchmark
+
+REPEATS = 5
+
+def round_trip():
+    """ Loads and saves the server data, like a request that writes to it. """
+
+    data.save_data(data.load_data())
+
+def measure(segment_size):
+    """ Builds the benchmark server with a given segment size, and returns the
+        size of data.p and the time taken to load and save it.
+    """
+
+    search_index.SEGMENT_SIZE = segment_size
+    server_data, user = search_benchmark.build_server_data()
+    search_index.wait_for_merges()
+    data.save_data(server_data)
+    # Sealed segments are only read from disk by the first request.
+    data.load_data().get_search_candidates("word123")
+    size = os.path.getsize(data.ServerData.DATA_FILENAME)
+    round_trip_time = min(timeit.repeat(round_trip, number=REPEATS,
+                                        repeat=3)) / REPEATS
+    search_time = min(timeit.repeat(
+        lambda: data.load_data().get_search_candidates("word123"),
+        number=REPEATS, repeat=3)) / REPEATS
+    return size, round_trip_time, search_time
+
+def main():
+    """ Runs the benchmark. """
+
+    segment_size = search_index.SEGMENT_SIZE
+    n_messages = (search_benchmark.N_CHANNELS *
+                  search_benchmark.N_MESSAGES_PER_CHANNEL)
+    print(f"{n_messages} messages")
+    results = {
+        "single index": measure(n_messages + 1),
+        "segmented": measure(segment_size),
+    }
+    for name, (size, round_trip_time, search_time) in results.items():
+        print(f"{name:>12}: data.p {size / 2 ** 20:6.1f} MiB, "
+              f"load and save {round_trip_time * 1e3:7.1f} ms, "
+              f"load and look up {search_time * 1e3:7.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ here.
 
 import sys
 from json import dumps
-from flask import Flask, request, send_from_directory
+from flask import (Flask, Response, make_response, request,
+                   send_from_directory)
 from flask_cors import CORS
 from flask_mail import Mail, Message
 from werkzeug.exceptions import HTTPException
@@ -17,12 +18,13 @@ from server import admin
 from server import channel
 from server import channels
 from server import data
+from server import events
 from server import user
 from server import users
 from server import message
 from server import search
 from server import standup
-from server.Error import AccessError, ValueError
+from server.Error import AccessError, BusyError, ValueError
 
 class SlackrHTTPException(HTTPException):
     """ Creates a custom HTTP exception that the front end can handle. """
@@ -30,6 +32,20 @@ class SlackrHTTPException(HTTPException):
     code = 400
     message = "No message specified"
 
+class SlackrBusyException(SlackrHTTPException):
+    """ Creates an HTTP exception telling the front end that the server is
+        busy, and how many seconds to wait before retrying.
+    """
+
+    code = 503
+
+    def get_headers(self, *args, **kwargs):
+        """ Adds the Retry-After header to the response. """
+
+        return super().get_headers(*args, **kwargs) + [
+            ("Retry-After", str(events.WAIT_RETRY_AFTER)),
+        ]
+
 def error_handler(err):
     """ Serialises error messages to conform with front-end interface. """
 
@@ -56,6 +72,7 @@ APP.config.update(
 )
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(SlackrHTTPException, error_handler)
+APP.register_error_handler(SlackrBusyException, error_handler)
 CORS(APP)
 
 def send_success(return_data):
@@ -63,6 +80,23 @@ def send_success(return_data):
 
     return dumps(return_data)
 
+def send_if_modified(etag, get_data, serialised=False):
+    """ Serialises the data returned by get_data() in JSON, tagged with an
+        entity tag. If the client already has the data with that tag, responds
+        with 304 Not Modified instead, without calling get_data().
+
+    If serialised is True, get_data() returns the data already in JSON.
+    """
+
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    elif serialised:
+        response = make_response(get_data())
+    else:
+        response = make_response(send_success(get_data()))
+    response.set_etag(etag)
+    return response
+
 @APP.route("/static/<path:path>")
 def send_js(path):
     """ Route serving static files. """
@@ -180,6 +214,45 @@ def admin_userpermission_change_route():
 
     return send_success({})
 
+@APP.route("/admin/channels/invite", methods=["POST"])
+def admin_channels_invite_route():
+    """ Adds many users to many channels, given as comma-separated u_ids and
+        channel_ids, given the authorised user is a Slackr owner or admin.
+    """
+
+    token = request.form.get("token")
+    channel_ids = [int(channel_id) for channel_id
+                   in request.form.get("channel_ids").split(",")]
+    u_ids = [int(u_id) for u_id in request.form.get("u_ids").split(",")]
+
+    try:
+        invite_results = admin.admin_channels_invite(token, channel_ids, u_ids)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return send_success(invite_results)
+
+@APP.route("/admin/user/messages", methods=["GET"])
+def admin_user_messages_route():
+    """ Returns the messages sent by a user in a paginated manner, given the
+        authorised user is a Slackr owner or admin.
+    """
+
+    token = request.args.get("token")
+    u_id = int(request.args.get("u_id"))
+    start = int(request.args.get("start"))
+
+    try:
+        user_messages = admin.admin_user_messages(token, u_id, start)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return send_success(user_messages)
+
 @APP.route("/channel/invite", methods=["POST"])
 def channel_invite_route():
     """ Invites a user to a channel. """
@@ -197,36 +270,92 @@ def channel_invite_route():
 
     return send_success({})
 
+@APP.route("/channel/invite/bulk", methods=["POST"])
+def channel_invite_bulk_route():
+    """ Invites many users, given as comma-separated u_ids, to a channel. """
+
+    token = request.form.get("token")
+    channel_id = int(request.form.get("channel_id"))
+    u_ids = [int(u_id) for u_id in request.form.get("u_ids").split(",")]
+
+    try:
+        invite_results = channel.channel_invite_bulk(token, channel_id, u_ids)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return send_success(invite_results)
+
 @APP.route("/channel/details", methods=["GET"])
 def channel_details_route():
     """ Returns details of a channel such as the name of the channel, members,
-        and owners.
+        and owners. The members can be paginated, and only some of the
+        details returned.
     """
 
     token = request.args.get("token")
     channel_id = int(request.args.get("channel_id"))
     static_url = request.host_url + STATIC_RELATIVE_PATH
-
-    try:
-        channel_details = channel.channel_details(token, channel_id,
-                                                  static_url)
+    start = int(request.args.get("start", 0))
+    limit = request.args.get("limit")
+    if limit is not None:
+        limit = int(limit)
+    fields = request.args.get("fields")
+    if fields is not None:
+        fields = fields.split(",")
+
+    try:
+        server_data = data.load_data()
+        etag = channel.channel_details_etag(token, channel_id, static_url,
+                                            start, limit, fields, server_data)
+        return send_if_modified(etag, lambda: channel.channel_details(
+            token, channel_id, static_url, start, limit, fields, server_data))
     except ValueError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
 
-    return send_success(channel_details)
-
 @APP.route("/channel/messages", methods=["GET"])
 def channel_messages_route():
-    """ Returns messages in a channel in a paginated manner. """
+    """ Returns messages in a channel in a paginated manner, either from a
+        start index, or before or after a given message.
+    """
 
     token = request.args.get("token")
     channel_id = int(request.args.get("channel_id"))
-    start = int(request.args.get("start"))
+    start = int(request.args.get("start", 0))
+    before_message_id = request.args.get("before_message_id")
+    if before_message_id is not None:
+        before_message_id = int(before_message_id)
+    after_message_id = request.args.get("after_message_id")
+    if after_message_id is not None:
+        after_message_id = int(after_message_id)
+
+    try:
+        server_data = data.load_data()
+        etag = channel.channel_messages_etag(token, channel_id, start,
+                                             before_message_id,
+                                             after_message_id, server_data)
+        return send_if_modified(etag, lambda: channel.channel_messages_json(
+            token, channel_id, start, before_message_id, after_message_id,
+            server_data), serialised=True)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+@APP.route("/channel/messages/around", methods=["GET"])
+def channel_messages_around_route():
+    """ Returns the page of messages in a channel around a given time. """
+
+    token = request.args.get("token")
+    channel_id = int(request.args.get("channel_id"))
+    timestamp = float(request.args.get("timestamp"))
 
     try:
-        channel_messages = channel.channel_messages(token, channel_id, start)
+        channel_messages = channel.channel_messages_around(token, channel_id,
+                                                           timestamp)
     except ValueError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
@@ -234,6 +363,90 @@ def channel_messages_route():
 
     return send_success(channel_messages)
 
+@APP.route("/channel/changes", methods=["GET"])
+def channel_changes_route():
+    """ Returns the messages in a channel that have changed since a given
+        version of it.
+    """
+
+    token = request.args.get("token")
+    channel_id = int(request.args.get("channel_id"))
+    since = int(request.args.get("since"))
+
+    try:
+        channel_changes = channel.channel_changes(token, channel_id, since)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return send_success(channel_changes)
+
+@APP.route("/channel/wait", methods=["GET"])
+def channel_wait_route():
+    """ Returns the messages in a channel that have changed since a given
+        version of it, waiting for a change if there are none yet.
+    """
+
+    token = request.args.get("token")
+    channel_id = int(request.args.get("channel_id"))
+    since = int(request.args.get("since"))
+    timeout = int(request.args.get("timeout", events.WAIT_TIMEOUT_LIMIT))
+
+    try:
+        channel_changes = channel.channel_wait(token, channel_id, since,
+                                               timeout)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except BusyError as excinfo:
+        raise SlackrBusyException(description=str(excinfo))
+
+    return send_success(channel_changes)
+
+@APP.route("/channel/stream", methods=["GET"])
+def channel_stream_route():
+    """ Streams the changes to messages in a channel as Server-Sent Events,
+        for as long as the client stays connected.
+    """
+
+    token = request.args.get("token")
+    channel_id = int(request.args.get("channel_id"))
+
+    try:
+        event_stream = events.channel_stream(token, channel_id)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return Response(event_stream, mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+@APP.route("/channel/markread", methods=["POST"])
+def channel_markread_route():
+    """ Marks the messages in a channel as read by the authorised user, up to
+        and including the given message, or all of them if none is given.
+    """
+
+    token = request.form.get("token")
+    channel_id = int(request.form.get("channel_id"))
+    message_id = request.form.get("message_id")
+    if message_id is not None:
+        message_id = int(message_id)
+
+    try:
+        unread_info = channel.channel_markread(token, channel_id, message_id)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return send_success(unread_info)
+
 @APP.route("/channel/leave", methods=["POST"])
 def channel_leave_route():
     """ Removes the authorised user from the channel. """
@@ -314,19 +527,34 @@ def channels_list_route():
 
     token = request.args.get("token")
     try:
-        channels_info = channels.channels_list(token)
+        server_data = data.load_data()
+        etag = channels.channels_list_etag(token, server_data)
+        return send_if_modified(etag, lambda: channels.channels_list(
+            token, server_data))
     except AccessError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
 
-    return send_success(channels_info)
-
 @APP.route("/channels/listall", methods=["GET"])
 def channels_listall_route():
-    """ Returns a list of the ID and names of all the channels on the server. """
+    """ Returns a list of the ID and names of all the channels on the server.
+        The list can be searched by name, filtered by whether channels are
+        public, and paginated.
+    """
 
     token = request.args.get("token")
-    try:
-        channels_info = channels.channels_listall(token)
+    query_str = request.args.get("query_str", "")
+    is_public = request.args.get("is_public")
+    if is_public is not None:
+        is_public = is_public == "true"
+    start = int(request.args.get("start", 0))
+    limit = request.args.get("limit")
+    if limit is not None:
+        limit = int(limit)
+    try:
+        channels_info = channels.channels_listall(token, query_str, is_public,
+                                                  start, limit)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
 
@@ -361,14 +589,15 @@ def user_profile_route():
     static_url = request.host_url + STATIC_RELATIVE_PATH
 
     try:
-        profile_info = user.user_profile(token, u_id, static_url=static_url)
+        server_data = data.load_data()
+        etag = user.user_profile_etag(token, u_id, static_url, server_data)
+        return send_if_modified(etag, lambda: user.user_profile(
+            token, u_id, static_url, server_data))
     except ValueError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
 
-    return send_success(profile_info)
-
 @APP.route('/user/profile/setname', methods=['PUT'])
 def user_profile_setname_route():
     """ Changes the authorised user's name. """
@@ -449,7 +678,31 @@ def users_all_route():
     static_url = request.host_url + STATIC_RELATIVE_PATH
 
     try:
-        users_info = users.users_all(token, static_url)
+        server_data = data.load_data()
+        etag = users.users_all_etag(token, static_url, server_data)
+        return send_if_modified(etag, lambda: users.users_all(
+            token, static_url, server_data))
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+@APP.route('/users/search', methods=['GET'])
+def users_search_route():
+    """ Returns the profile information of the users whose name or handle
+        starts with the query string.
+    """
+
+    token = request.args.get("token")
+    query_str = request.args.get("query_str", "")
+    limit = request.args.get("limit", "10")
+    if not limit.lstrip("-").isdigit():
+        raise SlackrHTTPException(description="Invalid limit")
+    limit = int(limit)
+    static_url = request.host_url + STATIC_RELATIVE_PATH
+
+    try:
+        users_info = users.users_search(token, query_str, limit, static_url)
     except ValueError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
@@ -660,20 +913,47 @@ def standup_send_route():
 @APP.route("/search", methods=["GET"])
 def search_route():
     """ Returns all the messages that contain the query string among the channels
-        that the authorised user is in.
+        that the authorised user is in. Results can be sorted by recent or by
+        relevance, and paginated by giving a limit, and the cursor returned
+        with the previous page. Giving a snippet length returns highlighted
+        snippets instead of whole messages.
     """
 
     token = request.args.get("token")
     query_str = request.args.get("query_str")
+    limit = request.args.get("limit")
+    if limit is not None:
+        limit = int(limit)
+    cursor = request.args.get("cursor")
+    sort = request.args.get("sort", "recent")
+    snippet_length = request.args.get("snippet_length")
+    if snippet_length is not None:
+        snippet_length = int(snippet_length)
+
+    try:
+        search_results = search.search_json(token, query_str, limit, cursor,
+                                            sort, snippet_length)
+    except ValueError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+    except AccessError as excinfo:
+        raise SlackrHTTPException(description=str(excinfo))
+
+    return search_results
+
+@APP.route("/search/cache/stats", methods=["GET"])
+def search_cache_stats_route():
+    """ Returns the hit rate and size of the cache of search results. """
+
+    token = request.args.get("token")
 
     try:
-        search_results = search.search(token, query_str)
+        stats = search.search_cache_stats(token)
     except ValueError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
     except AccessError as excinfo:
         raise SlackrHTTPException(description=str(excinfo))
 
-    return send_success(search_results)
+    return send_success(stats)
 
 if __name__ == '__main__':
     APP.run(port=(sys.argv[1] if len(sys.argv) > 1 else 5000))
@@ -11,3 +11,10 @@ class ValueError(Exception):
     """
 
     pass
+
+class BusyError(Exception):
+    """ Error raised when the server is too busy to handle a request, which the
+    front-end should retry later.
+    """
+
+    pass
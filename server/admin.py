@@ -1,8 +1,10 @@
 """ Contains all the features available to Slackr admins. """
 
 from server import auth
+from server import channel
 from server import data
-from server.Error import AccessError
+from server import message
+from server.Error import AccessError, ValueError
 
 def admin_userpermission_change(token, u_id, permission_id):
     """ Changes the user permission of an owner, given that the promoter has
@@ -27,3 +29,57 @@ def admin_userpermission_change(token, u_id, permission_id):
 
     subject_user.set_permission_id(permission_id)
     data.save_data(server_data)
+
+def admin_channels_invite(token, channel_ids, u_ids):
+    """ Adds many users to many channels at once, given that the authorised
+        user is a Slackr owner or admin. Returns whether each user was added
+        to each channel, or was already a member of it.
+
+    Owners and admins do not need to be members of the channels, which can be
+    private. Every ID is checked before any user is added, so either all of
+    the users are added or, if any ID is invalid, none of them are.
+    """
+
+    auth_u_id = auth.verify_token(token)
+    server_data = data.load_data()
+    auth_user = server_data.return_user(auth_u_id)
+    if auth_user.get_permission_id() == data.User.USER_ID:
+        raise AccessError("Channel invites attempted with insufficient privileges")
+    channels = [server_data.return_channel(channel_id)
+                for channel_id in dict.fromkeys(channel_ids)]
+    u_ids = list(dict.fromkeys(u_ids))
+    server_data.return_users(u_ids)
+    results = []
+    for channel_obj in channels:
+        results.extend(channel.add_members(server_data, channel_obj, u_ids))
+    data.save_data(server_data)
+    return {
+        "results": results
+    }
+
+def admin_user_messages(token, u_id, start):
+    """ Returns a page of the messages sent by a user, newest first, so that
+        Slackr owners and admins can moderate them. This page of messages is
+        50 messages long, starting from the start index the function is
+        provided.
+    """
+
+    auth_u_id = auth.verify_token(token)
+    server_data = data.load_data()
+    server_data.return_user(u_id)
+    auth_user = server_data.return_user(auth_u_id)
+    if auth_user.get_permission_id() == data.User.USER_ID:
+        raise AccessError("User messages requested with insufficient privileges")
+    end = start + 50
+    message_page = server_data.get_user_messages(u_id, start, end)
+    try:
+        server_data.get_user_messages(u_id, end, end + 50)
+    except ValueError:
+        end = -1
+    return {
+        "messages": [dict(message.message_info(view, auth_u_id),
+                          channel_id=view.channel_id)
+                     for view in server_data.return_messages(message_page)],
+        "start": start,
+        "end": end,
+    }
@@ -8,11 +8,16 @@ the permission level of users.
 ASSUMPTION These tests assume that the state of the program is reset after each test.
 """
 
+import time
+
 import pytest
 
 from server import auth
 from server import admin
+from server import channel
+from server import channels
 from server import data
+from server import message
 from server.Error import AccessError, ValueError
 
 
@@ -90,3 +95,97 @@ def test_admin_userpermission_change_successful():
     user2_info = auth.auth_register("user2@hotmail.com", "password098", "Mr", "Test")
     admin.admin_userpermission_change(owner_info["token"], user1_info["u_id"], 2)
     admin.admin_userpermission_change(user1_info["token"], user2_info["u_id"], 2)
+
+def test_admin_user_messages_unauthorised_attempt():
+    """Attempts to list the messages of another user while having insufficient
+       privileges.
+
+    Should be thrown AccessError("User messages requested with insufficient privileges")
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    owner_info = auth.auth_register("adminemail@email.com", "chickensoup897", "Mills", "Wood")
+    user_info = auth.auth_register("testemail@hotmail.com", "testpassword098", "Mr", "Test")
+    with pytest.raises(AccessError) as excinfo:
+        admin.admin_user_messages(user_info["token"], owner_info["u_id"], 0)
+    assert "User messages requested with insufficient privileges" in str(excinfo.value)
+
+def test_admin_user_messages_sendlater():
+    """Tests that messages sent later are only listed once they have been sent.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    owner_info = auth.auth_register("adminemail@email.com", "chickensoup897", "Mills", "Wood")
+    channel_info = channels.channels_create(owner_info["token"], "channel 1", True)
+    message_info = message.message_sendlater(owner_info["token"], channel_info["channel_id"],
+                                             "Later", int(time.time()) + 1)
+    assert admin.admin_user_messages(owner_info["token"], owner_info["u_id"], 0)["messages"] == []
+    time.sleep(2)
+    user_messages = admin.admin_user_messages(owner_info["token"], owner_info["u_id"], 0)
+    assert [msg["message_id"] for msg in user_messages["messages"]] == \
+        [message_info["message_id"]]
+
+def test_admin_user_messages_successful():
+    """Tests that an owner can page through every message sent by a user, across
+       channels, newest first.
+
+    Removed messages should no longer be returned, and messages sent by other
+    users should never be returned.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    owner_info = auth.auth_register("adminemail@email.com", "chickensoup897", "Mills", "Wood")
+    user_info = auth.auth_register("testemail@hotmail.com", "testpassword098", "Mr", "Test")
+    channel_1 = channels.channels_create(user_info["token"], "channel 1", True)
+    channel_2 = channels.channels_create(user_info["token"], "channel 2", True)
+    channel.channel_join(owner_info["token"], channel_1["channel_id"])
+    message.message_send(owner_info["token"], channel_1["channel_id"], "Owner message")
+    sent_ids = []
+    for i in range(60):
+        channel_id = channel_1["channel_id"] if i % 2 else channel_2["channel_id"]
+        sent_ids.append(message.message_send(user_info["token"], channel_id,
+                                             f"Message {i}")["message_id"])
+    message.message_remove(user_info["token"], sent_ids.pop())
+
+    first_page = admin.admin_user_messages(owner_info["token"], user_info["u_id"], 0)
+    assert first_page["end"] == 50
+    second_page = admin.admin_user_messages(owner_info["token"], user_info["u_id"], 50)
+    assert second_page["end"] == -1
+    returned_ids = [msg["message_id"] for msg in first_page["messages"] + second_page["messages"]]
+    assert returned_ids == sent_ids[::-1]
+    assert first_page["messages"][0]["channel_id"] == channel_2["channel_id"]
+
+def test_admin_channels_invite():
+    """ Tests that owners and admins can add many users to many channels at
+    once, including private channels they are not in.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    owner_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_1 = auth.auth_register("testemail1@hotmail.com", "badpassword123", "Major", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Private", "Wonky")
+    channel_info_1 = channels.channels_create(user_info_1["token"], "private 1", False)
+    channel_info_2 = channels.channels_create(user_info_2["token"], "private 2", False)
+    channel_ids = [channel_info_1["channel_id"], channel_info_2["channel_id"]]
+    u_ids = [user_info_1["u_id"], user_info_2["u_id"]]
+
+    with pytest.raises(AccessError):
+        admin.admin_channels_invite(user_info_1["token"], channel_ids, u_ids)
+    with pytest.raises(ValueError):
+        admin.admin_channels_invite(owner_info["token"], channel_ids + [12345], u_ids)
+    with pytest.raises(ValueError):
+        admin.admin_channels_invite(owner_info["token"], channel_ids, u_ids + [12345])
+    assert [result["channel_id"] for result in
+            channels.channels_list(user_info_1["token"])["channels"]] == channel_ids[:1]
+
+    results = admin.admin_channels_invite(owner_info["token"], channel_ids, u_ids)
+    assert [(result["channel_id"], result["u_id"], result["is_added"])
+            for result in results["results"]] == [
+                (channel_ids[0], u_ids[0], False), (channel_ids[0], u_ids[1], True),
+                (channel_ids[1], u_ids[0], True), (channel_ids[1], u_ids[1], False)]
+    for user_info in (user_info_1, user_info_2):
+        assert sorted(result["channel_id"] for result in
+                      channels.channels_list(user_info["token"])["channels"]) == channel_ids
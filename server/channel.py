@@ -4,6 +4,8 @@
 
 from server import auth
 from server import data
+from server import events
+from server import message
 from server.Error import AccessError, ValueError
 
 def channel_invite(token, channel_id, u_id):
@@ -21,41 +23,278 @@ def channel_invite(token, channel_id, u_id):
         raise AccessError("Authorised user is not a member of the channel")
     if channel.is_member(u_id):
         raise ValueError("Invited user is already a member of the channel")
-    user.add_channel(channel_id)
+    user.add_channel(channel_id, channel.get_sequence())
     channel.add_member(u_id)
     data.save_data(server_data)
 
-def channel_details(token, channel_id, static_url="static/"):
+def add_members(server_data, channel, u_ids):
+    """ Adds users to a channel given their u_ids, skipping those already in
+        it, and returns whether each user was added. Assumes that every u_id
+        is valid.
+    """
+
+    results = []
+    for u_id in u_ids:
+        is_added = not channel.is_member(u_id)
+        if is_added:
+            server_data.return_user(u_id).add_channel(channel.get_id(),
+                                                      channel.get_sequence())
+            channel.add_member(u_id)
+        results.append({
+            "u_id": u_id,
+            "channel_id": channel.get_id(),
+            "is_added": is_added,
+        })
+    return results
+
+def channel_invite_bulk(token, channel_id, u_ids):
+    """ Invites many users to a channel at once, adding them to it. Returns
+        whether each user was added, or was already a member of the channel.
+
+    Every u_id is checked before any user is added, so either all of the
+    users are invited or, if any u_id is invalid, none of them are.
+    """
+
+    authorised_u_id = auth.verify_token(token)
+    server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(authorised_u_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    u_ids = list(dict.fromkeys(u_ids))
+    server_data.return_users(u_ids)
+    results = add_members(server_data, channel, u_ids)
+    data.save_data(server_data)
+    return {
+        "results": results
+    }
+
+DETAILS_FIELDS = ("name", "owner_members", "all_members", "owner_count",
+                  "member_count")
+
+def check_details_fields(fields):
+    """ Returns the fields of a channel's details to return, given a list of
+        them, or all of them if fields is None.
+    """
+
+    if fields is None:
+        return DETAILS_FIELDS
+    for field in fields:
+        if field not in DETAILS_FIELDS:
+            raise ValueError("Invalid field")
+    return fields
+
+def channel_details(token, channel_id, static_url="static/", start=0,
+                    limit=None, fields=None, server_data=None):
     """ Returns all the details of a particular channel. This comprises the
-        name of the channel, and the details of all the owners and members
-        of the channel.
+        name of the channel, the details of all the owners and members of
+        the channel, and the number of each.
+
+    The members can be paginated by giving a limit, in which case the
+    returned end is the start of the next page, or -1 if there is none. Only
+    some of the details can be returned by giving a list of fields, so that
+    the number of members can be found without listing them.
+
+    If server_data is given, it is used instead of loading data.p, so that a
+    route can compute the entity tag and the body from the same data.
     """
 
     user_id = auth.verify_token(token)
-    server_data = data.load_data()
+    if server_data is None:
+        server_data = data.load_data()
     channel = server_data.return_channel(channel_id)
     if not channel.is_member(user_id):
         raise AccessError("Authorised user is not a member of the channel")
-    user_obj = server_data.return_user
-    return {
-        "name": channel.get_name(),
-        "owner_members": [{
-            "u_id": u_id,
-            "name_first": user_obj(u_id).get_name_first(),
-            "name_last": user_obj(u_id).get_name_last(),
-            "profile_img_url": static_url + user_obj(u_id).get_pfp_filename(),
-        } for u_id in channel.get_owners()],
-        "all_members": [{
-            "u_id": u_id,
-            "name_first": user_obj(u_id).get_name_first(),
-            "name_last": user_obj(u_id).get_name_last(),
-            "profile_img_url": static_url + user_obj(u_id).get_pfp_filename(),
-        } for u_id in channel.get_members()],
+    fields = check_details_fields(fields)
+    if start < 0 or (limit is not None and limit < 1):
+        raise ValueError("Invalid member page")
+    details = {}
+    if "name" in fields:
+        details["name"] = channel.get_name()
+    if "owner_members" in fields:
+        details["owner_members"] = [{
+            "u_id": view.u_id,
+            "name_first": view.name_first,
+            "name_last": view.name_last,
+            "profile_img_url": static_url + view.pfp_filename,
+        } for view in server_data.return_users(channel.get_owners())]
+    if "all_members" in fields:
+        end = None if limit is None else start + limit
+        details["all_members"] = [{
+            "u_id": view.u_id,
+            "name_first": view.name_first,
+            "name_last": view.name_last,
+            "profile_img_url": static_url + view.pfp_filename,
+        } for view in server_data.return_users(channel.get_members(start,
+                                                                   end))]
+        details["start"] = start
+        details["end"] = (end if end is not None and
+                          end < channel.get_member_count() else -1)
+    if "owner_count" in fields:
+        details["owner_count"] = channel.get_owner_count()
+    if "member_count" in fields:
+        details["member_count"] = channel.get_member_count()
+    return details
+
+def channel_details_etag(token, channel_id, static_url="static/", start=0,
+                         limit=None, fields=None, server_data=None):
+    """ Returns the entity tag of the details of a channel, which changes
+        whenever channel_details() would return something different. The
+        server data can be given as for channel_details().
+    """
+
+    user_id = auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    fields = tuple(check_details_fields(fields))
+    return server_data.make_etag("channel_details", channel_id,
+                                 channel.get_name(),
+                                 tuple(channel.get_owners()),
+                                 tuple(channel.get_members()),
+                                 server_data.get_users_version(), static_url,
+                                 start, limit, fields)
+
+def page_views(server_data, channel, start, end=None):
+    """ Returns read-only views of a page of messages from a channel, along
+        with the other fields of the page. This page of messages is 50
+        messages long, starting from the start index, unless an earlier end
+        index is given.
+
+    The version of the channel is included, so that changes since the page
+    can be requested with channel_changes().
+    """
+
+    if end is None:
+        end = start + 50
+    views = server_data.return_messages(channel.get_messages(start, end))
+    if end >= channel.get_message_count():
+        end = -1
+    return views, {
+        "start": start,
+        "end": end,
+        "version": channel.get_version(),
     }
 
-def channel_messages(token, channel_id, start):
+def message_page(server_data, channel, user_id, start, end=None):
+    """ Returns a page of messages from a channel as seen by a user, as found
+        by page_views().
+    """
+
+    views, fields = page_views(server_data, channel, start, end)
+    return message.message_page_info(views, user_id, fields)
+
+def check_message_page(server_data, channel, start, before_message_id,
+                       after_message_id):
+    """ Raises a ValueError if the page of messages asked for by
+        channel_messages() does not exist, without finding the page.
+    """
+
+    if before_message_id is not None and after_message_id is not None:
+        raise ValueError("Only one message cursor can be given")
+    cursor_id = (before_message_id if before_message_id is not None
+                 else after_message_id)
+    if cursor_id is not None:
+        cursor = server_data.return_message(cursor_id)
+        channel.get_message_position(cursor_id, cursor.get_time_sent())
+    elif start > 0 and start >= channel.get_message_count():
+        raise ValueError("Start index of message page exceeds number of "
+                         "messages in the channel")
+
+def channel_messages_etag(token, channel_id, start=0, before_message_id=None,
+                          after_message_id=None, server_data=None):
+    """ Returns the entity tag of a page of messages in a channel as seen by a
+        user, which changes whenever any message in the channel changes. The
+        page is checked first, so that a page that does not exist raises a
+        ValueError rather than matching a tag. The server data can be given
+        as for channel_details().
+    """
+
+    user_id = auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    check_message_page(server_data, channel, start, before_message_id,
+                       after_message_id)
+    return server_data.make_etag("channel_messages", channel_id, user_id,
+                                 start, before_message_id, after_message_id,
+                                 channel.get_version())
+
+def find_message_page(token, channel_id, start, before_message_id,
+                      after_message_id, server_data):
+    """ Returns the server data, the authorised user's u_id, and the views and
+        other fields of the page of messages asked for by channel_messages().
+    """
+
+    user_id = auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    check_message_page(server_data, channel, start, before_message_id,
+                       after_message_id)
+    if before_message_id is not None:
+        cursor = server_data.return_message(before_message_id)
+        start = channel.get_message_position(before_message_id,
+                                             cursor.get_time_sent()) + 1
+        if start == channel.get_message_count():
+            return server_data, user_id, [], {
+                "start": start, "end": -1, "version": channel.get_version(),
+            }
+    elif after_message_id is not None:
+        cursor = server_data.return_message(after_message_id)
+        end = channel.get_message_position(after_message_id,
+                                           cursor.get_time_sent())
+        if end == 0:
+            return server_data, user_id, [], {
+                "start": 0, "end": 0, "version": channel.get_version(),
+            }
+        return (server_data, user_id) + page_views(
+            server_data, channel, max(end - 50, 0), end)
+    return (server_data, user_id) + page_views(server_data, channel, start)
+
+def channel_messages(token, channel_id, start=0, before_message_id=None,
+                     after_message_id=None, server_data=None):
     """ Returns a page of messages. This page of messages is 50 messages long,
         starting from the start index the function is provided.
+
+    Instead of a start index, the ID of a message in the channel can be given
+    as a cursor, to return the 50 messages just before (older than) or just
+    after (newer than) it. The cursor message is found with a binary search
+    over the times messages were sent, so pages stay the same as messages
+    are posted, and cost the same however deep into the history they are.
+
+    The server data can be given as for channel_details().
+    """
+
+    _, user_id, views, fields = find_message_page(
+        token, channel_id, start, before_message_id, after_message_id,
+        server_data)
+    return message.message_page_info(views, user_id, fields)
+
+def channel_messages_json(token, channel_id, start=0, before_message_id=None,
+                          after_message_id=None, server_data=None):
+    """ Returns the same page of messages as channel_messages(), already
+        serialised in JSON from the cached JSON of each message.
+    """
+
+    server_data, user_id, views, fields = find_message_page(
+        token, channel_id, start, before_message_id, after_message_id,
+        server_data)
+    return message.message_page_json(server_data, views, user_id, fields)
+
+def channel_messages_around(token, channel_id, timestamp):
+    """ Returns the page of messages around a point in time, so that clients
+        can jump deep into a channel's history in a single request.
+
+    The oldest message sent at or after the timestamp is found using a binary
+    search over the times the channel's messages were sent, and the page is
+    positioned so that this message sits in the middle of it. The returned
+    start and end can be used to keep paging with channel_messages().
     """
 
     user_id = auth.verify_token(token)
@@ -63,28 +302,100 @@ def channel_messages(token, channel_id, start):
     channel = server_data.return_channel(channel_id)
     if not channel.is_member(user_id):
         raise AccessError("Authorised user is not a member of the channel")
-    end = start + 50
-    message_page = channel.get_messages(start, end)
-    try:
-        channel.get_messages(end, start + 50)
-    except ValueError:
-        end = -1
-    msg_obj = server_data.return_message
+    start = max(channel.get_message_index(timestamp) - 25, 0)
+    return message_page(server_data, channel, user_id, start)
+
+def channel_changes(token, channel_id, since, server_data=None):
+    """ Returns the messages that have changed in a channel since a version of
+        it, so that clients can keep up to date without refetching pages.
+
+    Changed messages are those posted, edited, reacted to, pinned or unpinned,
+    and are returned oldest change first, along with the IDs of those
+    removed. The current version is returned to pass as since next time. If
+    the channel no longer keeps enough changes to go back to since, reset is
+    True, and the client should fetch the channel's messages again.
+
+    The server data can be given as for channel_details().
+    """
+
+    user_id = auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    changed_ids = channel.get_changes(since)
+    if changed_ids is None:
+        return {
+            "version": channel.get_version(),
+            "reset": True,
+            "messages": [],
+            "removed_message_ids": [],
+        }
+    posted_ids = []
+    removed_ids = []
+    for message_id in changed_ids:
+        try:
+            msg = server_data.return_message(message_id)
+        except ValueError:
+            removed_ids.append(message_id)
+            continue
+        if channel.has_message(message_id, msg.get_time_sent()):
+            posted_ids.append(message_id)
+        else:
+            removed_ids.append(message_id)
     return {
-        "messages": [{
-            "message_id": id,
-            "u_id": msg_obj(id).get_u_id(),
-            "message": msg_obj(id).get_message_body(),
-            "time_created": msg_obj(id).get_time_sent().timestamp(),
-            "reacts": [{
-                "react_id": react_id,
-                "u_ids": u_ids,
-                "is_this_user_reacted": user_id in u_ids,
-            } for react_id, u_ids in msg_obj(id).get_reacts().items()],
-            "is_pinned": msg_obj(id).is_pinned(),
-        } for id in message_page],
-        "start": start,
-        "end": end,
+        "version": channel.get_version(),
+        "reset": False,
+        "messages": [message.message_info(view, user_id)
+                     for view in server_data.return_messages(posted_ids)],
+        "removed_message_ids": removed_ids,
+    }
+
+def channel_wait(token, channel_id, since, timeout):
+    """ Returns the messages that have changed in a channel since a version of
+        it, like channel_changes(), but if none have, waits up to timeout
+        seconds for one to change first.
+
+    Returns as soon as the channel has a newer version, or with no changes
+    once the timeout passes, and the client should then poll again. If too
+    many requests are already waiting, raises a BusyError without waiting.
+    """
+
+    if timeout < 0:
+        raise ValueError("Invalid timeout")
+    server_data = data.load_data()
+    changes = channel_changes(token, channel_id, since, server_data)
+    if changes["version"] > since or not timeout:
+        return changes
+    events.wait_for_version(server_data, channel_id, since, timeout)
+    return channel_changes(token, channel_id, since)
+
+def channel_markread(token, channel_id, message_id=None):
+    """ Marks the messages in a channel up to and including a message as read
+        by the authorised user, or every message if no message is given.
+        Returns the number of messages left unread.
+
+    Messages are never marked unread again, so marking an older message
+    than the last one read does nothing.
+    """
+
+    user_id = auth.verify_token(token)
+    server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    if message_id is None:
+        sequence = channel.get_sequence()
+    else:
+        server_data.return_message(message_id)
+        sequence = channel.get_message_sequence(message_id)
+    user = server_data.return_user(user_id)
+    user.mark_read(channel_id, sequence)
+    data.save_data(server_data)
+    return {
+        "unread_count": channel.get_unread_count(
+            user.get_read_marker(channel_id)),
     }
 
 def channel_leave(token, channel_id):
@@ -113,7 +424,7 @@ def channel_join(token, channel_id):
         raise AccessError("Cannot join private channel with regular user permissions.")
     if channel.is_member(user_id):
         raise ValueError("User is already a member of the channel")
-    user.add_channel(channel_id)
+    user.add_channel(channel_id, channel.get_sequence())
     channel.add_member(user_id)
     data.save_data(server_data)
 
@@ -1,11 +1,16 @@
 """ Unit tests for functions implementing features related to a specific channel. """
 
+import pickle
+
 import pytest
 from server import auth
 from server import channel
 from server import channels
 from server import data
 from server import message
+from server import search
+from server import user
+from server import users
 from server.Error import AccessError, ValueError
 
 def test_channel_invite_unauthorised_user():
@@ -221,6 +226,181 @@ def test_channel_messages_success_long():
     channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
                                         received["end"])
 
+def test_channel_messages_around_success():
+    """ Tests that channel_messages_around returns the page of messages
+    surrounding a point in time, and that paging can continue from it.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "1's server", 0)
+    for i in range(200):
+        message.message_send(user_info_1["token"], channel_info["channel_id"], f"message {i}")
+    history = []
+    start = 0
+    while start != -1:
+        page = channel.channel_messages(user_info_1["token"], channel_info["channel_id"], start)
+        history += page["messages"]
+        start = page["end"]
+    target = history[170]
+    received = channel.channel_messages_around(user_info_1["token"],
+                                               channel_info["channel_id"],
+                                               target["time_created"])
+    assert received["start"] == 145
+    assert received["messages"][25]["message"] == target["message"] == "message 29"
+    assert received["messages"] == history[145:195]
+
+    received = channel.channel_messages_around(user_info_1["token"],
+                                               channel_info["channel_id"],
+                                               history[0]["time_created"] + 1000)
+    assert received["start"] == 0
+    assert received["messages"][0]["message"] == "message 199"
+
+def test_channel_messages_cursors():
+    """ Tests that channel_messages pages stay stable when paging with message
+    cursors while new messages are posted.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "1's server", 0)
+    for i in range(120):
+        message.message_send(user_info_1["token"], channel_info["channel_id"], f"message {i}")
+    first_page = channel.channel_messages(user_info_1["token"], channel_info["channel_id"])
+    for i in range(120, 130):
+        message.message_send(user_info_1["token"], channel_info["channel_id"], f"message {i}")
+
+    history = first_page["messages"]
+    page = first_page
+    while page["end"] != -1:
+        page = channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
+                                        before_message_id=history[-1]["message_id"])
+        history += page["messages"]
+    assert [msg["message"] for msg in history] == [f"message {i}" for i in range(119, -1, -1)]
+
+    newer = channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
+                                     after_message_id=first_page["messages"][0]["message_id"])
+    assert [msg["message"] for msg in newer["messages"]] == \
+        [f"message {i}" for i in range(129, 119, -1)]
+    assert (newer["start"], newer["end"]) == (0, 10)
+    newest = channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
+                                      after_message_id=newer["messages"][0]["message_id"])
+    assert not newest["messages"]
+    with pytest.raises(ValueError) as excinfo:
+        channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
+                                 before_message_id=1, after_message_id=2)
+    assert "Only one message cursor can be given" in str(excinfo.value)
+
+def test_channel_changes(monkeypatch):
+    """ Tests that channel_changes returns only the messages that changed since
+    a version of the channel, and asks for a reset once its log is too short.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    monkeypatch.setattr(data.Channel, "CHANGE_LOG_SIZE", 5)
+    channel_info = channels.channels_create(user_info_1["token"], "1's server", 0)
+    message_ids = [message.message_send(user_info_1["token"], channel_info["channel_id"],
+                                        f"message {i}")["message_id"] for i in range(4)]
+    version = channel.channel_messages(user_info_1["token"], channel_info["channel_id"])["version"]
+    assert channel.channel_changes(user_info_1["token"], channel_info["channel_id"], version) == {
+        "version": version, "reset": False, "messages": [], "removed_message_ids": []}
+
+    message.message_edit(user_info_1["token"], message_ids[0], "edited")
+    message.message_react(user_info_1["token"], message_ids[1], 1)
+    message.message_remove(user_info_1["token"], message_ids[2])
+    new_id = message.message_send(user_info_1["token"], channel_info["channel_id"],
+                                  "new")["message_id"]
+    message.message_edit(user_info_1["token"], message_ids[0], "edited again")
+    changes = channel.channel_changes(user_info_1["token"], channel_info["channel_id"], version)
+    assert changes["version"] == version + 5
+    assert not changes["reset"]
+    assert [(msg["message_id"], msg["message"]) for msg in changes["messages"]] == [
+        (message_ids[1], "message 1"), (new_id, "new"), (message_ids[0], "edited again")]
+    assert changes["messages"][0]["reacts"][0]["is_this_user_reacted"]
+    assert changes["removed_message_ids"] == [message_ids[2]]
+
+    # The log only keeps the last 5 changes.
+    message.message_edit(user_info_1["token"], new_id, "edited")
+    changes = channel.channel_changes(user_info_1["token"], channel_info["channel_id"], version)
+    assert changes["reset"]
+    with pytest.raises(ValueError) as excinfo:
+        channel.channel_changes(user_info_1["token"], channel_info["channel_id"],
+                                changes["version"] + 1)
+    assert "Invalid channel version" in str(excinfo.value)
+
+    # Logs saved when they were longer are trimmed once loaded.
+    monkeypatch.setattr(data.Channel, "CHANGE_LOG_SIZE", 2)
+    changes = channel.channel_changes(user_info_1["token"], channel_info["channel_id"],
+                                      changes["version"] - 2)
+    assert not changes["reset"]
+    changes = channel.channel_changes(user_info_1["token"], channel_info["channel_id"],
+                                      changes["version"] - 3)
+    assert changes["reset"]
+
+def test_channel_etags():
+    """ Tests that the entity tags of a channel's messages and details only
+    change when what they tag changes, and can share loaded data with the body.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Major", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "1's server", 1)
+    message_info = message.message_send(user_info_1["token"], channel_info["channel_id"], "hi")
+    messages_etag = channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"])
+    details_etag = channel.channel_details_etag(user_info_1["token"], channel_info["channel_id"])
+    assert messages_etag == channel.channel_messages_etag(user_info_1["token"],
+                                                          channel_info["channel_id"])
+
+    channel.channel_join(user_info_2["token"], channel_info["channel_id"])
+    assert messages_etag == channel.channel_messages_etag(user_info_1["token"],
+                                                          channel_info["channel_id"])
+    assert messages_etag != channel.channel_messages_etag(user_info_2["token"],
+                                                          channel_info["channel_id"])
+    new_details_etag = channel.channel_details_etag(user_info_1["token"],
+                                                    channel_info["channel_id"])
+    assert new_details_etag != details_etag
+    message.message_react(user_info_2["token"], message_info["message_id"], 1)
+    assert messages_etag != channel.channel_messages_etag(user_info_1["token"],
+                                                          channel_info["channel_id"])
+    user.user_profile_setname(user_info_2["token"], "Minor", "Wonky")
+    assert new_details_etag != channel.channel_details_etag(user_info_1["token"],
+                                                            channel_info["channel_id"])
+
+    # The tag and the body can be computed from the same loaded data.
+    server_data = data.load_data()
+    messages_etag = channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"],
+                                                  server_data=server_data)
+    message.message_send(user_info_1["token"], channel_info["channel_id"], "later")
+    assert messages_etag == channel.channel_messages_etag(user_info_1["token"],
+                                                          channel_info["channel_id"],
+                                                          server_data=server_data)
+    messages = channel.channel_messages(user_info_1["token"], channel_info["channel_id"],
+                                        server_data=server_data)
+    assert [msg["message"] for msg in messages["messages"]] == ["hi"]
+
+    # Each page has its own tag, and a page that does not exist has none.
+    page_etags = {
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"]),
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"], 1),
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"],
+                                      before_message_id=message_info["message_id"]),
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"],
+                                      after_message_id=message_info["message_id"]),
+    }
+    assert len(page_etags) == 4
+    with pytest.raises(ValueError):
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"], 2)
+    with pytest.raises(ValueError):
+        channel.channel_messages_etag(user_info_1["token"], channel_info["channel_id"],
+                                      before_message_id=message_info["message_id"] + 10)
+
+    list_etag = channels.channels_list_etag(user_info_2["token"])
+    assert channels.channels_list_etag(user_info_2["token"]) == list_etag
+    message.message_send(user_info_1["token"], channel_info["channel_id"], "unread")
+    assert channels.channels_list_etag(user_info_2["token"]) != list_etag
+
 def test_channel_leave_channel_dne():
     """ Channel_leave_channel_dne_test()
     Tests for channel being left not existing
@@ -453,3 +633,257 @@ def test_channel_removeowner_successful():
     channel.channel_removeowner(user_info_1["token"], 1, user_info_2["u_id"])
     channel_details = channel.channel_details(user_info_1["token"], channel_info["channel_id"])
     assert user_info_2["u_id"] != channel_details["owner_members"][0]["u_id"]
+
+def test_channel_messages_first_page():
+    """Tests that the first page of messages stays up to date as the channel's
+    newest messages are edited, reacted to, pinned and removed.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    message_ids = [message.message_send(user_info["token"], channel_info["channel_id"],
+                                        str(index))["message_id"]
+                   for index in range(60)]
+
+    def check_first_page():
+        first_page = channel.channel_messages(user_info["token"], channel_info["channel_id"])
+        server_data = data.load_data()
+        channel_obj = server_data.return_channel(channel_info["channel_id"])
+        views = server_data.return_messages(channel_obj.get_messages(0, 50))
+        assert first_page["messages"] == \
+            message.message_page_info(views, user_info["u_id"], {})["messages"]
+        return first_page
+
+    first_page = check_first_page()
+    assert [msg["message"] for msg in first_page["messages"]] == \
+        [str(index) for index in range(59, 9, -1)]
+    assert first_page["end"] == 50
+
+    message.message_edit(user_info["token"], message_ids[58], "edited")
+    message.message_react(user_info["token"], message_ids[57], 1)
+    message.message_pin(user_info["token"], message_ids[56])
+    message.message_remove(user_info["token"], message_ids[59])
+    first_page = check_first_page()
+    assert [msg["message"] for msg in first_page["messages"][:2]] == ["edited", "57"]
+    assert first_page["messages"][1]["reacts"][0]["is_this_user_reacted"]
+    assert first_page["messages"][2]["is_pinned"]
+    assert first_page["messages"][-1]["message"] == "9"
+
+    for message_id in message_ids[:50]:
+        message.message_remove(user_info["token"], message_id)
+    first_page = check_first_page()
+    assert len(first_page["messages"]) == 9
+    assert first_page["end"] == -1
+
+def test_channel_markread():
+    """Tests that read markers give each channel's unread count in the list of
+    channels, that sending a message marks the channel read for the sender,
+    and that removed messages are not counted.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Major", "Wonky")
+    user_info_3 = auth.auth_register("testemail3@hotmail.com", "badpassword123", "Private", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "my server", 1)
+    channel.channel_join(user_info_2["token"], channel_info["channel_id"])
+    message_ids = [message.message_send(user_info_1["token"], channel_info["channel_id"],
+                                        str(index))["message_id"]
+                   for index in range(5)]
+
+    def unread_count(token):
+        return channels.channels_list(token)["channels"][0]["unread_count"]
+
+    assert unread_count(user_info_1["token"]) == 0
+    assert unread_count(user_info_2["token"]) == 5
+    etag = channels.channels_list_etag(user_info_2["token"])
+    assert channel.channel_markread(user_info_2["token"], channel_info["channel_id"],
+                                    message_ids[1]) == {"unread_count": 3}
+    assert unread_count(user_info_2["token"]) == 3
+    assert channels.channels_list_etag(user_info_2["token"]) != etag
+    # Markers do not move backwards
+    channel.channel_markread(user_info_2["token"], channel_info["channel_id"], message_ids[0])
+    assert unread_count(user_info_2["token"]) == 3
+
+    message.message_remove(user_info_1["token"], message_ids[0])
+    message.message_remove(user_info_1["token"], message_ids[3])
+    assert unread_count(user_info_2["token"]) == 2
+    assert channel.channel_markread(user_info_2["token"],
+                                    channel_info["channel_id"]) == {"unread_count": 0}
+    message.message_send(user_info_1["token"], channel_info["channel_id"], "new")
+    assert unread_count(user_info_2["token"]) == 1
+
+    with pytest.raises(ValueError):
+        channel.channel_markread(user_info_2["token"], channel_info["channel_id"],
+                                 message_ids[3])
+    with pytest.raises(AccessError):
+        channel.channel_markread(user_info_3["token"], channel_info["channel_id"])
+
+    # Users invited to or joining a channel have read the messages before then
+    channel.channel_invite(user_info_1["token"], channel_info["channel_id"], user_info_3["u_id"])
+    assert unread_count(user_info_3["token"]) == 0
+    channel.channel_leave(user_info_2["token"], channel_info["channel_id"])
+    message.message_send(user_info_1["token"], channel_info["channel_id"], "while away")
+    channel.channel_join(user_info_2["token"], channel_info["channel_id"])
+    assert unread_count(user_info_2["token"]) == 0
+    channel_2 = channels.channels_create(user_info_1["token"], "bulk", 1)
+    message.message_send(user_info_1["token"], channel_2["channel_id"], "before")
+    channel.channel_invite_bulk(user_info_1["token"], channel_2["channel_id"], [user_info_2["u_id"]])
+    assert channels.channels_list(user_info_2["token"])["channels"][1]["unread_count"] == 0
+
+def test_channel_markread_compacts_removed(monkeypatch):
+    """Tests that the removed messages a channel remembers for unread counts
+    are forgotten once they are before every member's read marker.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    monkeypatch.setattr(data.Channel, "REMOVED_COMPACT_SIZE", 2)
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Major", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "my server", 1)
+    channel.channel_join(user_info_2["token"], channel_info["channel_id"])
+    message_ids = [message.message_send(user_info_1["token"], channel_info["channel_id"],
+                                        str(index))["message_id"]
+                   for index in range(6)]
+    channel.channel_markread(user_info_2["token"], channel_info["channel_id"], message_ids[2])
+
+    def removed_count():
+        return data.load_data().return_channel(channel_info["channel_id"]).get_removed_count()
+
+    message.message_remove(user_info_1["token"], message_ids[0])
+    message.message_remove(user_info_1["token"], message_ids[1])
+    assert removed_count() == 0
+    message.message_remove(user_info_1["token"], message_ids[4])
+    message.message_remove(user_info_1["token"], message_ids[5])
+    # Both are after the second user's read marker, so are kept
+    assert removed_count() == 2
+    assert channels.channels_list(user_info_2["token"])["channels"][0]["unread_count"] == 1
+    assert channel.channel_markread(user_info_2["token"],
+                                    channel_info["channel_id"]) == {"unread_count": 0}
+
+def test_channel_load_old_data():
+    """Tests that data.p saved before the indexes were added is loaded with
+    them rebuilt, and is only rebuilt once.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Major", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "my server", 1)
+    channel.channel_join(user_info_2["token"], channel_info["channel_id"])
+    message_ids = [message.message_send(user_info_1["token"], channel_info["channel_id"],
+                                        f"hello {index}")["message_id"]
+                   for index in range(3)]
+    message.message_pin(user_info_1["token"], message_ids[1])
+
+    # Strip the attributes that data saved by the first version lacks
+    server_data = data.load_data()
+    added = {
+        "User": ["index", "version", "read_markers"],
+        "Channel": ["member_set", "message_times", "pinned_messages", "version",
+                    "changes", "sequence", "message_sequences", "removed_sequences",
+                    "compacted_size"],
+        "Message": ["version", "folded_body", "folded_offsets"],
+        "ServerData": ["user_messages", "channel_names", "user_index", "search_index",
+                       "instance_id", "data_version"],
+    }
+    objects = [server_data, server_data.return_channel(channel_info["channel_id"])]
+    objects += [server_data.return_user(user_info["u_id"])
+                for user_info in (user_info_1, user_info_2)]
+    objects += [server_data.return_message(message_id) for message_id in message_ids]
+    for obj in objects:
+        for name in added[type(obj).__name__]:
+            del obj.__dict__[f"_{type(obj).__name__}__{name}"]
+    with open(data.ServerData.DATA_FILENAME, "wb") as file:
+        pickle.dump(server_data, file)
+
+    server_data = data.load_data()
+    assert server_data.is_migrated()
+    assert not data.load_data().is_migrated()
+    assert server_data.return_channel(channel_info["channel_id"]).get_sequence() == 3
+    assert channels.channels_list(user_info_2["token"])["channels"][0]["unread_count"] == 0
+    messages = channel.channel_messages(user_info_2["token"], channel_info["channel_id"])
+    assert [msg["message_id"] for msg in messages["messages"]] == message_ids[::-1]
+    assert [msg["is_pinned"] for msg in messages["messages"]] == [False, True, False]
+    search_return = search.search(user_info_2["token"], "hello")
+    assert len(search_return["messages"]) == 3
+    assert users.users_search(user_info_2["token"], "Capt")["users"][0]["u_id"] == \
+        user_info_1["u_id"]
+
+    message.message_send(user_info_1["token"], channel_info["channel_id"], "hello again")
+    assert channels.channels_list(user_info_2["token"])["channels"][0]["unread_count"] == 1
+
+def test_channel_details_pages_and_fields():
+    """Tests paginating the members of a channel, and returning only some of its
+    details.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_infos = [auth.auth_register(f"testemail{index}@hotmail.com", "badpassword123",
+                                     "Captain", "Wonky")
+                  for index in range(5)]
+    channel_info = channels.channels_create(user_infos[0]["token"], "my server", 1)
+    for user_info in user_infos[1:]:
+        channel.channel_join(user_info["token"], channel_info["channel_id"])
+
+    details = channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                      start=1, limit=2)
+    assert [member["u_id"] for member in details["all_members"]] == \
+        [user_info["u_id"] for user_info in user_infos[1:3]]
+    assert (details["start"], details["end"]) == (1, 3)
+    assert (details["owner_count"], details["member_count"]) == (1, 5)
+    details = channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                      start=3, limit=2)
+    assert len(details["all_members"]) == 2
+    assert details["end"] == -1
+    assert channel.channel_details(user_infos[0]["token"], channel_info["channel_id"])["end"] == -1
+
+    assert channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                   fields=["name", "member_count"]) == {
+                                       "name": "my server", "member_count": 5}
+    assert channel.channel_details_etag(user_infos[0]["token"], channel_info["channel_id"],
+                                        fields=["member_count"]) != \
+        channel.channel_details_etag(user_infos[0]["token"], channel_info["channel_id"])
+    with pytest.raises(ValueError):
+        channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                fields=["password"])
+    with pytest.raises(ValueError):
+        channel.channel_details(user_infos[0]["token"], channel_info["channel_id"], limit=0)
+
+    channel.channel_leave(user_infos[2]["token"], channel_info["channel_id"])
+    assert channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                   fields=["member_count"]) == {"member_count": 4}
+    with pytest.raises(AccessError):
+        channel.channel_details(user_infos[2]["token"], channel_info["channel_id"])
+
+def test_channel_invite_bulk():
+    """Tests inviting many users to a channel at once, where users already in the
+    channel are skipped, and an invalid u_id means no one is invited.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_infos = [auth.auth_register(f"testemail{index}@hotmail.com", "badpassword123",
+                                     "Captain", "Wonky")
+                  for index in range(4)]
+    u_ids = [user_info["u_id"] for user_info in user_infos]
+    channel_info = channels.channels_create(user_infos[0]["token"], "my server", 0)
+    channel.channel_invite(user_infos[0]["token"], channel_info["channel_id"], u_ids[1])
+
+    with pytest.raises(ValueError):
+        channel.channel_invite_bulk(user_infos[0]["token"], channel_info["channel_id"],
+                                    [u_ids[2], 12345])
+    assert channel.channel_details(user_infos[0]["token"], channel_info["channel_id"],
+                                   fields=["member_count"]) == {"member_count": 2}
+    with pytest.raises(AccessError):
+        channel.channel_invite_bulk(user_infos[2]["token"], channel_info["channel_id"],
+                                    [u_ids[3]])
+
+    results = channel.channel_invite_bulk(user_infos[0]["token"], channel_info["channel_id"],
+                                          [u_ids[1], u_ids[2], u_ids[3], u_ids[2]])
+    assert [(result["u_id"], result["is_added"]) for result in results["results"]] == \
+        [(u_ids[1], False), (u_ids[2], True), (u_ids[3], True)]
+    assert [member["u_id"] for member in channel.channel_details(
+        user_infos[0]["token"], channel_info["channel_id"])["all_members"]] == u_ids
+    assert channels.channels_list(user_infos[3]["token"])["channels"][0]["channel_id"] == \
+        channel_info["channel_id"]
@@ -4,34 +4,76 @@
 
 from server import auth
 from server import data
+from server.Error import ValueError
 
-def channels_list(token):
-    """ Returns a list of all the channels that a user is in. """
+def channels_list(token, server_data=None):
+    """ Returns a list of all the channels that a user is in, along with the
+        number of messages in each that the user has not read.
+
+    If server_data is given, it is used instead of loading data.p, so that a
+    route can compute the entity tag and the body from the same data.
+    """
 
     user_id = auth.verify_token(token)
-    server_data = data.load_data()
+    if server_data is None:
+        server_data = data.load_data()
     user = server_data.return_user(user_id)
     channel_obj = server_data.return_channel
     channels_info = [{
         "channel_id": id,
         "name": channel_obj(id).get_name(),
+        "unread_count": channel_obj(id).get_unread_count(
+            user.get_read_marker(id)),
     } for id in user.get_channels()]
     return {
         "channels": channels_info
     }
 
-def channels_listall(token):
-    """ Returns a list of all the channels on the Slackr."""
+def channels_list_etag(token, server_data=None):
+    """ Returns the entity tag of the list of channels that a user is in. As
+        channels cannot be renamed, it only changes when the user joins or
+        leaves a channel, the messages in one change, or the user reads one.
+        It is built from versions and read markers alone, without counting
+        unread messages. The server data can be given as for channels_list().
+    """
+
+    user_id = auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    user = server_data.return_user(user_id)
+    channel_obj = server_data.return_channel
+    return server_data.make_etag("channels_list", user_id, tuple(
+        (id, channel_obj(id).get_version(), user.get_read_marker(id))
+        for id in user.get_channels()))
+
+def channels_listall(token, query_str="", is_public=None, start=0, limit=None):
+    """ Returns a list of all the channels on the Slackr, in order of name.
+
+    The list can be narrowed to channels whose name contains a query string
+    (those starting with it come first), and to only public or only private
+    channels. It can also be paginated by giving a limit, in which case the
+    returned end is the start of the next page, or -1 if there is none.
+    """
 
     auth.verify_token(token)
+    if start < 0 or (limit is not None and limit < 1):
+        raise ValueError("Invalid channel page")
     server_data = data.load_data()
     channel_obj = server_data.return_channel
+    channel_ids = server_data.search_channel_names(query_str)
+    if is_public is not None:
+        channel_ids = [id for id in channel_ids
+                       if channel_obj(id).is_public() == is_public]
+    end = len(channel_ids) if limit is None else start + limit
     channels_info = [{
         "channel_id": id,
         "name": channel_obj(id).get_name(),
-    } for id in server_data.get_all_channel_id()]
+        "is_public": channel_obj(id).is_public(),
+    } for id in channel_ids[start:end]]
     return {
-        "channels": channels_info
+        "channels": channels_info,
+        "start": start,
+        "end": end if end < len(channel_ids) else -1,
     }
 
 def channels_create(token, name, is_public):
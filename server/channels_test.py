@@ -118,3 +118,47 @@ def test_channels_create_successful():
     channels.channels_create(user_info["token"], "test channel", True)
     channels_info = channels.channels_listall(user_info["token"])
     assert channels_info["channels"][0]["name"] == "test channel"
+
+def test_channels_listall_search():
+    """ Test that the list of all channels can be searched by name, filtered by
+    whether the channels are public, and paginated.
+    Channels whose name starts with the query should be listed before those that
+    only contain it, and the search should ignore case.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    for name, is_public in [("general", True), ("Design", True), ("random", True),
+                            ("design-private", False), ("web design", True)]:
+        channels.channels_create(user_info["token"], name, is_public)
+
+    channels_info = channels.channels_listall(user_info["token"], "DESIGN")
+    assert [info["name"] for info in channels_info["channels"]] == [
+        "Design", "design-private", "web design"]
+    assert channels_info["end"] == -1
+
+    channels_info = channels.channels_listall(user_info["token"], "design", is_public=True)
+    assert [info["name"] for info in channels_info["channels"]] == ["Design", "web design"]
+
+    channels_info = channels.channels_listall(user_info["token"], start=0, limit=2)
+    assert [info["name"] for info in channels_info["channels"]] == ["Design", "design-private"]
+    assert channels_info["end"] == 2
+    channels_info = channels.channels_listall(user_info["token"], start=2, limit=3)
+    assert [info["name"] for info in channels_info["channels"]] == [
+        "general", "random", "web design"]
+    assert channels_info["end"] == -1
+
+def test_channels_listall_invalid_page():
+    """ Test that a negative start, or a limit less than one, is rejected
+    rather than returning a page that never ends or that slices from the end.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channels.channels_create(user_info["token"], "general", True)
+    for start, limit in [(0, 0), (0, -1), (-1, None), (-1, 2)]:
+        with pytest.raises(ValueError) as excinfo:
+            channels.channels_listall(user_info["token"], start=start, limit=limit)
+        assert "Invalid channel page" in str(excinfo.value)
@@ -6,19 +6,50 @@ behviour of a database. A ServerData class acts as our database, and
 contains many extra utilities that deal with the data, decoupling the
 application and data layers.
 
-Contains four classes: User, Class, Message, and ServerData. Also contains
-methods to load, save, and reset the persistent server data.
+Contains five classes: User, UserIndex, Channel, Message, and ServerData, along
+with the read-only UserView and MessageView records that ServerData hydrates
+in bulk. Also contains methods to load, save, and reset the persistent server
+data.
 """
 
 import binascii
+import bisect
+import collections
 import copy
 import hashlib
 import os
 import pickle
 import random
 import re
+import threading
 
 from server.Error import ValueError
+from server import search_index
+from server.search_index import SearchIndex
+
+# Lightweight read-only snapshots of users and messages, used to serialise
+# many objects in a single pass.
+UserView = collections.namedtuple("UserView", [
+    "u_id", "email", "name_first", "name_last", "handle_str", "pfp_filename",
+])
+MessageView = collections.namedtuple("MessageView", [
+    "message_id", "channel_id", "u_id", "message", "time_created", "reacts",
+    "is_pinned", "version",
+])
+
+def restore_state(obj, state, defaults):
+    """ Restores the attributes of an object loaded from data.p, giving those
+        added since it was saved a copy of their default. Defaults are given
+        by attribute name, without the class prefix. Returns the names of the
+        attributes that were missing.
+    """
+
+    obj.__dict__.update(state)
+    prefix = f"_{type(obj).__name__}__"
+    missing = {name for name in defaults if prefix + name not in state}
+    for name in missing:
+        setattr(obj, prefix + name, copy.copy(defaults[name]))
+    return missing
 
 class User():
     """ Class for a user. The u_id is not an attribute of the user object,
@@ -36,6 +67,8 @@ class User():
         """
 
         self.__u_id = u_id
+        self.__index = None
+        self.__version = 0
         self.set_email(email)
         self.set_password(password)
         self.set_name_first(name_first)
@@ -43,13 +76,53 @@ class User():
         self.set_permission_id(User.USER_ID)
         self.__handle = ""
         self.__channels = []
+        # The sequence number of the last message read in each channel.
+        self.__read_markers = {}
         self.__pfp_filename = ""
 
+    def __setstate__(self, state):
+        """ Restores a user loaded from data.p. """
+
+        restore_state(self, state, {
+            "index": None,
+            "version": 0,
+            "read_markers": {},
+        })
+
     def get_id(self):
         """ Returns the user's ID. """
 
         return self.__u_id
 
+    def get_version(self):
+        """ Returns the version of the user's profile, which is bumped whenever
+            their email, names, handle or profile picture change.
+        """
+
+        return self.__version
+
+    def attach_index(self, index):
+        """ Attaches the user index that the user's names and handle are
+            searchable in. The index is kept up to date by the setters.
+        """
+
+        self.__index = index
+        self.__profile_changed()
+
+    def __profile_changed(self):
+        """ Bumps the version of the user's profile, and updates the user's
+            entries in the attached user index, if any.
+        """
+
+        self.__version += 1
+        if self.__index is not None:
+            self.__index.update(self.__u_id, [
+                self.__name_first,
+                self.__name_last,
+                self.__name_first + " " + self.__name_last,
+                self.__handle,
+            ])
+
     def set_email(self, email):
         """ Sets a user's email after checking that it is valid. The check for
             if it is already taken is done in auth.
@@ -58,6 +131,7 @@ class User():
         email_reg_string = r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)"
         if re.search(email_reg_string, email):
             self.__email = email
+            self.__profile_changed()
         else:
             raise ValueError("Invalid email")
 
@@ -67,6 +141,7 @@ class User():
         """
         if 3 <= len(handle) <= 20:
             self.__handle = handle
+            self.__profile_changed()
         else:
             raise ValueError("Invalid handle")
 
@@ -75,6 +150,7 @@ class User():
 
         if 1 <= len(name_first) <= 50:
             self.__name_first = name_first
+            self.__profile_changed()
         else:
             raise ValueError("Invalid first name")
 
@@ -83,6 +159,7 @@ class User():
 
         if 1 <= len(name_last) <= 50:
             self.__name_last = name_last
+            self.__profile_changed()
         else:
             raise ValueError("Invalid last name")
 
@@ -164,10 +241,14 @@ class User():
 
         return self.__permission_id
 
-    def add_channel(self, channel_id):
-        """ Adds a channel to the list of channels that the user is in. """
+    def add_channel(self, channel_id, sequence=0):
+        """ Adds a channel to the list of channels that the user is in. The
+            messages already posted in it, up to a sequence number, are
+            marked as read, so that they are not counted as unread.
+        """
 
         self.__channels.append(channel_id)
+        self.mark_read(channel_id, sequence)
 
     def remove_channel(self, channel_id):
         """ Removes a channel from the list of channels that the user is in.
@@ -180,22 +261,126 @@ class User():
 
         return self.__channels[:]
 
+    def get_read_marker(self, channel_id):
+        """ Returns the sequence number of the last message that the user has
+            read in a channel, or 0 if they have not read any.
+        """
+
+        return self.__read_markers.get(channel_id, 0)
+
+    def mark_read(self, channel_id, sequence):
+        """ Marks the messages in a channel up to a sequence number as read.
+            Read markers only move forwards.
+        """
+
+        self.__read_markers[channel_id] = max(
+            sequence, self.__read_markers.get(channel_id, 0))
+
     def set_pfp_filename(self, filename):
         """ Sets the user's profile picture filename. """
 
         self.__pfp_filename = filename
+        self.__profile_changed()
 
     def get_pfp_filename(self):
         """ Returns the user's profile picture filename. """
 
         return self.__pfp_filename
 
+    def view(self):
+        """ Returns a read-only snapshot of the user's profile. """
+
+        return UserView(self.__u_id, self.__email, self.__name_first,
+                        self.__name_last, self.__handle, self.__pfp_filename)
+
+
+class UserIndex():
+    """ Class for a prefix index over the names and handles of users, used to
+        find users by what they have typed so far.
+
+    The index is a sorted list of (case-folded key, u_id) pairs, so the users
+    with a key starting with a prefix are found with a binary search.
+    """
+
+    def __init__(self):
+        """ Creates an empty user index. """
+
+        self.__entries = []
+        self.__keys = {
+            # u_id: [case-folded key, ...]
+        }
+        # Bumped whenever any indexed user's profile changes.
+        self.__version = 0
+
+    def get_version(self):
+        """ Returns the version of the profiles of all the indexed users. """
+
+        return self.__version
+
+    def update(self, u_id, keys):
+        """ Replaces the keys that a user is indexed under, and bumps the
+            version of the index.
+        """
+
+        self.__version += 1
+
+        for key in self.__keys.pop(u_id, []):
+            position = bisect.bisect_left(self.__entries, (key, u_id))
+            del self.__entries[position]
+        keys = sorted({key.casefold() for key in keys if key})
+        for key in keys:
+            bisect.insort(self.__entries, (key, u_id))
+        self.__keys[u_id] = keys
+
+    def find(self, key):
+        """ Returns the u_ids of the users indexed under exactly the given key,
+            ignoring case.
+        """
+
+        key = key.casefold()
+        position = bisect.bisect_left(self.__entries, (key,))
+        u_ids = []
+        while (position < len(self.__entries) and
+               self.__entries[position][0] == key):
+            u_ids.append(self.__entries[position][1])
+            position += 1
+        return u_ids
+
+    def search(self, prefix, limit):
+        """ Returns up to limit u_ids of the users with a first name, last name,
+            full name, or handle starting with the prefix, ignoring case.
+
+        Users are returned in order of their first matching key.
+        """
+
+        prefix = prefix.casefold()
+        position = bisect.bisect_left(self.__entries, (prefix,))
+        u_ids = []
+        while position < len(self.__entries) and len(u_ids) < limit:
+            key, u_id = self.__entries[position]
+            if not key.startswith(prefix):
+                break
+            if u_id not in u_ids:
+                u_ids.append(u_id)
+            position += 1
+        return u_ids
+
 
 class Channel():
     """ Class for a channel. The channel_id is not an attribute of the channel
         object, and is instead used to identify the object in a dictionary.
     """
 
+    # The number of changes to messages that a channel keeps in its log. The
+    # log is saved in data.p with the channel, so it only goes back as far as
+    # a page of messages: a client further behind than that fetches the page
+    # again, which costs about as much as catching up on the changes would.
+    CHANGE_LOG_SIZE = 50
+    # The number of removed messages that a channel remembers before they are
+    # first compacted. They are compacted again each time their number
+    # doubles.
+    REMOVED_COMPACT_SIZE = 64
+
     def __init__(self, channel_id, creator_id, name, is_public):
         """ Creats a channel given the u_id of the creator, the name of the
             channel, and whether the channel is public.
@@ -207,13 +392,72 @@ class Channel():
         self.__channel_id = channel_id
         self.__owners = []
         self.__members = []
+        # The same members, so that membership is checked in constant time.
+        self.__member_set = set()
         self.__messages = []
+        # Times sent of the messages, kept parallel to (and sorted like) the
+        # list of message IDs so that it can be binary searched.
+        self.__message_times = []
+        self.__pinned_messages = set()
+        # Bumped whenever the messages in the channel are written to, with
+        # the most recent (version, message_id) changes kept in a log.
+        self.__version = 0
+        self.__changes = collections.deque(maxlen=self.CHANGE_LOG_SIZE)
+        # Messages are numbered in the order they are posted, so that the
+        # number of messages after a read marker can be found by subtracting,
+        # less the removed messages after it.
+        self.__sequence = 0
+        self.__message_sequences = {}
+        self.__removed_sequences = []
+        self.__compacted_size = 0
         self.add_owner(creator_id)
         self.add_member(creator_id)
         self.set_name(name)
         self.set_is_public(is_public)
         self.__current_msg = 0
 
+    def __setstate__(self, state):
+        """ Restores a channel loaded from data.p. The indexes of its messages
+            are rebuilt by rebuild_messages() if they are missing.
+        """
+
+        restore_state(self, state, {
+            "member_set": set(),
+            "message_times": [],
+            "pinned_messages": set(),
+            "version": 0,
+            "changes": collections.deque(maxlen=self.CHANGE_LOG_SIZE),
+            "sequence": 0,
+            "message_sequences": {},
+            "removed_sequences": [],
+            "compacted_size": 0,
+        })
+        self.__member_set = set(self.__members)
+        if self.__changes.maxlen != self.CHANGE_LOG_SIZE:
+            self.__changes = collections.deque(self.__changes,
+                                               maxlen=self.CHANGE_LOG_SIZE)
+
+    def rebuild_messages(self, return_message):
+        """ Rebuilds the indexes of the messages in the channel, for a channel
+            loaded from data.p saved before they existed. return_message()
+            returns a message object given its ID.
+
+        Messages are numbered again in the order they were sent.
+        """
+
+        messages = sorted(map(return_message, self.__messages),
+                          key=lambda message: (message.get_time_sent(),
+                                               message.get_id()))
+        self.__messages = []
+        self.__message_times = []
+        self.__message_sequences = {}
+        self.__removed_sequences = []
+        self.__compacted_size = 0
+        for message in messages:
+            self.add_message(message.get_id(), message.get_time_sent())
+        self.__pinned_messages = {message.get_id() for message in messages
+                                  if message.is_pinned()}
+
     def get_id(self):
         """ Returns the channel ID. """
 
@@ -232,6 +476,40 @@ class Channel():
         self.__current_msg -= 1
         return self.__messages[self.__current_msg]
 
+    def record_change(self, message_id):
+        """ Increments the version of the channel, and logs that a message
+            changed in it. Called whenever a message is posted, edited,
+            removed, reacted to or pinned, so that anything derived from the
+            messages in the channel can tell it is stale.
+        """
+
+        self.__version += 1
+        self.__changes.append((self.__version, message_id))
+
+    def get_version(self):
+        """ Returns the version of the channel. """
+
+        return self.__version
+
+    def get_changes(self, since):
+        """ Returns the IDs of the messages that changed after a version of
+            the channel, in the order they last changed.
+
+        If the log no longer goes back to that version, returns None. If the
+        version is newer than the channel, raises a ValueError.
+        """
+
+        if not 0 <= since <= self.__version:
+            raise ValueError("Invalid channel version")
+        if self.__changes and self.__changes[0][0] > since + 1:
+            return None
+        changed = {}
+        for version, message_id in reversed(self.__changes):
+            if version <= since:
+                break
+            changed.setdefault(message_id, version)
+        return sorted(changed, key=changed.get)
+
     def add_owner(self, owner_id):
         """ Adds an owner to a channel. Assumes the promotee is already a
             member.
@@ -261,13 +539,14 @@ class Channel():
         """ Adds a member to the channel. """
 
         self.__members.append(member_id)
+        self.__member_set.add(member_id)
 
     def is_member(self, u_id):
         """ Given a u_id, returns whether or not they are a member of
             the channel.
         """
 
-        return u_id in self.__members
+        return u_id in self.__member_set
 
     def remove_member(self, member_id):
         """ Removes a member from the list of members given their u_id. Assumes
@@ -275,23 +554,184 @@ class Channel():
         """
 
         self.__members.remove(member_id)
+        self.__member_set.discard(member_id)
+
+    def get_members(self, start=0, end=None):
+        """ Returns a copy of the list of members, in the order they joined,
+            or of the members from start up to but excluding end.
+        """
+
+        return self.__members[start:end]
+
+    def get_member_count(self):
+        """ Returns the number of members in the channel. """
+
+        return len(self.__members)
+
+    def get_owner_count(self):
+        """ Returns the number of owners of the channel. """
 
-    def get_members(self):
-        """ Returns a copy of the list of members. """
+        return len(self.__owners)
 
-        return self.__members[:]
+    def add_message(self, message_id, time_sent):
+        """ Adds a message to the channel given its message id and the time it
+            was sent.
 
-    def add_message(self, message_id):
-        """ Adds a message to the channel given its message id. """
+        Messages are kept in order of the time they were sent. New messages
+        are almost always the newest, in which case this is an append.
+        """
 
-        self.__messages.append(message_id)
+        timestamp = time_sent.timestamp()
+        position = bisect.bisect_right(self.__message_times, timestamp)
+        self.__messages.insert(position, message_id)
+        self.__message_times.insert(position, timestamp)
+        self.__sequence += 1
+        self.__message_sequences[message_id] = self.__sequence
+        self.record_change(message_id)
 
     def remove_message(self, message_id):
         """ Removes a message from the channel given its message_id. Assumes
             that the message is in the channel.
         """
 
-        self.__messages.remove(message_id)
+        position = self.__messages.index(message_id)
+        del self.__messages[position]
+        del self.__message_times[position]
+        self.__pinned_messages.discard(message_id)
+        bisect.insort(self.__removed_sequences,
+                      self.__message_sequences.pop(message_id))
+        self.record_change(message_id)
+
+    def get_sequence(self):
+        """ Returns the sequence number of the last message posted in the
+            channel, or 0 if none have been.
+        """
+
+        return self.__sequence
+
+    def get_message_sequence(self, message_id):
+        """ Returns the sequence number of a message in the channel, which
+            counts the messages posted in the channel up to and including it.
+        """
+
+        if message_id not in self.__message_sequences:
+            raise ValueError("Message is not in the channel")
+        return self.__message_sequences[message_id]
+
+    def get_removed_count(self):
+        """ Returns the number of removed messages whose sequence numbers the
+            channel remembers.
+        """
+
+        return len(self.__removed_sequences)
+
+    def should_compact_removed(self):
+        """ Returns whether enough messages have been removed since the
+            channel was last compacted by compact_removed() to do it again.
+        """
+
+        return (len(self.__removed_sequences) >=
+                max(self.REMOVED_COMPACT_SIZE, 2 * self.__compacted_size))
+
+    def compact_removed(self, read_marker):
+        """ Forgets the sequence numbers of the removed messages up to a read
+            marker, as they no longer change the unread count of any member.
+            The read marker must be the earliest of every member's.
+        """
+
+        del self.__removed_sequences[:bisect.bisect_right(
+            self.__removed_sequences, read_marker)]
+        self.__compacted_size = len(self.__removed_sequences)
+
+    def get_unread_count(self, read_marker):
+        """ Returns the number of messages in the channel posted after the
+            message with the sequence number read_marker.
+        """
+
+        removed = (len(self.__removed_sequences) -
+                   bisect.bisect_right(self.__removed_sequences, read_marker))
+        return self.__sequence - read_marker - removed
+
+    def __find_message(self, message_id, time_sent):
+        """ Returns the position in the list of message IDs of a message sent
+            at the given time, or None if it has not been posted in the
+            channel. Uses a binary search over the times messages were sent.
+        """
+
+        timestamp = time_sent.timestamp()
+        position = bisect.bisect_left(self.__message_times, timestamp)
+        while (position < len(self.__messages) and
+               self.__message_times[position] == timestamp):
+            if self.__messages[position] == message_id:
+                return position
+            position += 1
+        return None
+
+    def has_message(self, message_id, time_sent):
+        """ Returns whether a message, sent at the given time, has been posted
+            in the channel.
+        """
+
+        return self.__find_message(message_id, time_sent) is not None
+
+    def get_messages_between(self, start_time, end_time):
+        """ Returns the IDs of the messages sent from the start timestamp up
+            to, but excluding, the end timestamp, oldest first. Either bound
+            can be None.
+        """
+
+        start = (0 if start_time is None else
+                 bisect.bisect_left(self.__message_times, start_time))
+        end = (len(self.__messages) if end_time is None else
+               bisect.bisect_left(self.__message_times, end_time))
+        return self.__messages[start:end]
+
+    def pin_message(self, message_id):
+        """ Adds a message to the set of pinned messages in the channel. """
+
+        self.__pinned_messages.add(message_id)
+        self.record_change(message_id)
+
+    def unpin_message(self, message_id):
+        """ Removes a message from the set of pinned messages in the channel.
+        """
+
+        self.__pinned_messages.discard(message_id)
+        self.record_change(message_id)
+
+    def get_pinned_messages(self):
+        """ Returns a copy of the set of IDs of pinned messages in the channel.
+        """
+
+        return set(self.__pinned_messages)
+
+    def get_message_index(self, timestamp):
+        """ Returns the index, counting from the newest message like
+            get_messages(), of the oldest message sent at or after the given
+            timestamp.
+
+        If every message was sent before the timestamp, returns 0.
+        """
+
+        position = bisect.bisect_left(self.__message_times, timestamp)
+        return max(len(self.__messages) - position - 1, 0)
+
+    def get_message_position(self, message_id, time_sent):
+        """ Returns the index, counting from the newest message like
+            get_messages(), of a message sent at the given time.
+
+        If the message is not in the channel, raises a ValueError.
+        """
+
+        position = self.__find_message(message_id, time_sent)
+        if position is None:
+            raise ValueError("Message is not in the channel")
+        return len(self.__messages) - position - 1
+
+    def get_message_count(self):
+        """ Returns the number of messages in the channel. """
+
+        return len(self.__messages)
 
     def get_messages(self, start, end):
         """ Returns a page of messages in the form of a list of message IDs.
@@ -352,6 +792,7 @@ class Message():
         """
 
         self.__message_id = message_id
+        self.__version = 0
         self.set_channel_id(channel_id)
         self.set_message_body(message)
         self.set_u_id(u_id)
@@ -359,6 +800,20 @@ class Message():
         self.__reacts = {}
         self.__is_pinned = False
 
+    def __setstate__(self, state):
+        """ Restores a message loaded from data.p, folding its body again if
+            it was saved before bodies were folded.
+        """
+
+        missing = restore_state(self, state, {
+            "version": 0,
+            "folded_body": None,
+            "folded_offsets": None,
+        })
+        if "folded_body" in missing:
+            self.__folded_body, self.__folded_offsets = \
+                search_index.fold_with_offsets(self.__message_body)
+
     def get_id(self):
         """ Returns the message ID. """
 
@@ -374,20 +829,55 @@ class Message():
 
         return self.__channel_id
 
+    def get_version(self):
+        """ Returns the version of the message, which is bumped whenever its
+            body, sender, time sent, reactions or pinned status change.
+        """
+
+        return self.__version
+
     def set_message_body(self, message):
-        """ Sets the body of the message. """
+        """ Sets the body of the message, along with the folded body that it
+            is searched by.
+        """
 
         self.__message_body = message
+        self.__version += 1
+        self.__folded_body, self.__folded_offsets = \
+            search_index.fold_with_offsets(message)
 
     def get_message_body(self):
         """ Returns the body of the message. """
 
         return self.__message_body
 
+    def get_folded_body(self):
+        """ Returns the body of the message case-folded and without accents,
+            as it is searched.
+        """
+
+        return self.__folded_body
+
+    def get_original_span(self, start, end):
+        """ Returns the span of the body of the message that a span of its
+            folded body came from.
+
+        Characters removed by folding, such as accents, are included with the
+        character before them.
+        """
+
+        offsets = self.__folded_offsets
+        if offsets is None:
+            return start, end
+        while end < len(offsets) - 1 and offsets[end] == offsets[end - 1]:
+            end += 1
+        return offsets[start], offsets[end]
+
     def set_u_id(self, u_id):
         """ Sets the user ID of the user who sent the message. """
 
         self.__u_id = u_id
+        self.__version += 1
 
     def get_u_id(self):
         """ Returns the user ID of the sender. """
@@ -398,6 +888,7 @@ class Message():
         """ Set the time that the message is sent. """
 
         self.__time_sent = time_sent
+        self.__version += 1
 
     def get_time_sent(self):
         """ Returns the time that the message is sent. """
@@ -408,11 +899,13 @@ class Message():
         """ Pins the message. """
 
         self.__is_pinned = True
+        self.__version += 1
 
     def unpin(self):
         """ Unpins the message. """
 
         self.__is_pinned = False
+        self.__version += 1
 
     def is_pinned(self):
         """ Returns whether the message is pinned or not. """
@@ -426,6 +919,7 @@ class Message():
         if react_id in self.__reacts:
             raise ValueError("React Id already active")
         self.__reacts[react_id] = [u_id]
+        self.__version += 1
 
     def get_reacts(self):
         """ Returns a copy of all the reactions to the message, along with
@@ -434,12 +928,27 @@ class Message():
 
         return copy.deepcopy(self.__reacts)
 
+    def view(self):
+        """ Returns a read-only snapshot of the message. The reactions are
+            given as a tuple of (react_id, tuple of u_ids) pairs, which avoids
+            the deep copy made by get_reacts().
+        """
+
+        return MessageView(
+            self.__message_id, self.__channel_id, self.__u_id,
+            self.__message_body, self.__time_sent.timestamp(),
+            tuple((react_id, tuple(u_ids))
+                  for react_id, u_ids in self.__reacts.items()),
+            self.__is_pinned, self.__version,
+        )
+
     def remove_react(self, react_id):
         """ Removes a reaction from the message. """
 
         if react_id not in self.__reacts:
             raise ValueError("React Id already not active")
         del self.__reacts[react_id]
+        self.__version += 1
 
 
 class ServerData():
@@ -451,6 +960,10 @@ class ServerData():
     WORKING_FILEPATH = "working_images/"
     DEFAULT_PFP_FILENAME = "default.jpeg"
     DATA_FILENAME = "data.p"
+    SEGMENTS_DIRECTORY = "data.p.segments"
+    # Bumped whenever the server data gains an index that data saved by
+    # earlier versions needs to have rebuilt.
+    DATA_VERSION = 1
 
     def __init__(self):
         """ Constructs a ServerData instance.
@@ -468,14 +981,105 @@ class ServerData():
         self.__messages = {
             # message_id: ###message object###
         }
+        self.__user_messages = {
+            # u_id: [message_id, ...] in the order they were registered
+        }
+        # Sorted list of (case-folded channel name, channel_id) pairs.
+        self.__channel_names = []
+        self.__user_index = UserIndex()
+        self.__search_index = SearchIndex(self.SEGMENTS_DIRECTORY)
+        # Distinguishes this server's data from data that has been reset.
+        self.__instance_id = binascii.hexlify(os.urandom(16)).decode("ascii")
         self.__u_id_counter = 0
         self.__channel_id_counter = 0
         self.__message_id_counter = 0
+        self.__data_version = self.DATA_VERSION
+        self.__migrated = False
+
+    def __setstate__(self, state):
+        """ Restores the server data loaded from data.p. Data saved by an
+            earlier version has its indexes rebuilt.
+        """
+
+        self.__dict__.update(state)
+        self.__migrated = \
+            state.get("_ServerData__data_version", 0) < self.DATA_VERSION
+        if self.__migrated:
+            self.__rebuild_indexes()
+
+    def is_migrated(self):
+        """ Returns whether the data was saved by an earlier version, and had
+            its indexes rebuilt when it was loaded.
+        """
+
+        return self.__migrated
+
+    def __rebuild_indexes(self):
+        """ Rebuilds every index from the users, channels and messages, so
+            that data saved before the indexes existed can still be loaded.
+
+        Users are taken to have read every channel they are in, rather than
+        see its whole history as unread.
+        """
+
+        self.__instance_id = binascii.hexlify(os.urandom(16)).decode("ascii")
+        self.__user_index = UserIndex()
+        for user in self.__users.values():
+            user.attach_index(self.__user_index)
+        self.__channel_names = sorted(
+            (channel.get_name().casefold(), channel_id)
+            for channel_id, channel in self.__channels.items())
+        self.__user_messages = {}
+        self.__search_index = SearchIndex(self.SEGMENTS_DIRECTORY)
+        posted_ids = []
+        for channel in self.__channels.values():
+            channel.rebuild_messages(self.return_message)
+            posted_ids.extend(channel)
+        for message_id in sorted(posted_ids):
+            self.post_message(message_id)
+        for user in self.__users.values():
+            for channel_id in user.get_channels():
+                user.mark_read(channel_id,
+                               self.__channels[channel_id].get_sequence())
+        self.__data_version = self.DATA_VERSION
+
+    def get_instance_id(self):
+        """ Returns the ID of this ServerData instance, which is unique even
+            across resets of the server data.
+        """
+
+        return self.__instance_id
 
     def register_user(self, user):
-        """ Registers a user object in the server. """
+        """ Registers a user object in the server, and makes their names and
+            handle searchable in the user index.
+        """
 
         self.__users[user.get_id()] = user
+        user.attach_index(self.__user_index)
+
+    def get_users_version(self):
+        """ Returns a version that is bumped whenever a user registers or
+            changes their profile.
+        """
+
+        return self.__user_index.get_version()
+
+    def make_etag(self, *parts):
+        """ Returns an entity tag for a response that only depends on the given
+            versions and IDs. Tags are unique to this ServerData instance, so
+            they do not survive a reset of the server data.
+        """
+
+        return hashlib.sha1(repr((self.__instance_id,) + parts)
+                            .encode()).hexdigest()
+
+    def search_users(self, prefix, limit):
+        """ Returns up to limit u_ids of the users with a name or handle
+            starting with the prefix, ignoring case.
+        """
+
+        return self.__user_index.search(prefix, limit)
 
     def return_user(self, u_id):
         """ Returns a user object given their user ID.
@@ -488,15 +1092,57 @@ class ServerData():
 
         return self.__users[u_id]
 
+    def return_users(self, u_ids):
+        """ Returns a list of read-only views of users given their user IDs,
+            validating all the IDs in a single pass.
+
+        If any user ID is invalid, raises a ValueError.
+        """
+
+        users = self.__users
+        try:
+            return [users[u_id].view() for u_id in u_ids]
+        except KeyError:
+            raise ValueError("Invalid user id")
+
     def get_all_u_id(self):
         """ Returns a set of all the registered user IDs. """
 
         return self.__users.keys()
 
     def register_channel(self, channel):
-        """ Registers a channel object in the server. """
+        """ Registers a channel object in the server, and adds it to the
+            channel name index.
+        """
 
         self.__channels[channel.get_id()] = channel
+        bisect.insort(self.__channel_names,
+                      (channel.get_name().casefold(), channel.get_id()))
+
+    def search_channel_names(self, query_str=""):
+        """ Returns the IDs of the channels whose name contains the query
+            string, ignoring case.
+
+        Channels whose name starts with the query string are found with a
+        binary search over the sorted name index and come first, followed by
+        the remaining channels that contain it. Both groups are in name order.
+        """
+
+        query_str = query_str.casefold()
+        position = bisect.bisect_left(self.__channel_names, (query_str,))
+        prefix_ids = []
+        while position < len(self.__channel_names):
+            name, channel_id = self.__channel_names[position]
+            if not name.startswith(query_str):
+                break
+            prefix_ids.append(channel_id)
+            position += 1
+        if query_str == "":
+            return prefix_ids
+        return prefix_ids + [
+            channel_id for name, channel_id in self.__channel_names
+            if query_str in name and not name.startswith(query_str)
+        ]
 
     def return_channel(self, channel_id):
         """ Returns a channel object given its ID.
@@ -515,10 +1161,23 @@ class ServerData():
         return self.__channels.keys()
 
     def register_message(self, message):
-        """ Registers a message object in the server. """
+        """ Registers a message object in the server. Messages sent later are
+            registered when they are scheduled, but are only indexed once
+            post_message() is called.
+        """
 
         self.__messages[message.get_id()] = message
 
+    def post_message(self, message_id):
+        """ Indexes a registered message under the user who sent it, and
+            makes it searchable. Called once the message is posted to its
+            channel.
+        """
+
+        self.__user_messages.setdefault(
+            self.__messages[message_id].get_u_id(), []).append(message_id)
+        self.index_message(message_id)
+
     def return_message(self, message_id):
         """ Returns a message object given its ID.
 
@@ -530,6 +1189,31 @@ class ServerData():
 
         return self.__messages[message_id]
 
+    def return_messages(self, message_ids):
+        """ Returns a list of read-only views of messages given their IDs,
+            validating all the IDs in a single pass.
+
+        If any message ID is invalid, raises a ValueError.
+        """
+
+        messages = self.__messages
+        try:
+            return [messages[message_id].view() for message_id in message_ids]
+        except KeyError:
+            raise ValueError("Invalid message id")
+
+    def compact_removed_messages(self, channel):
+        """ Compacts the removed messages that a channel remembers to count
+            unread messages, if enough have been removed since it was last
+            compacted.
+        """
+
+        if channel.should_compact_removed():
+            channel.compact_removed(min(
+                (self.return_user(u_id).get_read_marker(channel.get_id())
+                 for u_id in channel.get_members()),
+                default=channel.get_sequence()))
+
     def delete_message(self, message_id):
         """ Deletes a message from the server given its ID.
 
@@ -538,7 +1222,73 @@ class ServerData():
         # Presently, checking validity of message_id is redundant.
         #if message_id not in self.__messages:
             #raise ValueError("Invalid message id")
-        del self.__messages[message_id]
+        message = self.__messages.pop(message_id)
+        user_messages = self.__user_messages.get(message.get_u_id(), [])
+        if message_id in user_messages:
+            user_messages.remove(message_id)
+        self.__search_index.remove(message_id)
+
+    def index_message(self, message_id):
+        """ Makes the current body of a message searchable. Called by
+            post_message(), and again whenever a message is edited.
+        """
+
+        self.__search_index.add(message_id,
+                                self.__messages[message_id].get_folded_body())
+
+    def get_search_candidates(self, query_str):
+        """ Returns the set of IDs of posted messages that could contain the
+            query string, or None if the search index cannot narrow it down.
+        """
+
+        return self.__search_index.candidates(query_str)
+
+    def estimate_search_candidates(self, query_str):
+        """ Returns an upper bound on the number of messages that
+            get_search_candidates() would return for the query string.
+        """
+
+        return self.__search_index.estimate(query_str)
+
+    def get_search_scorer(self, query_str):
+        """ Returns a function that gives the relevance of a posted message to
+            the query string.
+        """
+
+        return self.__search_index.scorer(query_str)
+
+    def collect_search_garbage(self):
+        """ Deletes the files of search index segments that are no longer
+            needed. Called by save_data() once the data has been saved.
+        """
+
+        self.__search_index.collect_garbage()
+
+    def get_search_version(self):
+        """ Returns the version of the search index, which changes whenever a
+            message is indexed or removed from it.
+        """
+
+        return self.__search_index.get_version()
+
+    def get_user_messages(self, u_id, start, end):
+        """ Returns a page of the IDs of messages sent by a user, newest first.
+            The page goes from start to end, including start and excluding end.
+
+        Follows the same paging contract as Channel.get_messages(), so the cost
+        is proportional to the number of messages the user has sent rather
+        than the number of messages on the server.
+        """
+
+        message_ids = self.__user_messages.get(u_id, [])
+        if len(message_ids) == 0 and start == 0:
+            return []
+        if start >= len(message_ids):
+            raise ValueError("Start index of message page exceeds number of "
+                             "messages sent by the user")
+
+        length = len(message_ids)
+        return message_ids[max(length - end, 0):length - start][::-1]
 
     def get_u_id_counter(self):
         """ Returns the current value of the u_id counter. """
@@ -590,6 +1340,23 @@ class ServerData():
                 return u_id
         raise ValueError("Unregistered email")
 
+    def get_u_id_from_handle(self, handle):
+        """ Returns the u_id of a user based on their handle, ignoring case.
+            The user index is used to find the users that could have it.
+
+        If there is no user with that handle, raises a ValueError.
+        """
+
+        for u_id in self.__user_index.find(handle):
+            if self.__users[u_id].get_handle().casefold() == handle.casefold():
+                return u_id
+        raise ValueError("Unregistered handle")
+
+    def get_user_message_ids(self, u_id):
+        """ Returns a copy of the list of IDs of messages sent by a user. """
+
+        return self.__user_messages.get(u_id, [])[:]
+
     def generate_unique_handle(self, handle):
         """ Generates a new handle by concatenating a sequence of 3 digits. """
 
@@ -606,22 +1373,36 @@ class ServerData():
 def initialise_data():
     """ Resets/sets the server data. All the data is stored in a single
         ServerData object. The data is serialised each time it is modified
-        in data.p.
+        in data.p, apart from the sealed segments of the search index,
+        which are stored in data.p.segments.
     """
 
+    search_index.clear_segments(ServerData.SEGMENTS_DIRECTORY)
     data = ServerData()
     with open(ServerData.DATA_FILENAME, "wb") as file:
         pickle.dump(data, file)
 
 def load_data():
-    """ Loads the data from data.p into a ServerData object. """
+    """ Loads the data from data.p into a ServerData object. Data saved by an
+        earlier version is saved again once its indexes are rebuilt, so that
+        they are only rebuilt once.
+    """
 
     with open(ServerData.DATA_FILENAME, "rb") as file:
         data = pickle.load(file)
+    if data.is_migrated():
+        save_data(data)
     return data
 
 def save_data(data):
-    """ Saves the passed server data into data.p. """
+    """ Saves the passed server data into data.p. The data is written to a
+        temporary file first and then moved over data.p, so that other
+        requests never load a partly written file.
+    """
 
-    with open(ServerData.DATA_FILENAME, "wb") as file:
+    temporary_filename = f"{ServerData.DATA_FILENAME}.{os.getpid()}." \
+                         f"{threading.get_ident()}.tmp"
+    with open(temporary_filename, "wb") as file:
         pickle.dump(data, file)
+    os.replace(temporary_filename, ServerData.DATA_FILENAME)
+    data.collect_search_garbage()
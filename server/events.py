@@ -0,0 +1,183 @@
+""" Contains the registry that pushes changes in channels to the clients
+    subscribed to them, as Server-Sent Events.
+
+Events are published by the functions that change messages, after the change
+has been saved, and fanned out to a queue per subscriber. Requests long
+polling a channel instead wait on its condition, which is notified with each
+event. Like the standup data, subscriptions are not persistent, and only exist
+in the running server.
+
+Channels are identified by the instance ID of the server data along with
+their channel ID, like the caches, so that once the data is reset, possibly by
+another process, the channels of the new data start afresh.
+"""
+
+import json
+import queue
+import threading
+
+from server import auth
+from server import data
+from server.Error import AccessError, BusyError
+
+# The number of events a subscriber can fall behind by before its events are
+# replaced by a single reset event, telling it to fetch the channel again.
+QUEUE_SIZE = 100
+
+# Seconds between comments sent to idle subscribers, so that connections
+# which have been closed are noticed.
+HEARTBEAT_INTERVAL = 15
+
+SUBSCRIBERS = {
+    # (instance_id, channel_id): {queue, ...}
+}
+SUBSCRIBERS_LOCK = threading.Lock()
+
+# The most seconds a long poll can wait for, and the most requests that can
+# wait at once. As each waiting request holds a server thread, requests past
+# the limit are turned away, and told to retry after WAIT_RETRY_AFTER seconds.
+WAIT_TIMEOUT_LIMIT = 30
+MAX_WAITERS = 64
+WAIT_RETRY_AFTER = 5
+WAITERS = threading.BoundedSemaphore(MAX_WAITERS)
+
+CONDITIONS = {
+    # (instance_id, channel_id): condition
+}
+PUBLISHED_VERSIONS = {
+    # (instance_id, channel_id): version
+}
+
+def reset_subscribers():
+    """ Removes every subscription, and forgets the published versions. """
+
+    global SUBSCRIBERS, CONDITIONS, PUBLISHED_VERSIONS
+    with SUBSCRIBERS_LOCK:
+        SUBSCRIBERS = {}
+        CONDITIONS = {}
+        PUBLISHED_VERSIONS = {}
+
+def get_condition(key):
+    """ Returns the condition notified when an event is published to a
+        channel, given its (instance_id, channel_id) key.
+    """
+
+    with SUBSCRIBERS_LOCK:
+        return CONDITIONS.setdefault(key, threading.Condition())
+
+def subscribe(key):
+    """ Returns a new queue that the events published to a channel are put
+        on, given its (instance_id, channel_id) key.
+    """
+
+    subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+    with SUBSCRIBERS_LOCK:
+        SUBSCRIBERS.setdefault(key, set()).add(subscriber)
+    return subscriber
+
+def unsubscribe(key, subscriber):
+    """ Stops putting the events published to a channel on a queue. """
+
+    with SUBSCRIBERS_LOCK:
+        subscribers = SUBSCRIBERS.get(key, set())
+        subscribers.discard(subscriber)
+        if not subscribers:
+            SUBSCRIBERS.pop(key, None)
+
+def publish(server_data, channel_id, event_type, message_id, version):
+    """ Puts an event on the queue of every subscriber to a channel in the
+        given server data.
+
+    If a subscriber's queue is full, its events are dropped, and replaced by a
+    reset event.
+    """
+
+    key = (server_data.get_instance_id(), channel_id)
+    event = (event_type, {
+        "channel_id": channel_id,
+        "message_id": message_id,
+        "version": version,
+    })
+    condition = get_condition(key)
+    with condition:
+        PUBLISHED_VERSIONS[key] = max(version,
+                                      PUBLISHED_VERSIONS.get(key, 0))
+        condition.notify_all()
+    with SUBSCRIBERS_LOCK:
+        subscribers = list(SUBSCRIBERS.get(key, ()))
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            with subscriber.mutex:
+                subscriber.queue.clear()
+            subscriber.put_nowait(("reset", {
+                "channel_id": channel_id,
+                "version": version,
+            }))
+
+def wait_for_version(server_data, channel_id, since, timeout):
+    """ Waits until an event newer than a version of a channel in the given
+        server data is published, or for timeout seconds, capped at
+        WAIT_TIMEOUT_LIMIT. Returns whether a newer version was published.
+
+    If MAX_WAITERS requests are already waiting, raises a BusyError straight
+    away.
+    """
+
+    if not WAITERS.acquire(blocking=False):
+        raise BusyError("Too many requests are waiting")
+    key = (server_data.get_instance_id(), channel_id)
+    try:
+        condition = get_condition(key)
+        with condition:
+            return condition.wait_for(
+                lambda: PUBLISHED_VERSIONS.get(key, 0) > since,
+                min(timeout, WAIT_TIMEOUT_LIMIT))
+    finally:
+        WAITERS.release()
+
+def format_event(event_type, event_data):
+    """ Serialises an event in the Server-Sent Events format, using the
+        version of the channel as the event ID.
+    """
+
+    return (f"event: {event_type}\n"
+            f"id: {event_data['version']}\n"
+            f"data: {json.dumps(event_data)}\n\n")
+
+def stream_events(key, subscriber):
+    """ Yields the events put on a subscriber's queue as they arrive, along
+        with heartbeats while the channel is idle. Unsubscribes once the
+        client disconnects and the generator is closed.
+    """
+
+    try:
+        while True:
+            try:
+                event_type, event_data = subscriber.get(
+                    timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            yield format_event(event_type, event_data)
+    finally:
+        unsubscribe(key, subscriber)
+
+def channel_stream(token, channel_id):
+    """ Subscribes the authorised user to the events in a channel, returning
+        a generator of the events in the Server-Sent Events format.
+
+    The event ID is the version of the channel after the event, which can be
+    passed to channel_changes() to fetch the changed messages. Checks are
+    made before subscribing, so errors are raised by this function rather
+    than the generator.
+    """
+
+    user_id = auth.verify_token(token)
+    server_data = data.load_data()
+    channel = server_data.return_channel(channel_id)
+    if not channel.is_member(user_id):
+        raise AccessError("Authorised user is not a member of the channel")
+    key = (server_data.get_instance_id(), channel_id)
+    return stream_events(key, subscribe(key))
@@ -0,0 +1,138 @@
+""" Unit tests for the Server-Sent Events registry.
+
+Designed to be run using the pytest utility.
+"""
+
+import json
+import threading
+import time
+
+import pytest
+
+from server import auth
+from server import channel
+from server import channels
+from server import data
+from server import events
+from server import message
+from server.Error import AccessError, BusyError, ValueError
+
+def parse_event(event_text):
+    """ Returns the type and data of an event in the Server-Sent Events format.
+    """
+
+    fields = dict(line.split(": ", 1) for line in event_text.strip().split("\n"))
+    return fields["event"], json.loads(fields["data"])
+
+def test_channel_stream_events():
+    """ Tests that changes to messages in a channel are streamed to its
+    subscribers, in order, with the channel version as the event ID.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    events.reset_subscribers()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    other_channel_info = channels.channels_create(user_info["token"], "other server", 1)
+    stream = events.channel_stream(user_info["token"], channel_info["channel_id"])
+
+    message_info = message.message_send(user_info["token"], channel_info["channel_id"], "hi")
+    message.message_send(user_info["token"], other_channel_info["channel_id"], "elsewhere")
+    message.message_edit(user_info["token"], message_info["message_id"], "hello")
+    message.message_react(user_info["token"], message_info["message_id"], 1)
+    message.message_pin(user_info["token"], message_info["message_id"])
+    message.message_remove(user_info["token"], message_info["message_id"])
+
+    received = [parse_event(next(stream)) for _ in range(5)]
+    assert [event_type for event_type, _ in received] == [
+        "message_sent", "message_edited", "message_reacted", "message_pinned",
+        "message_removed"]
+    assert all(event_data["message_id"] == message_info["message_id"]
+               for _, event_data in received)
+    assert [event_data["version"] for _, event_data in received] == [1, 2, 3, 4, 5]
+
+    stream.close()
+    assert (data.load_data().get_instance_id(),
+            channel_info["channel_id"]) not in events.SUBSCRIBERS
+
+def test_channel_stream_not_member():
+    """ Tests that only members of a channel can subscribe to its events. """
+    auth.reset_auth_data()
+    data.initialise_data()
+    events.reset_subscribers()
+    user_info_1 = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info_2 = auth.auth_register("testemail2@hotmail.com", "badpassword123", "Major", "Wonky")
+    channel_info = channels.channels_create(user_info_1["token"], "my server", 0)
+    with pytest.raises(AccessError):
+        events.channel_stream(user_info_2["token"], channel_info["channel_id"])
+    assert not events.SUBSCRIBERS
+
+def test_channel_wait():
+    """ Tests that a long poll returns once the channel changes, and
+    straight away if it has already changed.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    events.reset_subscribers()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+
+    def send_later():
+        time.sleep(0.2)
+        message.message_send(user_info["token"], channel_info["channel_id"], "hi")
+    sender = threading.Thread(target=send_later)
+    sender.start()
+    start = time.time()
+    changes = channel.channel_wait(user_info["token"], channel_info["channel_id"], 0, 10)
+    sender.join()
+    assert time.time() - start < 5
+    assert changes["version"] == 1
+    assert [msg["message"] for msg in changes["messages"]] == ["hi"]
+
+    changes = channel.channel_wait(user_info["token"], channel_info["channel_id"], 0, 10)
+    assert changes["version"] == 1
+
+    start = time.time()
+    changes = channel.channel_wait(user_info["token"], channel_info["channel_id"], 1, 0.2)
+    assert 0.2 <= time.time() - start < 5
+    assert changes["version"] == 1
+    assert changes["messages"] == []
+
+    with pytest.raises(ValueError):
+        channel.channel_wait(user_info["token"], channel_info["channel_id"], 2, 1)
+    with pytest.raises(ValueError):
+        channel.channel_wait(user_info["token"], channel_info["channel_id"], 1, -1)
+
+    # Once the data is reset, the new channel with the same ID has had nothing
+    # published to it, so a long poll waits.
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    start = time.time()
+    changes = channel.channel_wait(user_info["token"], channel_info["channel_id"], 0, 0.2)
+    assert 0.2 <= time.time() - start < 5
+    assert changes["version"] == 0
+
+def test_channel_wait_limit(monkeypatch):
+    """ Tests that long polls past the limit on waiting requests are turned
+    away straight away, rather than returning no changes.
+    """
+    auth.reset_auth_data()
+    data.initialise_data()
+    events.reset_subscribers()
+    monkeypatch.setattr(events, "WAITERS", threading.BoundedSemaphore(1))
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    assert events.WAITERS.acquire(blocking=False)
+    start = time.time()
+    with pytest.raises(BusyError):
+        channel.channel_wait(user_info["token"], channel_info["channel_id"], 0, 10)
+    assert time.time() - start < 5
+    events.WAITERS.release()
+    # A channel that has already changed is returned without waiting.
+    message.message_send(user_info["token"], channel_info["channel_id"], "hi")
+    assert events.WAITERS.acquire(blocking=False)
+    changes = channel.channel_wait(user_info["token"], channel_info["channel_id"], 0, 10)
+    assert changes["version"] == 1
+    events.WAITERS.release()
@@ -1,12 +1,20 @@
 """ Contains all messaging-related functions. """
 
+import collections
 import datetime
+import json
 import threading
 
 from server import auth
 from server import data
+from server import events
 from server.Error import AccessError, ValueError
 
+# The number of messages whose JSON is cached, least recently used first.
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE = collections.OrderedDict()
+FRAGMENT_CACHE_LOCK = threading.Lock()
+
 def is_valid_message_body(message_body):
     """ Checks if message is of valid length. """
 
@@ -14,6 +22,106 @@ def is_valid_message_body(message_body):
         return False
     return True
 
+def message_info(view, u_id):
+    """ Serialises a message, given a read-only view of it, as seen by the user
+        with the given u_id.
+    """
+
+    return {
+        "message_id": view.message_id,
+        "u_id": view.u_id,
+        "message": view.message,
+        "time_created": view.time_created,
+        "reacts": [{
+            "react_id": react_id,
+            "u_ids": list(u_ids),
+            "is_this_user_reacted": u_id in u_ids,
+        } for react_id, u_ids in view.reacts],
+        "is_pinned": view.is_pinned,
+    }
+
+def reset_fragment_cache():
+    """ Removes every cached message fragment. """
+
+    with FRAGMENT_CACHE_LOCK:
+        FRAGMENT_CACHE.clear()
+
+def make_fragment(view):
+    """ Serialises a message in JSON, given a read-only view of it, as seen by
+        no user in particular.
+
+    Returns the JSON split around each react's is_this_user_reacted value,
+    along with the u_ids of each react, which decide those values.
+    """
+
+    head = json.dumps({
+        "message_id": view.message_id,
+        "u_id": view.u_id,
+        "message": view.message,
+        "time_created": view.time_created,
+    })
+    parts = [head[:-1] + ", \"reacts\": ["]
+    for index, (react_id, u_ids) in enumerate(view.reacts):
+        if index:
+            parts[-1] += ", "
+        parts[-1] += json.dumps({
+            "react_id": react_id,
+            "u_ids": list(u_ids),
+        })[:-1] + ", \"is_this_user_reacted\": "
+        parts.append("}")
+    parts[-1] += "], \"is_pinned\": " + json.dumps(view.is_pinned) + "}"
+    return parts, [frozenset(u_ids) for _, u_ids in view.reacts]
+
+def message_json(server_data, view, u_id):
+    """ Returns the same JSON as serialising message_info(view, u_id).
+
+    The JSON of each message is cached by its ID and version, and only the
+    is_this_user_reacted values are filled in for the user.
+    """
+
+    key = (server_data.get_instance_id(), view.message_id)
+    with FRAGMENT_CACHE_LOCK:
+        cached = FRAGMENT_CACHE.get(key)
+        if cached is not None and cached[0] == view.version:
+            FRAGMENT_CACHE.move_to_end(key)
+    if cached is None or cached[0] != view.version:
+        cached = (view.version,) + make_fragment(view)
+        with FRAGMENT_CACHE_LOCK:
+            FRAGMENT_CACHE[key] = cached
+            FRAGMENT_CACHE.move_to_end(key)
+            while len(FRAGMENT_CACHE) > FRAGMENT_CACHE_SIZE:
+                FRAGMENT_CACHE.popitem(last=False)
+    _, parts, react_u_ids = cached
+    if not react_u_ids:
+        return parts[0]
+    json_parts = [parts[0]]
+    for u_ids, part in zip(react_u_ids, parts[1:]):
+        json_parts.append("true" if u_id in u_ids else "false")
+        json_parts.append(part)
+    return "".join(json_parts)
+
+def message_page_info(views, u_id, fields):
+    """ Serialises a page of messages, given read-only views of them, as seen
+        by the user with the given u_id, along with the other fields of the
+        page.
+    """
+
+    page = {"messages": [message_info(view, u_id) for view in views]}
+    page.update(fields)
+    return page
+
+def message_page_json(server_data, views, u_id, fields):
+    """ Serialises a page of messages in JSON, like message_page_info(),
+        joined together from the cached JSON of each message.
+    """
+
+    messages = ", ".join(message_json(server_data, view, u_id)
+                         for view in views)
+    if not fields:
+        return "{\"messages\": [" + messages + "]}"
+    return ("{\"messages\": [" + messages + "], " +
+            json.dumps(fields)[1:])
+
 def message_send(token, channel_id, message_body):
     """ Sends a message. """
 
@@ -28,8 +136,14 @@ def message_send(token, channel_id, message_body):
     message_id = server_data.get_new_message_id()
     message_obj = data.Message(message_id, u_id, channel_id, message_body, time_sent)
     server_data.register_message(message_obj)
-    channel.add_message(message_id)
+    channel.add_message(message_id, time_sent)
+    server_data.post_message(message_id)
+    # Users have read the channel up to the messages they send.
+    server_data.return_user(u_id).mark_read(
+        channel_id, channel.get_message_sequence(message_id))
     data.save_data(server_data)
+    events.publish(server_data, channel_id, "message_sent",
+                   message_id, channel.get_version())
     return {
         "message_id": message_id
     }
@@ -40,8 +154,13 @@ def send_timed_message(channel_id, message_id):
     """
 
     server_data = data.load_data()
-    server_data.return_channel(channel_id).add_message(message_id)
+    time_sent = server_data.return_message(message_id).get_time_sent()
+    channel = server_data.return_channel(channel_id)
+    channel.add_message(message_id, time_sent)
+    server_data.post_message(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel_id, "message_sent",
+                   message_id, channel.get_version())
 
 def message_sendlater(token, channel_id, message_body, time_sent):
     """ Send message at the time given by the user. """
@@ -80,10 +199,13 @@ def message_remove(token, message_id):
     if (message.get_u_id() != u_id and
             server_data.return_user(u_id).get_permission_id() == data.User.USER_ID):
         raise AccessError("User does not have permission")
-    channel_id = message.get_channel_id()
-    server_data.return_channel(channel_id).remove_message(message_id)
+    channel = server_data.return_channel(message.get_channel_id())
+    channel.remove_message(message_id)
+    server_data.compact_removed_messages(channel)
     server_data.delete_message(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel.get_id(), "message_removed",
+                   message_id, channel.get_version())
 
 def message_edit(token, message_id, message_body):
     """ Edits a message of a specified id. """
@@ -100,7 +222,12 @@ def message_edit(token, message_id, message_body):
         message_remove(token, message_id)
     else:
         message.set_message_body(message_body)
+        server_data.index_message(message_id)
+        channel = server_data.return_channel(message.get_channel_id())
+        channel.record_change(message_id)
         data.save_data(server_data)
+        events.publish(server_data, channel.get_id(), "message_edited",
+                       message_id, channel.get_version())
 
 def message_react(token, message_id, react_id):
     """ Adds a reaction given a react ID to a message given a message ID. """
@@ -111,7 +238,11 @@ def message_react(token, message_id, react_id):
     if react_id != 1:
         raise ValueError("Invalid react id")
     message.add_react(u_id, react_id)
+    channel = server_data.return_channel(message.get_channel_id())
+    channel.record_change(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel.get_id(), "message_reacted",
+                   message_id, channel.get_version())
 
 def message_unreact(token, message_id, react_id):
     """ Removes a reaction given a react ID to a message given a message ID. """
@@ -122,7 +253,11 @@ def message_unreact(token, message_id, react_id):
     if react_id != 1:
         raise ValueError("Invalid react id")
     message.remove_react(react_id)
+    channel = server_data.return_channel(message.get_channel_id())
+    channel.record_change(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel.get_id(), "message_unreacted",
+                   message_id, channel.get_version())
 
 def message_pin(token, message_id):
     """ Pins message given by message ID. """
@@ -137,7 +272,11 @@ def message_pin(token, message_id):
     if message.is_pinned():
         raise ValueError("Message is already pinned")
     message.pin()
+    channel = server_data.return_channel(message.get_channel_id())
+    channel.pin_message(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel.get_id(), "message_pinned",
+                   message_id, channel.get_version())
 
 def message_unpin(token, message_id):
     """ Unpins message given by message_id. """
@@ -152,4 +291,8 @@ def message_unpin(token, message_id):
     if not message.is_pinned():
         raise ValueError("Message is already unpinned")
     message.unpin()
+    channel = server_data.return_channel(message.get_channel_id())
+    channel.unpin_message(message_id)
     data.save_data(server_data)
+    events.publish(server_data, channel.get_id(), "message_unpinned",
+                   message_id, channel.get_version())
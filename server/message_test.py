@@ -1,6 +1,7 @@
 """ Unit tests for all functions implementing the messaging feature. """
 
 import datetime
+import json
 import time
 import pytest
 
@@ -679,3 +680,41 @@ def test_message_unpin_success(): #TEST
     message.message_unpin(user_info["token"], message_id["message_id"])
     messages = channel.channel_messages(user_info["token"], new_channel["channel_id"], 0)
     assert not messages["messages"][0]["is_pinned"]
+
+def test_message_json_fragments():
+    """
+    Test that messages serialised from cached fragments match serialising
+    them directly, for each viewer, and after each kind of change
+    test_message_json_fragments()
+    """
+    #Register users
+    auth.reset_auth_data()
+    data.initialise_data()
+    message.reset_fragment_cache()
+    user_info = auth.auth_register("mrbean@gmail.com", "ilovemrbean123", "Mr", "Bean")
+    user_info_2 = auth.auth_register("mrsbean@gmail.com", "ilovemrbean123", "Mrs", "Bean")
+    new_channel = channels.channels_create(user_info["token"], "channel 1", True)
+    channel.channel_join(user_info_2["token"], new_channel["channel_id"])
+    message_ids = [message.message_send(user_info["token"], new_channel["channel_id"],
+                                        "message \"%d\" é" % index)["message_id"]
+                   for index in range(3)]
+
+    def check_pages():
+        for token in (user_info["token"], user_info_2["token"]):
+            page = channel.channel_messages(token, new_channel["channel_id"], 0)
+            page_json = channel.channel_messages_json(token, new_channel["channel_id"], 0)
+            assert page_json == json.dumps(page)
+
+    check_pages()
+    message.message_react(user_info_2["token"], message_ids[0], 1)
+    check_pages()
+    message.message_edit(user_info["token"], message_ids[1], "edited")
+    message.message_pin(user_info["token"], message_ids[2])
+    check_pages()
+    assert len(message.FRAGMENT_CACHE) == 3
+    message.message_unreact(user_info_2["token"], message_ids[0], 1)
+    message.message_remove(user_info["token"], message_ids[1])
+    check_pages()
+    assert json.loads(channel.channel_messages_json(
+        user_info["token"], new_channel["channel_id"], before_message_id=message_ids[0])) == \
+        {"messages": [], "start": 2, "end": -1, "version": 8}
@@ -1,35 +1,634 @@
 """ Contains all the functions implementing the search feature. """
 
+import atexit
+import base64
+import collections
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import json
+import multiprocessing
+import re
+import threading
+
 from server import auth
 from server import data
+from server import message
+from server import search_index
+from server.Error import ValueError
 
-def search(token, query_str):
-    """ Returns all the messages that a query string is found in. Only searches
-        the channels that the authorised user is in.
+SORT_ORDERS = ("recent", "relevance")
+FILTER_REGEX = re.compile(r"(?:^|\s)(in|from|before|after|is):(\S+)")
+
+# Ranking by relevance is split across a process pool, a partition of whole
+# channels per worker, when there are at least this many candidates left after
+# the filters and more than one worker. The pool is off by default, as it has
+# not been shown to be faster; set PARALLEL_WORKERS to the number of cores to
+# turn it on.
+PARALLEL_MIN_CANDIDATES = 20000
+PARALLEL_WORKERS = 1
+
+# The process pool is created the first time it is needed, and shut down when
+# the server exits. Workers are spawned rather than forked, as the server is
+# threaded.
+SEARCH_POOL = None
+
+# The server data loaded from data.p by a worker process, kept until a search
+# asks for a different snapshot of the search index.
+WORKER_DATA = None
+
+# Results of recent searches, most recently used last. Each entry is keyed on
+# the search and the channels searched, in the order they are searched, and
+# holds the versions of those channels when it was stored, along with the
+# version of the search index for relevance searches, which must still match
+# for it to be used.
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE = collections.OrderedDict()
+SEARCH_CACHE_LOCK = threading.Lock()
+SEARCH_CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+def encode_cursor(sort, position):
+    """ Returns an opaque cursor pointing just after a position in the results
+        of a search with the given sort order.
+
+    When sorting by recent, the position is (channel_id, time_created,
+    message_id). When sorting by relevance, it is (relevance, time_created,
+    message_id).
+    """
+
+    cursor = [sort] + list(position)
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+def decode_cursor(cursor, sort):
+    """ Returns the position encoded in a cursor, given the sort order of the
+        search it is used with.
+
+    If the cursor is malformed, or is from a search with a different sort
+    order, raises a ValueError.
+    """
+
+    try:
+        cursor_sort, first, time_created, message_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        first = int(first) if sort == "recent" else float(first)
+        position = (first, float(time_created), int(message_id))
+    except Exception:
+        raise ValueError("Invalid search cursor")
+    if cursor_sort != sort:
+        raise ValueError("Invalid search cursor")
+    return position
+
+def parse_filter(server_data, name, value):
+    """ Returns the filter that a "name:value" token of a query string
+        stands for, as a (key, value) pair, or None if the value is not
+        valid for it, in which case the token is searched for as text.
+    """
+
+    if name == "in":
+        value = value.lstrip("#")
+        if value.isdigit():
+            channel_ids = [int(value)]
+            if channel_ids[0] not in server_data.get_all_channel_id():
+                return None
+        else:
+            channel_ids = [
+                channel_id for channel_id in
+                server_data.search_channel_names(value)
+                if (server_data.return_channel(channel_id).get_name()
+                    .casefold() == value.casefold())
+            ]
+        return ("channel_ids", channel_ids) if channel_ids else None
+    if name == "from":
+        value = value.lstrip("@")
+        try:
+            u_id = (int(value) if value.isdigit() else
+                    server_data.get_u_id_from_handle(value))
+            server_data.return_user(u_id)
+        except ValueError:
+            return None
+        return "u_ids", [u_id]
+    if name in ("before", "after"):
+        try:
+            date = datetime.datetime.strptime(value, "%Y-%m-%d")
+        except Exception:
+            return None
+        if name == "before":
+            return "end_time", date.timestamp()
+        return "start_time", (date + datetime.timedelta(days=1)).timestamp()
+    if name == "is" and value == "pinned":
+        return "is_pinned", True
+    return None
+
+def parse_query(server_data, query_str):
+    """ Splits the filters out of a query string, returning the remaining query
+        string and a dictionary of filters.
+
+    The filters are "in:" a channel name or ID, "from:" a user handle or ID,
+    "before:" and "after:" a date in the form YYYY-MM-DD, and "is:pinned".
+    Giving more than one "in:" or "from:" filter matches any of them. Tokens
+    that look like filters but do not name a valid channel, user or date,
+    such as "is:broken", are left in the query string and searched for.
+    """
+
+    filters = {}
+
+    def take_filter(match):
+        search_filter = parse_filter(server_data, match.group(1),
+                                     match.group(2))
+        if search_filter is None:
+            return match.group(0)
+        key, value = search_filter
+        if key in ("channel_ids", "u_ids"):
+            filters.setdefault(key, set()).update(value)
+        else:
+            filters[key] = value
+        return ""
+
+    remaining_str = FILTER_REGEX.sub(take_filter, query_str)
+    if not filters:
+        return query_str, filters
+    return remaining_str.strip(), filters
+
+def searched_channels(user, filters):
+    """ Returns the IDs of the channels that a user is in, which are not
+        excluded by the "in:" filters of a search.
+    """
+
+    return [channel_id for channel_id in user.get_channels()
+            if channel_id in filters.get("channel_ids", [channel_id])]
+
+def get_cached_results(key, versions):
+    """ Returns the cached results of a search, or None if they are not cached
+        or any of the channels searched have been written to since.
+    """
+
+    with SEARCH_CACHE_LOCK:
+        entry = SEARCH_CACHE.get(key)
+        if entry is not None and entry[0] != versions:
+            del SEARCH_CACHE[key]
+            SEARCH_CACHE_STATS["invalidations"] += 1
+            entry = None
+        if entry is None:
+            SEARCH_CACHE_STATS["misses"] += 1
+            return None
+        SEARCH_CACHE.move_to_end(key)
+        SEARCH_CACHE_STATS["hits"] += 1
+        return entry[1]
+
+def cache_results(key, versions, results):
+    """ Caches the results of a search, evicting the least recently used
+        results if the cache is full.
+    """
+
+    with SEARCH_CACHE_LOCK:
+        SEARCH_CACHE[key] = (versions, results)
+        SEARCH_CACHE.move_to_end(key)
+        while len(SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            SEARCH_CACHE.popitem(last=False)
+
+def reset_search_cache():
+    """ Empties the search cache and resets its statistics. """
+
+    with SEARCH_CACHE_LOCK:
+        SEARCH_CACHE.clear()
+        for stat in SEARCH_CACHE_STATS:
+            SEARCH_CACHE_STATS[stat] = 0
+
+def search_cache_stats(token):
+    """ Returns the number of searches that were and were not answered from
+        the cache, along with its hit rate and size.
+    """
+
+    auth.verify_token(token)
+    with SEARCH_CACHE_LOCK:
+        stats = dict(SEARCH_CACHE_STATS)
+        stats["size"] = len(SEARCH_CACHE)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0
+    stats["capacity"] = SEARCH_CACHE_SIZE
+    return stats
+
+def find_candidates(server_data, channel_ids, query_str, filters):
+    """ Returns the candidate messages for a query string in the given
+        channels, grouped by channel ID and ordered newest first, or None if
+        every message in the channels needs to be checked.
+
+    Filters from parse_query() are pushed down into the indexes before any
+    message is looked at. The candidates are the intersection of the author
+    index, the channels' pinned messages and the search index, skipping the
+    search index when a filter has already narrowed the candidates down
+    further than it could. Only candidates that are posted and pass the date
+    filters are kept.
+    """
+
+    start_time = filters.get("start_time")
+    end_time = filters.get("end_time")
+
+    candidate_sets = []
+    if "u_ids" in filters:
+        candidate_sets.append({
+            msg_id for u_id in filters["u_ids"]
+            for msg_id in server_data.get_user_message_ids(u_id)
+        })
+    if filters.get("is_pinned"):
+        candidate_sets.append(set().union(*(
+            server_data.return_channel(channel_id).get_pinned_messages()
+            for channel_id in channel_ids
+        )))
+    if (not candidate_sets or min(map(len, candidate_sets)) >
+            server_data.estimate_search_candidates(query_str)):
+        text_candidates = server_data.get_search_candidates(query_str)
+        if text_candidates is not None:
+            candidate_sets.append(text_candidates)
+    if not candidate_sets:
+        return None
+    candidate_sets.sort(key=len)
+    candidates = candidate_sets[0].intersection(*candidate_sets[1:])
+
+    channel_candidates = {}
+    for msg in map(server_data.return_message, candidates):
+        channel = server_data.return_channel(msg.get_channel_id())
+        time_created = msg.get_time_sent().timestamp()
+        if ((start_time is None or time_created >= start_time) and
+                (end_time is None or time_created < end_time) and
+                channel.has_message(msg.get_id(), msg.get_time_sent())):
+            channel_candidates.setdefault(msg.get_channel_id(),
+                                          []).append(msg)
+    for msgs in channel_candidates.values():
+        msgs.sort(key=lambda msg: (msg.get_time_sent(), msg.get_id()),
+                  reverse=True)
+    return channel_candidates
+
+def match_messages(server_data, channel_ids, channel_candidates, query_str,
+                   after=None, filters=None):
+    """ Yields the IDs of the messages that a query string is found in, among
+        the candidates from find_candidates(), channel by channel, newest
+        first. Without candidates, the channels' time indexes are used to only
+        look at messages within the date filters. If a position decoded from
+        a cursor is given, the search resumes after it.
+    """
+
+    filters = filters or {}
+    if after is not None:
+        if after[0] not in channel_ids:
+            raise ValueError("Invalid search cursor")
+        channel_ids = channel_ids[channel_ids.index(after[0]):]
+    for channel_id in channel_ids:
+        if channel_candidates is None:
+            channel = server_data.return_channel(channel_id)
+            msgs = map(server_data.return_message,
+                       reversed(channel.get_messages_between(
+                           filters.get("start_time"), filters.get("end_time"))))
+        else:
+            msgs = channel_candidates.get(channel_id, [])
+        if after is not None and channel_id == after[0]:
+            msgs = itertools.dropwhile(
+                lambda msg: ((msg.get_time_sent().timestamp(), msg.get_id()) >=
+                             tuple(after[1:])), msgs)
+        for msg in msgs:
+            if query_str in msg.get_folded_body():
+                yield msg.get_id()
+
+def find_messages(server_data, user, query_str, after=None, filters=None):
+    """ Yields the IDs of the messages that a query string is found in, among
+        the channels that a user is in. Messages are yielded channel by
+        channel, newest first, and are only checked as they are consumed.
+
+    The query string must already be folded by search_index.fold(), as it is
+    matched against the folded bodies of messages.
+    """
+
+    filters = filters or {}
+    channel_ids = searched_channels(user, filters)
+    channel_candidates = find_candidates(server_data, channel_ids, query_str,
+                                         filters)
+    yield from match_messages(server_data, channel_ids, channel_candidates,
+                              query_str, after, filters)
+
+def best_keys(keys, limit):
+    """ Returns the best limit of an iterable of ranking keys, best first, or
+        all of them if there is no limit.
+    """
+
+    if limit is None:
+        return sorted(keys, reverse=True)
+    return heapq.nlargest(limit, keys)
+
+def rank_messages(server_data, user, query_str, limit=None, after=None,
+                  filters=None):
+    """ Returns the (relevance, time_created, message_id) keys of the most
+        relevant messages that a query string is found in, among the channels
+        that a user is in, from most to least relevant.
+
+    Every match is scored, but only the best limit of them are kept using a
+    heap. If a position decoded from a cursor is given, only matches ranked
+    after it are considered. When enough candidates are left after the
+    filters, they are scored in parallel by rank_in_parallel().
+    """
+
+    filters = filters or {}
+    channel_ids = searched_channels(user, filters)
+    channel_candidates = find_candidates(server_data, channel_ids, query_str,
+                                         filters)
+    if channel_candidates is not None:
+        channel_candidates = {
+            channel_id: channel_candidates[channel_id]
+            for channel_id in channel_ids if channel_id in channel_candidates
+        }
+        if should_parallelise(sum(map(len, channel_candidates.values()))):
+            return rank_in_parallel(server_data, channel_candidates,
+                                    query_str, limit, after)
+
+    score = server_data.get_search_scorer(query_str)
+    keys = ((score(msg_id),
+             server_data.return_message(msg_id).get_time_sent().timestamp(),
+             msg_id)
+            for msg_id in match_messages(server_data, channel_ids,
+                                         channel_candidates, query_str,
+                                         filters=filters))
+    if after is not None:
+        keys = (key for key in keys if key < after)
+    return best_keys(keys, limit)
+
+def get_search_pool():
+    """ Returns the process pool used to rank candidates in parallel, creating
+        it if needed.
+    """
+
+    global SEARCH_POOL
+    if SEARCH_POOL is None:
+        SEARCH_POOL = concurrent.futures.ProcessPoolExecutor(
+            PARALLEL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(shutdown_search_pool)
+    return SEARCH_POOL
+
+def shutdown_search_pool():
+    """ Shuts down the process pool, if it has been created. """
+
+    global SEARCH_POOL
+    if SEARCH_POOL is not None:
+        SEARCH_POOL.shutdown()
+        SEARCH_POOL = None
+
+def search_snapshot(server_data):
+    """ Returns what identifies the messages and search index in the server
+        data: its instance ID and the version of its search index, which is
+        bumped whenever a message is indexed or removed from the index.
+    """
+
+    return server_data.get_instance_id(), server_data.get_search_version()
+
+def load_worker_data(snapshot):
+    """ Returns the server data with the given snapshot, in a worker process,
+        loading data.p again if the data already loaded has another snapshot.
+        Returns None if data.p has been saved with another snapshot since.
+    """
+
+    global WORKER_DATA
+    if WORKER_DATA is None or search_snapshot(WORKER_DATA) != snapshot:
+        WORKER_DATA = data.load_data()
+    if search_snapshot(WORKER_DATA) != snapshot:
+        return None
+    return WORKER_DATA
+
+def rank_candidates(server_data, partition, query_str, limit, after):
+    """ Returns the keys of the best limit matches among a partition of the
+        candidates of a search, which maps channel IDs to the IDs of their
+        candidate messages.
+    """
+
+    score = server_data.get_search_scorer(query_str)
+    keys = []
+    for msg_id in itertools.chain.from_iterable(partition.values()):
+        msg = server_data.return_message(msg_id)
+        if query_str not in msg.get_folded_body():
+            continue
+        key = (score(msg_id), msg.get_time_sent().timestamp(), msg_id)
+        if after is None or key < after:
+            keys.append(key)
+    return best_keys(keys, limit)
+
+def rank_partition(snapshot, partition, query_str, limit, after):
+    """ Returns the keys of the best limit matches among a partition of the
+        candidates of a search, in a worker process, or None if the worker
+        cannot load the snapshot of the server data they were found in.
+
+    Only message IDs are sent to workers. Each worker loads data.p itself,
+    and keeps it for later searches until the search index changes.
+    """
+
+    server_data = load_worker_data(snapshot)
+    if server_data is None:
+        return None
+    return rank_candidates(server_data, partition, query_str, limit, after)
+
+def should_parallelise(n_candidates):
+    """ Returns whether a search with a given number of candidates left after
+        its filters is broad enough to be worth ranking on the process pool.
+    """
+
+    return PARALLEL_WORKERS > 1 and n_candidates >= PARALLEL_MIN_CANDIDATES
+
+def partition_channels(channel_candidates, n_partitions):
+    """ Splits the IDs of the candidates of a search, grouped by channel ID,
+        into at most n_partitions partitions of whole channels, with about as
+        many candidates in each.
+    """
+
+    # (number of candidates, position, partition), smallest first
+    partitions = [(0, position, {}) for position in range(n_partitions)]
+    for channel_id, msg_ids in sorted(channel_candidates.items(),
+                                      key=lambda item: len(item[1]),
+                                      reverse=True):
+        size, position, partition = heapq.heappop(partitions)
+        partition[channel_id] = msg_ids
+        heapq.heappush(partitions, (size + len(msg_ids), position, partition))
+    return [partition for _, _, partition in sorted(partitions) if partition]
+
+def rank_in_parallel(server_data, channel_candidates, query_str, limit,
+                     after):
+    """ Splits the candidates of a search, grouped by channel, into one
+        partition of whole channels per worker process, and ranks them in
+        parallel.
+
+    Workers rank the same snapshot of data.p as this process, and each
+    returns at most its own top limit keys, of which the best limit are
+    kept. A partition whose worker no longer finds that snapshot in data.p is
+    ranked here instead.
+    """
+
+    snapshot = search_snapshot(server_data)
+    partitions = partition_channels(
+        {channel_id: [msg.get_id() for msg in msgs]
+         for channel_id, msgs in channel_candidates.items()},
+        PARALLEL_WORKERS)
+    pool = get_search_pool()
+    futures = [
+        pool.submit(rank_partition, snapshot, partition, query_str, limit,
+                    after)
+        for partition in partitions
+    ]
+    keys = []
+    for partition, future in zip(partitions, futures):
+        partition_keys = future.result()
+        if partition_keys is None:
+            partition_keys = rank_candidates(server_data, partition,
+                                             query_str, limit, after)
+        keys.extend(partition_keys)
+    return best_keys(keys, limit)
+
+def make_snippet(msg, query_str, length):
+    """ Returns a snippet of at most length characters of the body of a
+        message, centred on the first match of a folded query string, along
+        with the [start, end) positions of the matches within the snippet.
+
+    The snippet is marked with "..." where the body has been cut off. Matches
+    are found in the folded body, and mapped back to the original body.
+    """
+
+    body = msg.get_message_body()
+    folded_body = msg.get_folded_body()
+    matches = []
+    if query_str:
+        position = folded_body.find(query_str)
+        while position != -1:
+            matches.append(msg.get_original_span(position,
+                                                 position + len(query_str)))
+            position = folded_body.find(query_str, position + len(query_str))
+    match_start, match_end = matches[0] if matches else (0, 0)
+    start = max(0, min(match_start - (length - (match_end - match_start)) // 2,
+                       len(body) - length))
+    end = min(len(body), start + length)
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(body) else ""
+    highlights = [
+        [match_start - start + len(prefix),
+         min(match_end, end) - start + len(prefix)]
+        for match_start, match_end in matches
+        if start <= match_start < end
+    ]
+    return prefix + body[start:end] + suffix, highlights
+
+def run_search(server_data, user, query_str, filters, sort, limit, after):
+    """ Returns the IDs of the first limit matches of a search when sorting by
+        recent, or the keys of the best limit matches when sorting by
+        relevance.
+    """
+
+    if sort == "recent":
+        return list(itertools.islice(
+            find_messages(server_data, user, query_str, after, filters), limit))
+    return rank_messages(server_data, user, query_str, limit, after, filters)
+
+def find_search_page(token, query_str, limit, cursor, sort, snippet_length):
+    """ Returns the server data, the authorised user's u_id, the folded query
+        string, and the views and next cursor of the page of messages asked
+        for by search().
     """
 
     user_id = auth.verify_token(token)
     server_data = data.load_data()
-    message_info = {
-        "messages": [],
+    if sort not in SORT_ORDERS:
+        raise ValueError("Invalid sort order")
+    if limit is not None and limit < 1:
+        raise ValueError("Invalid limit")
+    if snippet_length is not None and snippet_length < 1:
+        raise ValueError("Invalid snippet length")
+    user = server_data.return_user(user_id)
+    query_str, filters = parse_query(server_data, query_str)
+    query_str = search_index.fold(query_str)
+    after = None if cursor is None else decode_cursor(cursor, sort)
+    page_size = None if limit is None else limit + 1
+
+    channel_ids = searched_channels(user, filters)
+    cache_key = (
+        server_data.get_instance_id(), query_str, sort, page_size, after,
+        tuple(channel_ids), frozenset(filters.get("u_ids", ())),
+        filters.get("start_time"), filters.get("end_time"),
+        filters.get("is_pinned", False),
+    )
+    versions = tuple(sorted(
+        (channel_id, server_data.return_channel(channel_id).get_version())
+        for channel_id in channel_ids
+    ))
+    if sort == "relevance":
+        # Relevance also depends on how common the words are across every
+        # channel.
+        versions += (("index", server_data.get_search_version()),)
+    results = get_cached_results(cache_key, versions)
+    if results is None:
+        results = run_search(server_data, user, query_str, filters, sort,
+                             page_size, after)
+        cache_results(cache_key, versions, results)
+
+    matching_ids = (results if sort == "recent" else
+                    [msg_id for _, _, msg_id in results])
+    views = server_data.return_messages(matching_ids[:limit])
+    if len(matching_ids) <= len(views):
+        next_cursor = None
+    elif sort == "recent":
+        next_cursor = encode_cursor(sort, (views[-1].channel_id,
+                                           views[-1].time_created,
+                                           views[-1].message_id))
+    else:
+        next_cursor = encode_cursor(sort, results[len(views) - 1])
+    return server_data, user_id, query_str, views, next_cursor
+
+def search(token, query_str, limit=None, cursor=None, sort="recent",
+           snippet_length=None):
+    """ Returns the messages that a query string is found in. Only searches
+        the channels that the authorised user is in.
+
+    The query string can contain filters, as described in parse_query().
+    Matching ignores case and accents. Messages are sorted either by recent,
+    which lists them channel by channel and newest first, or by relevance.
+
+    If a limit is given, at most that many messages are returned, along with
+    a cursor that the next page of messages can be requested with. The cursor
+    is None once there are no more messages.
+
+    If a snippet length is given, each message's body is replaced by a
+    snippet of at most that many characters around the first match, and the
+    positions of the matches in the snippet are given as highlights.
+
+    Results are cached for the set of channels searched, and reused until a
+    message in one of them changes, or, when sorting by relevance, until any
+    message is indexed or removed.
+    """
+
+    server_data, user_id, query_str, views, next_cursor = find_search_page(
+        token, query_str, limit, cursor, sort, snippet_length)
+    if snippet_length is None:
+        return message.message_page_info(views, user_id, {
+            "next_cursor": next_cursor,
+        })
+    messages = [message.message_info(view, user_id) for view in views]
+    for message_info in messages:
+        message_info["message"], message_info["highlights"] = make_snippet(
+            server_data.return_message(message_info["message_id"]),
+            query_str, snippet_length)
+    return {
+        "messages": messages,
+        "next_cursor": next_cursor,
     }
 
-    user = server_data.return_user(user_id)
-    for channel_id in user.get_channels():
-        for msg_id in server_data.return_channel(channel_id):
-            msg = server_data.return_message(msg_id)
-            if query_str in msg.get_message_body():
-                message_info["messages"].append({
-                    "message_id": msg_id,
-                    "u_id": msg.get_u_id(),
-                    "message": msg.get_message_body(),
-                    "time_created": msg.get_time_sent().timestamp(),
-                    "reacts": [{
-                        "react_id": react_id,
-                        "u_ids": u_ids,
-                        "is_this_user_reacted": user_id in u_ids,
-                    } for react_id, u_ids in msg.get_reacts().items()],
-                    "is_pinned": msg.is_pinned(),
-                })
-
-    return message_info
+def search_json(token, query_str, limit=None, cursor=None, sort="recent",
+                snippet_length=None):
+    """ Returns the same results as search(), already serialised in JSON.
+        Without snippets, they are joined together from the cached JSON of
+        each message.
+    """
+
+    if snippet_length is not None:
+        return json.dumps(search(token, query_str, limit, cursor, sort,
+                                 snippet_length))
+    server_data, user_id, _, views, next_cursor = find_search_page(
+        token, query_str, limit, cursor, sort, snippet_length)
+    return message.message_page_json(server_data, views, user_id, {
+        "next_cursor": next_cursor,
+    })
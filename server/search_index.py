@@ -0,0 +1,644 @@
+""" Contains the index used to search the bodies of messages.
+
+The index is owned by the ServerData instance, and is kept up to date as
+messages are posted to channels, edited, and removed. It is used to narrow a
+search down to the messages that could contain the query string, so that a
+search does not need to look at every message on the server.
+
+The index is split into segments. New messages are indexed in a small mutable
+segment, which is saved with the rest of the server data. Once it is full, it
+is sealed: written to its own file next to data.p, and never modified again.
+Sealed segments are loaded at most once per process, and are merged together
+in the background as they accumulate, so that the server data stays small and
+a search only needs to look in a few segments. Segments that are no longer
+needed are only deleted once the server data has been saved without them, and
+requests still using older server data have had time to finish.
+
+Message bodies are indexed, and query strings looked up, after being folded
+by fold().
+"""
+
+import binascii
+import collections
+import math
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+import unicodedata
+
+# Parameters of the BM25 relevance function.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# The number of messages in the mutable segment before it is sealed, and the
+# number of sealed segments of a similar size that are merged together.
+SEGMENT_SIZE = 1000
+MERGE_FACTOR = 4
+
+# The number of seconds that a segment file is kept after no saved index
+# refers to it, as requests that loaded older server data may still read it.
+SEGMENT_GRACE_PERIOD = 60
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+# Sealed segments that have been loaded or written by this process, by path.
+LOADED_SEGMENTS = {}
+
+# The threads merging segments in this process, by the path of their output.
+MERGE_THREADS = {}
+MERGE_LOCK = threading.Lock()
+
+def fold(text):
+    """ Returns a string case-folded, with compatibility characters decomposed
+        and accents removed, so that searches ignore case and accents.
+    """
+
+    return "".join(char for char in
+                   unicodedata.normalize("NFKD", text.casefold())
+                   if not unicodedata.combining(char))
+
+def fold_with_offsets(text):
+    """ Returns a string folded by fold(), along with a list mapping each
+        position in the folded string to the position in the original string
+        that it came from, plus the length of the original string at the end.
+
+    As ASCII strings are folded into strings of the same length, their list
+    is None, and positions are the same in both.
+    """
+
+    if text.isascii():
+        return text.lower(), None
+    folded_chars = []
+    offsets = []
+    for position, char in enumerate(text):
+        folded_char = fold(char)
+        folded_chars.append(folded_char)
+        offsets.extend([position] * len(folded_char))
+    offsets.append(len(text))
+    return "".join(folded_chars), offsets
+
+def trigrams(text):
+    """ Returns the set of all the substrings of length 3 in a string. """
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def bm25(counts, length, term_idfs, average_length):
+    """ Returns the BM25 relevance of a message, given how many times it
+        contains each word in a list of (word, idf) pairs and its length in
+        words, to a query with those words.
+    """
+
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+    relevance = 0
+    for count, (_, idf) in zip(counts, term_idfs):
+        relevance += idf * count * (BM25_K1 + 1) / (count + length_norm)
+    return relevance
+
+def load_segment(path):
+    """ Returns the sealed segment saved at a path, only reading it from disk
+        the first time it is needed.
+    """
+
+    segment = LOADED_SEGMENTS.get(path)
+    if segment is None:
+        with open(path, "rb") as file:
+            segment = pickle.load(file)
+        LOADED_SEGMENTS[path] = segment
+    return segment
+
+def write_segment(path, segment):
+    """ Saves a sealed segment to a path. The file only appears once it has
+        been completely written.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(segment, file)
+    os.replace(path + ".tmp", path)
+    LOADED_SEGMENTS[path] = segment
+
+def merge_segments(inputs, output_path, deleted):
+    """ Merges sealed segments into a new one, leaving out the messages that
+        have been deleted from them.
+
+    The inputs are (path, sequence number) pairs, and deleted maps the IDs of
+    deleted messages to the sequence number of the newest segment they were
+    deleted from.
+    """
+
+    merged = Segment()
+    for path, seq in inputs:
+        merged.merge(load_segment(path), lambda message_id, seq=seq:
+                     deleted.get(message_id, 0) < seq)
+    write_segment(output_path, merged)
+
+def run_merge(output_path, inputs, deleted):
+    """ Merges sealed segments, then marks the merge as no longer running. """
+
+    try:
+        merge_segments(inputs, output_path, deleted)
+    finally:
+        with MERGE_LOCK:
+            del MERGE_THREADS[output_path]
+
+def wait_for_merges():
+    """ Blocks until every merge running in this process has finished. """
+
+    with MERGE_LOCK:
+        threads = list(MERGE_THREADS.values())
+    for thread in threads:
+        thread.join()
+
+def clear_segments(directory):
+    """ Deletes all the sealed segments in a directory, and forgets any that
+        have been loaded from it.
+    """
+
+    wait_for_merges()
+    shutil.rmtree(directory, ignore_errors=True)
+    for path in list(LOADED_SEGMENTS):
+        if os.path.dirname(path) == directory:
+            del LOADED_SEGMENTS[path]
+
+class Segment():
+    """ Class for an inverted index from the tokens (runs of word characters)
+        and trigrams in message bodies to the IDs of the messages that contain
+        them.
+
+    Query strings of at least three characters are looked up by trigram, and
+    shorter ones by token. The number of times each token occurs in each
+    message is also kept, to rank messages by relevance using BM25.
+    """
+
+    def __init__(self):
+        """ Creates an empty segment. """
+
+        self.__postings = {
+            # token: {message_id: number of occurrences, ...}
+        }
+        self.__tokens = {
+            # message_id: {token, ...}
+        }
+        self.__lengths = {
+            # message_id: number of tokens
+        }
+        self.__total_length = 0
+        self.__trigram_postings = {
+            # trigram: {message_id, ...}
+        }
+        self.__trigrams = {
+            # message_id: {trigram, ...}
+        }
+
+    def __len__(self):
+        """ Returns the number of messages in the segment. """
+
+        return len(self.__lengths)
+
+    def add(self, message_id, body):
+        """ Indexes the body of a message. If the message is already indexed,
+            its old body is replaced.
+        """
+
+        self.remove(message_id)
+        token_list = TOKEN_REGEX.findall(body)
+        token_counts = collections.Counter(token_list)
+        for token, count in token_counts.items():
+            self.__postings.setdefault(token, {})[message_id] = count
+        self.__tokens[message_id] = set(token_counts)
+        self.__lengths[message_id] = len(token_list)
+        self.__total_length += len(token_list)
+        body_trigrams = trigrams(body)
+        for trigram in body_trigrams:
+            self.__trigram_postings.setdefault(trigram, set()).add(message_id)
+        self.__trigrams[message_id] = body_trigrams
+
+    def remove(self, message_id):
+        """ Removes a message from the segment, if it is in it. """
+
+        for token in self.__tokens.pop(message_id, ()):
+            postings = self.__postings[token]
+            del postings[message_id]
+            if not postings:
+                del self.__postings[token]
+        self.__total_length -= self.__lengths.pop(message_id, 0)
+        for trigram in self.__trigrams.pop(message_id, ()):
+            postings = self.__trigram_postings[trigram]
+            postings.discard(message_id)
+            if not postings:
+                del self.__trigram_postings[trigram]
+
+    def merge(self, segment, is_live):
+        """ Adds the messages in another segment to this one, skipping those
+            for which is_live() returns False. A message already in this
+            segment is replaced.
+        """
+
+        for message_id, length in segment.__lengths.items():
+            if not is_live(message_id):
+                continue
+            self.remove(message_id)
+            self.__lengths[message_id] = length
+            self.__total_length += length
+            self.__tokens[message_id] = segment.__tokens[message_id]
+            for token in segment.__tokens[message_id]:
+                self.__postings.setdefault(token, {})[message_id] = \
+                    segment.__postings[token][message_id]
+            self.__trigrams[message_id] = segment.__trigrams[message_id]
+            for trigram in segment.__trigrams[message_id]:
+                self.__trigram_postings.setdefault(trigram,
+                                                   set()).add(message_id)
+
+    def contains(self, message_id):
+        """ Returns whether a message is in the segment. """
+
+        return message_id in self.__lengths
+
+    def get_length(self, message_id):
+        """ Returns the number of tokens in a message in the segment. """
+
+        return self.__lengths[message_id]
+
+    def get_total_length(self):
+        """ Returns the total number of tokens in the segment. """
+
+        return self.__total_length
+
+    def get_postings(self, token):
+        """ Returns the number of times a token occurs in each message in the
+            segment that contains it.
+        """
+
+        return self.__postings.get(token, {})
+
+    def __matching_tokens(self, run, starts_token, ends_token):
+        """ Returns the indexed tokens that a run of word characters from a
+            query string could fall within.
+
+        If the run is bounded by non-word characters in the query string, the
+        token it falls within must start and/or end with it.
+        """
+
+        if starts_token and ends_token:
+            return [run] if run in self.__postings else []
+        if starts_token:
+            return [token for token in self.__postings if token.startswith(run)]
+        if ends_token:
+            return [token for token in self.__postings if token.endswith(run)]
+        return [token for token in self.__postings if run in token]
+
+    def estimate(self, query_str):
+        """ Returns an upper bound on the number of candidates that the segment
+            would return for a query string, without finding them.
+        """
+
+        if len(query_str) >= 3:
+            return min(len(self.__trigram_postings.get(trigram, ()))
+                       for trigram in trigrams(query_str))
+        return len(self.__lengths)
+
+    def candidates(self, query_str):
+        """ Returns the set of IDs of the messages in the segment that could
+            contain the query string. Every message containing the query
+            string is in the set, but each one must still be checked.
+
+        If the query string is shorter than three characters and has no word
+        characters, the segment cannot narrow the search, and None is returned.
+        """
+
+        if len(query_str) >= 3:
+            # Intersects the postings of the rarest trigrams first.
+            postings = sorted((self.__trigram_postings.get(trigram, set())
+                               for trigram in trigrams(query_str)), key=len)
+            return postings[0].intersection(*postings[1:])
+
+        runs = list(TOKEN_REGEX.finditer(query_str))
+        if not runs:
+            return None
+
+        # Looks up runs that must match a whole token first, as they are the
+        # cheapest to find and usually the most selective.
+        runs.sort(key=lambda run: (run.start() == 0 or
+                                   run.end() == len(query_str)))
+        candidates = None
+        for run in runs:
+            message_ids = set()
+            for token in self.__matching_tokens(run.group(),
+                                                run.start() > 0,
+                                                run.end() < len(query_str)):
+                message_ids.update(self.__postings[token])
+            candidates = (message_ids if candidates is None
+                          else candidates & message_ids)
+            if not candidates:
+                break
+        return candidates
+
+class SearchIndex():
+    """ Class for the segmented index of the bodies of all posted messages.
+
+    Sealed segments are listed oldest first in a manifest, each with a
+    sequence number. When a message is removed from a sealed segment, it is
+    given a tombstone holding the newest sequence number at that time, which
+    hides it in every segment up to that sequence number, but not in any that
+    it is indexed in afterwards.
+    """
+
+    def __init__(self, directory):
+        """ Creates an empty search index, which stores its sealed segments in
+            a directory.
+        """
+
+        self.__directory = directory
+        # Distinguishes the files of this index from those of earlier ones.
+        self.__prefix = binascii.hexlify(os.urandom(8)).decode("ascii")
+        self.__segment_counter = 0
+        self.__seq = 0
+        self.__mutable_segment = Segment()
+        self.__manifest = [
+            # (segment name, sequence number), ...
+        ]
+        self.__tombstones = {
+            # message_id: sequence number
+        }
+        self.__merges = [
+            # (output segment name, [(segment name, sequence number), ...]), ...
+        ]
+        self.__version = 0
+        self.__retired = {
+            # segment name: time it was merged away
+        }
+
+    def __path(self, name):
+        """ Returns the path of the file of a sealed segment. """
+
+        return os.path.join(self.__directory, name + ".seg")
+
+    def __segments(self):
+        """ Returns (sequence number, segment) pairs for all the segments, the
+            mutable segment last.
+        """
+
+        segments = [(seq, load_segment(self.__path(name)))
+                    for name, seq in self.__manifest]
+        segments.append((math.inf, self.__mutable_segment))
+        return segments
+
+    def __is_live(self, message_id, seq):
+        """ Returns whether a message is visible in the segment with a given
+            sequence number.
+        """
+
+        return self.__tombstones.get(message_id, 0) < seq
+
+    def __new_segment_name(self):
+        """ Returns a name that no other segment of this index has. """
+
+        self.__segment_counter += 1
+        return f"{self.__prefix}-{self.__segment_counter}"
+
+    def __seal(self):
+        """ Writes the mutable segment to disk as a sealed segment, and starts
+            a new one.
+        """
+
+        self.__seq += 1
+        name = self.__new_segment_name()
+        write_segment(self.__path(name), self.__mutable_segment)
+        self.__manifest.append((name, self.__seq))
+        self.__mutable_segment = Segment()
+        self.__schedule_merges()
+
+    def __schedule_merges(self):
+        """ Starts merging the oldest sealed segments of any size tier which
+            has at least MERGE_FACTOR segments.
+
+        A segment is in tier n if it holds at least SEGMENT_SIZE *
+        MERGE_FACTOR ** n messages, but fewer than MERGE_FACTOR times that.
+        """
+
+        merging = {name for _, inputs in self.__merges for name, _ in inputs}
+        tiers = {}
+        for name, seq in self.__manifest:
+            if name in merging:
+                continue
+            size = len(load_segment(self.__path(name)))
+            tier = 0
+            while size >= SEGMENT_SIZE * MERGE_FACTOR:
+                size //= MERGE_FACTOR
+                tier += 1
+            tiers.setdefault(tier, []).append((name, seq))
+        for inputs in tiers.values():
+            if len(inputs) >= MERGE_FACTOR:
+                merge = (self.__new_segment_name(), inputs[:MERGE_FACTOR])
+                self.__merges.append(merge)
+                self.__start_merge(*merge)
+
+    def __start_merge(self, output, inputs):
+        """ Merges segments on a background thread, unless they are already
+            being merged by this process, or have been merged.
+        """
+
+        output_path = self.__path(output)
+        with MERGE_LOCK:
+            # A merge writes its output before it stops running, so it has
+            # not finished if neither is true.
+            if output_path in MERGE_THREADS or os.path.exists(output_path):
+                return
+            thread = threading.Thread(
+                target=run_merge,
+                args=(output_path,
+                      [(self.__path(name), seq) for name, seq in inputs],
+                      dict(self.__tombstones)),
+                daemon=True)
+            MERGE_THREADS[output_path] = thread
+        thread.start()
+
+    def __adopt_merges(self):
+        """ Replaces segments in the manifest with the segments they have been
+            merged into, once the merges have finished.
+
+        Merges that are not running in this process, and have not finished,
+        were interrupted, and are started again. A merge that kept a message
+        which was edited or removed while it ran, and so is hidden in its
+        output, is started again with a new output instead of being adopted.
+        """
+
+        adopted = False
+        for merge in list(self.__merges):
+            output, inputs = merge
+            if not os.path.exists(self.__path(output)):
+                self.__start_merge(output, inputs)
+                continue
+            self.__merges.remove(merge)
+            output_seq = max(seq for _, seq in inputs)
+            output_segment = load_segment(self.__path(output))
+            if any(deleted_seq >= output_seq and
+                   output_segment.contains(message_id)
+                   for message_id, deleted_seq in self.__tombstones.items()):
+                LOADED_SEGMENTS.pop(self.__path(output), None)
+                merge = (self.__new_segment_name(), inputs)
+                self.__merges.append(merge)
+                self.__start_merge(*merge)
+                continue
+            position = self.__manifest.index(inputs[0])
+            for name_seq in inputs:
+                self.__manifest.remove(name_seq)
+                LOADED_SEGMENTS.pop(self.__path(name_seq[0]), None)
+                self.__retired[name_seq[0]] = time.time()
+            self.__manifest.insert(position, (output, output_seq))
+            adopted = True
+        if adopted:
+            # Tombstones are only kept while a segment they hide a message in
+            # remains.
+            segments = self.__segments()[:-1]
+            self.__tombstones = {
+                message_id: deleted_seq
+                for message_id, deleted_seq in self.__tombstones.items()
+                if any(seq <= deleted_seq and segment.contains(message_id)
+                       for seq, segment in segments)
+            }
+            self.__schedule_merges()
+
+    def collect_garbage(self):
+        """ Deletes the files of segments that the index no longer refers to.
+            Called once the index has been saved, so that the saved server
+            data never refers to a deleted segment.
+
+        Segments that have been merged away, and files that no index refers
+        to, such as segments sealed by a request whose save was lost, are
+        kept until they have been unused for SEGMENT_GRACE_PERIOD seconds.
+        """
+
+        now = time.time()
+        self.__retired = {
+            name: retired for name, retired in self.__retired.items()
+            if now - retired < SEGMENT_GRACE_PERIOD
+        }
+        used = {name for name, _ in self.__manifest} | set(self.__retired)
+        for output, inputs in self.__merges:
+            used.add(output)
+            used.update(name for name, _ in inputs)
+        try:
+            filenames = os.listdir(self.__directory)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            # Segment names have no dots, and partly written segments end in
+            # ".seg.tmp".
+            name = filename.split(".")[0]
+            path = os.path.join(self.__directory, filename)
+            if name in used or not (filename.endswith(".seg") or
+                                    filename.endswith(".seg.tmp")):
+                continue
+            try:
+                if now - os.path.getmtime(path) >= SEGMENT_GRACE_PERIOD:
+                    os.remove(path)
+                    LOADED_SEGMENTS.pop(path, None)
+            except FileNotFoundError:
+                pass
+
+    def add(self, message_id, body):
+        """ Indexes the body of a message. If the message is already indexed,
+            its old body is replaced.
+        """
+
+        self.remove(message_id)
+        self.__mutable_segment.add(message_id, body)
+        if len(self.__mutable_segment) >= SEGMENT_SIZE:
+            self.__seal()
+
+    def remove(self, message_id):
+        """ Removes a message from the index, if it is indexed. """
+
+        # Every change to the index, including adding a message or adopting
+        # merges, goes through here.
+        self.__version += 1
+        self.__adopt_merges()
+        self.__mutable_segment.remove(message_id)
+        if any(segment.contains(message_id) and
+               self.__is_live(message_id, seq)
+               for seq, segment in self.__segments()[:-1]):
+            self.__tombstones[message_id] = self.__seq
+
+    def get_version(self):
+        """ Returns a number that changes whenever the statistics used to
+            score messages may have changed.
+        """
+
+        return self.__version
+
+    def estimate(self, query_str):
+        """ Returns an upper bound on the number of candidates that the index
+            would return for a query string, without finding them.
+        """
+
+        return sum(segment.estimate(query_str)
+                   for _, segment in self.__segments())
+
+    def candidates(self, query_str):
+        """ Returns the set of IDs of the indexed messages that could contain
+            the query string. Every message containing the query string is in
+            the set, but each one must still be checked.
+
+        If the query string is shorter than three characters and has no word
+        characters, the index cannot narrow the search, and None is returned.
+        """
+
+        candidates = set()
+        for seq, segment in self.__segments():
+            message_ids = segment.candidates(query_str)
+            if message_ids is None:
+                return None
+            candidates.update(message_id for message_id in message_ids
+                              if self.__is_live(message_id, seq))
+        return candidates
+
+    def statistics(self, query_str):
+        """ Returns the statistics used to weigh the whole words in a query
+            string: a list of (word, idf) pairs for the indexed words, and the
+            average length of an indexed message in words.
+
+        Deleted messages still in sealed segments count towards the statistics
+        until they are merged away.
+        """
+
+        segments = self.__segments()
+        n_messages = sum(len(segment) for _, segment in segments)
+        total_length = sum(segment.get_total_length() for _, segment in segments)
+        average_length = total_length / n_messages if n_messages else 1
+        term_idfs = []
+        for term in set(TOKEN_REGEX.findall(query_str)):
+            n_postings = sum(len(segment.get_postings(term))
+                             for _, segment in segments)
+            if n_postings:
+                idf = math.log(1 + (n_messages - n_postings + 0.5) /
+                               (n_postings + 0.5))
+                term_idfs.append((term, idf))
+        return term_idfs, average_length
+
+    def scorer(self, query_str):
+        """ Returns a function that gives the BM25 relevance of an indexed
+            message to the whole words in a query string.
+
+        Messages that only contain the query string within longer words have
+        a relevance of 0.
+        """
+
+        segments = self.__segments()
+        term_idfs, average_length = self.statistics(query_str)
+
+        def score(message_id):
+            """ Returns the relevance of a message to the query string. """
+
+            segment = next(segment for seq, segment in reversed(segments)
+                           if segment.contains(message_id) and
+                           self.__is_live(message_id, seq))
+            counts = [segment.get_postings(term).get(message_id, 0)
+                      for term, _ in term_idfs]
+            return bm25(counts, segment.get_length(message_id), term_idfs,
+                        average_length)
+
+        return score
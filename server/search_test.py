@@ -7,12 +7,20 @@ ASSUMPTION These tests assume that the state of the program is reset after each
 ASSUMPTION The search function works without any regard to the channel the messages are in.
 """
 
+import json
+import os
+import threading
+
+import pytest
+
 from server import auth
 from server import channel
 from server import channels
 from server import data
 from server import message
 from server import search
+from server import search_index
+from server.Error import ValueError
 
 def test_search_variety():
     """Unit test for execution of the search() function on multiple messages,
@@ -106,3 +114,506 @@ def test_search_no_matches():
 
     search_return = search.search(user_info_2["token"], query_str)
     assert not search_return["messages"]  # asserts list of messages returned is empty.
+
+def test_search_matches_substrings():
+    """Unit test checking that search() still finds every message containing the
+       query string now that it is narrowed down by the search index.
+
+    Queries include partial words, whole words, several words, punctuation, and
+    strings with no word characters at all. Results are returned newest first.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    message_strings = [
+        "Hello!",
+        "I fell down the stairs this morning",
+        "Uh.... Bell.",
+        "well, well, well",
+        "Tell me guys, is there anyone else here?",
+        "hello world",
+        "...",
+    ]
+    queries = ["ell", "Hello", "l, w", "ell.", "Uh.... Be", "guys, is th", "e", "..", " ",
+               "", "world!", "xyz"]
+
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    for message_str in message_strings:
+        message.message_send(user_info["token"], channel_info["channel_id"], message_str)
+
+    for query_str in queries:
+        search_return = search.search(user_info["token"], query_str)
+        expected = [msg for msg in message_strings[::-1]
+                    if search_index.fold(query_str) in search_index.fold(msg)]
+        assert [msg["message"] for msg in search_return["messages"]] == expected, query_str
+
+def test_search_ignores_case_and_accents():
+    """Unit test checking that search() matches messages regardless of case and
+       accents, in both the query string and the message.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    cafe = message.message_send(user_info["token"], channel_info["channel_id"],
+                                "Meet at the CAFÉ, déjà vu")
+    street = message.message_send(user_info["token"], channel_info["channel_id"], "Hauptstraße")
+
+    for query_str in ["cafe", "Café", "DEJA VU", "é, d", "ca"]:
+        search_return = search.search(user_info["token"], query_str)
+        assert [msg["message_id"] for msg in search_return["messages"]] == [cafe["message_id"]]
+    for query_str in ["STRASSE", "hauptstraße"]:
+        search_return = search.search(user_info["token"], query_str)
+        assert [msg["message_id"] for msg in search_return["messages"]] == [street["message_id"]]
+    search_return = search.search(user_info["token"], "Café")
+    assert search_return["messages"][0]["message"] == "Meet at the CAFÉ, déjà vu"
+
+def test_search_snippets():
+    """Unit test checking that search() can return snippets of messages around
+       their matches, with the positions of the matches highlighted.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    message.message_send(user_info["token"], channel_info["channel_id"],
+                         "a" * 200 + " the CAFÉ opens at noon " + "b" * 200)
+    message.message_send(user_info["token"], channel_info["channel_id"], "cafe? Cafe!")
+
+    search_return = search.search(user_info["token"], "cafe", snippet_length=20)
+    snippets = [(msg["message"], msg["highlights"]) for msg in search_return["messages"]]
+    assert snippets[0] == ("cafe? Cafe!", [[0, 4], [6, 10]])
+    snippet, highlights = snippets[1]
+    assert snippet.startswith("...") and snippet.endswith("...")
+    assert len(snippet) == 20 + 6
+    assert [snippet[start:end] for start, end in highlights] == ["CAFÉ"]
+    assert "highlights" not in search.search(user_info["token"], "cafe")["messages"][0]
+    with pytest.raises(ValueError, match="Invalid snippet length"):
+        search.search(user_info["token"], "cafe", snippet_length=0)
+    # The JSON results match the results, with or without snippets.
+    for snippet_length in (None, 20):
+        assert json.loads(search.search_json(user_info["token"], "cafe", limit=1,
+                                             snippet_length=snippet_length)) == \
+            search.search(user_info["token"], "cafe", limit=1, snippet_length=snippet_length)
+
+def test_search_follows_edits_and_removals():
+    """Unit test checking that edited and removed messages are searched by their
+       current contents only.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    edited = message.message_send(user_info["token"], channel_info["channel_id"], "grasshopper")
+    removed = message.message_send(user_info["token"], channel_info["channel_id"], "grass")
+    message.message_edit(user_info["token"], edited["message_id"], "hopscotch")
+    message.message_remove(user_info["token"], removed["message_id"])
+
+    assert not search.search(user_info["token"], "grass")["messages"]
+    search_return = search.search(user_info["token"], "hop")
+    assert [msg["message_id"] for msg in search_return["messages"]] == [edited["message_id"]]
+
+def test_search_cache():
+    """Unit test checking that repeated searches are answered from the cache,
+       until a message in one of the channels searched is written to.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    search.reset_search_cache()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    first = message.message_send(user_info["token"], channel_info["channel_id"], "grasshopper")
+
+    search.search(user_info["token"], "grass")
+    search_return = search.search(user_info["token"], "grass")
+    assert [msg["message_id"] for msg in search_return["messages"]] == [first["message_id"]]
+    stats = search.search_cache_stats(user_info["token"])
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+
+    second = message.message_send(user_info["token"], channel_info["channel_id"], "grass")
+    search_return = search.search(user_info["token"], "grass")
+    assert ([msg["message_id"] for msg in search_return["messages"]] ==
+            [second["message_id"], first["message_id"]])
+    message.message_edit(user_info["token"], first["message_id"], "hopscotch")
+    search_return = search.search(user_info["token"], "grass")
+    assert [msg["message_id"] for msg in search_return["messages"]] == [second["message_id"]]
+    stats = search.search_cache_stats(user_info["token"])
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 3, 2)
+    assert stats["hit_rate"] == 0.25
+
+def test_search_cache_relevance():
+    """Unit test checking that cached relevance results are invalidated when a
+       message is sent to a channel that was not searched, as it changes how
+       common each word is.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    search.reset_search_cache()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    other_info = auth.auth_register("other@hotmail.com", "badpassword123", "Other", "Person")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    other_channel = channels.channels_create(other_info["token"], "other server", 1)
+    message.message_send(user_info["token"], channel_info["channel_id"], "red apple")
+    message.message_send(user_info["token"], channel_info["channel_id"], "green apple red")
+
+    search.search(user_info["token"], "red apple", sort="relevance")
+    search.search(user_info["token"], "red apple", sort="recent")
+    message.message_send(other_info["token"], other_channel["channel_id"], "red red red")
+    search.search(user_info["token"], "red apple", sort="relevance")
+    search.search(user_info["token"], "red apple", sort="recent")
+    stats = search.search_cache_stats(user_info["token"])
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (1, 3, 1)
+
+def test_search_pagination():
+    """Unit test checking that search results can be paged through with a limit
+       and cursor, and that every page together matches the unpaginated results.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_1 = channels.channels_create(user_info["token"], "channel 1", 1)
+    channel_2 = channels.channels_create(user_info["token"], "channel 2", 1)
+    for i in range(12):
+        channel_id = channel_1["channel_id"] if i % 3 else channel_2["channel_id"]
+        message.message_send(user_info["token"], channel_id, f"page test {i}")
+    message.message_send(user_info["token"], channel_1["channel_id"], "unrelated")
+
+    all_results = search.search(user_info["token"], "page test")
+    assert len(all_results["messages"]) == 12
+    assert all_results["next_cursor"] is None
+
+    paged_results = []
+    cursor = None
+    while True:
+        page = search.search(user_info["token"], "page test", limit=5, cursor=cursor)
+        assert len(page["messages"]) <= 5
+        paged_results += page["messages"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert paged_results == all_results["messages"]
+
+    with pytest.raises(ValueError) as excinfo:
+        search.search(user_info["token"], "page test", limit=5, cursor="gibberish")
+    assert "Invalid search cursor" in str(excinfo.value)
+    for limit in (0, -1, -2):
+        for sort in ("recent", "relevance"):
+            with pytest.raises(ValueError) as excinfo:
+                search.search(user_info["token"], "page test", limit=limit, sort=sort)
+            assert "Invalid limit" in str(excinfo.value)
+
+def test_search_sort_by_relevance():
+    """Unit test checking that search results can be sorted by relevance, with
+       messages using the query words more often and in shorter messages ranked
+       first, and that relevance-sorted results can be paged through.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "channel 1", 1)
+    message_strings = [
+        "the launch is delayed until the review of the launch checklist is done",
+        "launch launch launch",
+        "relaunching the website next week",
+        "launch tomorrow",
+        "nothing to see here",
+    ]
+    for message_str in message_strings:
+        message.message_send(user_info["token"], channel_info["channel_id"], message_str)
+
+    search_return = search.search(user_info["token"], "launch", sort="relevance")
+    assert [msg["message"] for msg in search_return["messages"]] == [
+        "launch launch launch",
+        "launch tomorrow",
+        "the launch is delayed until the review of the launch checklist is done",
+        "relaunching the website next week",
+    ]
+
+    paged_results = []
+    cursor = None
+    while True:
+        page = search.search(user_info["token"], "launch", limit=1, cursor=cursor,
+                             sort="relevance")
+        paged_results += page["messages"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert paged_results == search_return["messages"]
+
+    with pytest.raises(ValueError) as excinfo:
+        search.search(user_info["token"], "launch", sort="alphabetical")
+    assert "Invalid sort order" in str(excinfo.value)
+
+def test_search_filters():
+    """Unit test checking the in:, from:, before:, after: and is:pinned filters,
+       on their own and combined with a query string.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    owner_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    user_info = auth.auth_register("anotheremail@hotmail.com", "blahblah293", "Wonder", "Woman")
+    general = channels.channels_create(owner_info["token"], "general", 1)
+    random = channels.channels_create(owner_info["token"], "Random", 1)
+    channels.channels_create(user_info["token"], "secret", 0)
+    for channel_info in (general, random):
+        channel.channel_join(user_info["token"], channel_info["channel_id"])
+
+    sent = {}
+    for sender, channel_info, message_str in [
+            (owner_info, general, "standup at 10"),
+            (user_info, general, "standup moved to 11"),
+            (user_info, random, "lunch?"),
+            (owner_info, random, "standup notes"),
+        ]:
+        sent[message_str] = message.message_send(sender["token"], channel_info["channel_id"],
+                                                 message_str)["message_id"]
+    message.message_pin(owner_info["token"], sent["standup moved to 11"])
+    message.message_pin(owner_info["token"], sent["lunch?"])
+
+    def search_messages(query_str):
+        return [msg["message"] for msg in search.search(owner_info["token"],
+                                                        query_str)["messages"]]
+
+    assert search_messages("standup in:general") == ["standup moved to 11", "standup at 10"]
+    assert search_messages("in:#random") == ["standup notes", "lunch?"]
+    assert search_messages("standup from:WonderWoman") == ["standup moved to 11"]
+    assert search_messages(f"from:{user_info['u_id']} in:random") == ["lunch?"]
+    assert search_messages("is:pinned") == ["standup moved to 11", "lunch?"]
+    assert search_messages("standup is:pinned") == ["standup moved to 11"]
+    assert search_messages("in:secret") == []
+    assert search_messages("standup before:2000-01-01") == []
+    assert search_messages("standup after:2000-01-01 in:random") == ["standup notes"]
+
+    message.message_unpin(owner_info["token"], sent["lunch?"])
+    message.message_remove(owner_info["token"], sent["standup moved to 11"])
+    assert search_messages("is:pinned") == []
+
+    for query_str in ["from:nobody", "in:nowhere", "in:12345", "before:yesterday",
+                      "is:starred"]:
+        assert search_messages(query_str) == []
+
+def test_search_plain_text_like_filters():
+    """Unit test checking that words that look like filters, but do not name a
+       valid channel, user or date, are searched for as plain text.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    general = channels.channels_create(user_info["token"], "general", 1)
+    for message_str in ["the build is:broken again", "meet in:office at 3",
+                        "from:home today", "after:lunch in:general"]:
+        message.message_send(user_info["token"], general["channel_id"], message_str)
+
+    def search_messages(query_str):
+        return [msg["message"] for msg in search.search(user_info["token"],
+                                                        query_str)["messages"]]
+
+    assert search_messages("is:broken") == ["the build is:broken again"]
+    assert search_messages("meet in:office") == ["meet in:office at 3"]
+    assert search_messages("from:home") == ["from:home today"]
+    assert search_messages("after:lunch") == ["after:lunch in:general"]
+    assert search_messages("lunch in:general") == ["after:lunch in:general"]
+
+def test_search_parallel_matches_serial():
+    """Unit test checking that splitting a search across the process pool gives
+       the same results as searching serially, for both sort orders and with
+       pagination.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    for i in range(6):
+        channel_info = channels.channels_create(user_info["token"], f"channel {i}", 1)
+        for j in range(i + 2):
+            message.message_send(user_info["token"], channel_info["channel_id"],
+                                 f"status {i} {j} " + "update " * j)
+
+    def all_pages(sort):
+        results = []
+        cursor = None
+        while True:
+            page = search.search(user_info["token"], "update", limit=3, cursor=cursor,
+                                 sort=sort)
+            results += page["messages"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return results
+
+    serial = {sort: all_pages(sort) for sort in search.SORT_ORDERS}
+    search.reset_search_cache()
+    parallel_min_candidates = search.PARALLEL_MIN_CANDIDATES
+    parallel_workers = search.PARALLEL_WORKERS
+    rank_in_parallel = search.rank_in_parallel
+    rank_candidates = search.rank_candidates
+    parallel_calls = []
+    fallback_calls = []
+
+    def counted_rank_in_parallel(*args):
+        parallel_calls.append(sum(map(len, args[1].values())))
+        return rank_in_parallel(*args)
+
+    def counted_rank_candidates(*args):
+        fallback_calls.append(args[1])
+        return rank_candidates(*args)
+
+    search.PARALLEL_MIN_CANDIDATES = 7
+    search.PARALLEL_WORKERS = 2
+    search.rank_in_parallel = counted_rank_in_parallel
+    search.rank_candidates = counted_rank_candidates
+    try:
+        for sort in search.SORT_ORDERS:
+            assert all_pages(sort) == serial[sort]
+        # Only relevance searches are ranked in parallel, and the workers found
+        # the snapshot in data.p, so nothing was ranked here instead.
+        assert parallel_calls and all(n_candidates == 21 for n_candidates in parallel_calls)
+        assert fallback_calls == []
+        # Channel 5 only has 6 candidates once filtered, so is ranked serially.
+        parallel_calls.clear()
+        results = search.search(user_info["token"], f"update in:{channel_info['channel_id']}",
+                                sort="relevance")
+        assert len(results["messages"]) == 6
+        assert parallel_calls == []
+    finally:
+        search.PARALLEL_MIN_CANDIDATES = parallel_min_candidates
+        search.PARALLEL_WORKERS = parallel_workers
+        search.rank_in_parallel = rank_in_parallel
+        search.rank_candidates = rank_candidates
+        search.shutdown_search_pool()
+    # Channel i has i + 1 messages containing "update".
+    assert len(serial["recent"]) == sum(i + 1 for i in range(6))
+
+def test_search_partitions():
+    """Unit test checking that candidates are split into partitions of whole
+       channels, and that a worker whose data.p has moved on ranks nothing.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    message.message_send(user_info["token"], channel_info["channel_id"], "hello world")
+    server_data = data.load_data()
+    channel_candidates = {1: [1, 2, 3], 2: [4, 5], 3: [6], 4: [7], 5: [8]}
+    partitions = search.partition_channels(channel_candidates, 2)
+    assert sorted(sum(map(len, partition.values())) for partition in partitions) == [4, 4]
+    assert {channel_id: msg_ids for partition in partitions
+            for channel_id, msg_ids in partition.items()} == channel_candidates
+    assert len(search.partition_channels(channel_candidates, 8)) == 5
+
+    snapshot = search.search_snapshot(server_data)
+    partition = {channel_info["channel_id"]: [1]}
+    assert search.rank_partition(snapshot, partition, "hello", 10, None) == \
+        search.rank_candidates(server_data, partition, "hello", 10, None)
+    # A worker that has loaded the snapshot keeps ranking it, while a new one
+    # only finds the data saved since.
+    message.message_send(user_info["token"], channel_info["channel_id"], "hello again")
+    assert search.rank_partition(snapshot, partition, "hello", 10, None)
+    search.WORKER_DATA = None
+    assert search.rank_partition(snapshot, partition, "hello", 10, None) is None
+    search.WORKER_DATA = None
+
+def test_search_segmented_index():
+    """Unit test checking that searches stay correct as the search index is
+       sealed into segments on disk and merged in the background, and that
+       unused segment files are only deleted after a grace period.
+    """
+
+    auth.reset_auth_data()
+    data.initialise_data()
+    user_info = auth.auth_register("testemail@hotmail.com", "badpassword123", "Captain", "Wonky")
+    channel_info = channels.channels_create(user_info["token"], "my server", 1)
+    segment_size = search_index.SEGMENT_SIZE
+    merge_factor = search_index.MERGE_FACTOR
+    grace_period = search_index.SEGMENT_GRACE_PERIOD
+    search_index.SEGMENT_SIZE = 3
+    search_index.MERGE_FACTOR = 2
+    try:
+        bodies = {}
+        for i in range(30):
+            message_info = message.message_send(user_info["token"], channel_info["channel_id"],
+                                                f"note {i} " + "tick " * (i % 3))
+            bodies[message_info["message_id"]] = f"note {i} " + "tick " * (i % 3)
+            if i % 4 == 1:
+                message.message_edit(user_info["token"], message_info["message_id"], f"memo {i}")
+                bodies[message_info["message_id"]] = f"memo {i}"
+            if i % 5 == 2:
+                message.message_remove(user_info["token"], message_info["message_id"])
+                del bodies[message_info["message_id"]]
+        search_index.wait_for_merges()
+        # Finished merges are picked up by the next write to the index, but
+        # the segments merged away are kept for requests using older data.
+        old_data = data.load_data()
+        message.message_send(user_info["token"], channel_info["channel_id"], "last")
+        assert old_data.get_search_candidates("note")
+        n_files = len(os.listdir(data.ServerData.SEGMENTS_DIRECTORY))
+        # Once the grace period has passed, the next save deletes them, along
+        # with files that no index refers to.
+        search_index.SEGMENT_GRACE_PERIOD = 0
+        orphan = os.path.join(data.ServerData.SEGMENTS_DIRECTORY, "orphan.seg")
+        open(orphan, "wb").close()
+        message.message_send(user_info["token"], channel_info["channel_id"], "later")
+        assert not os.path.exists(orphan)
+        assert len(os.listdir(data.ServerData.SEGMENTS_DIRECTORY)) < n_files
+    finally:
+        search_index.SEGMENT_SIZE = segment_size
+        search_index.MERGE_FACTOR = merge_factor
+        search_index.SEGMENT_GRACE_PERIOD = grace_period
+
+    assert os.listdir(data.ServerData.SEGMENTS_DIRECTORY)
+    for query_str in ["note", "memo", "tick", "2", "note 1"]:
+        search_return = search.search(user_info["token"], query_str)
+        expected = sorted((msg_id for msg_id, body in bodies.items() if query_str in body),
+                          reverse=True)
+        assert [msg["message_id"] for msg in search_return["messages"]] == expected, query_str
+    data.initialise_data()
+    assert not os.path.exists(data.ServerData.SEGMENTS_DIRECTORY)
+
+def test_search_index_edit_during_merge(monkeypatch, tmp_path):
+    """Unit test checking that a message edited while the segments it is in are
+       being merged is only counted once, once the merge is adopted.
+    """
+
+    monkeypatch.setattr(search_index, "SEGMENT_SIZE", 2)
+    monkeypatch.setattr(search_index, "MERGE_FACTOR", 2)
+    merge_segments = search_index.merge_segments
+    merging = threading.Event()
+
+    def held_merge_segments(*args):
+        merging.wait()
+        merge_segments(*args)
+
+    monkeypatch.setattr(search_index, "merge_segments", held_merge_segments)
+    bodies = {1: "apple pie", 2: "banana split", 3: "cherry tart", 4: "apple crumble"}
+    index = search_index.SearchIndex(str(tmp_path / "edited"))
+    for message_id, body in bodies.items():
+        index.add(message_id, body)
+    # The two sealed segments are being merged.
+    bodies[1] = "plum jam"
+    index.add(1, bodies[1])
+    merging.set()
+    bodies[5] = "date loaf"
+    index.add(5, bodies[5])
+    search_index.wait_for_merges()
+    index.remove(6)
+    search_index.wait_for_merges()
+    index.remove(6)
+
+    fresh_index = search_index.SearchIndex(str(tmp_path / "fresh"))
+    for message_id in sorted(bodies):
+        fresh_index.add(message_id, bodies[message_id])
+    search_index.wait_for_merges()
+    for query_str in ["apple", "plum jam", "a"]:
+        assert index.candidates(query_str) == fresh_index.candidates(query_str)
+        assert index.statistics(query_str) == fresh_index.statistics(query_str)
+    assert index.scorer("apple")(4) == fresh_index.scorer("apple")(4)
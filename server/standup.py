@@ -5,6 +5,7 @@ import threading
 
 from server import auth
 from server import data
+from server import events
 from server import message
 from server.Error import AccessError, ValueError
 
@@ -16,11 +17,19 @@ STANDUP_DATA = {
     # channel_id: {
     #     "time_finish":
     #     "message_queue": [ f"{name}: {message}" ]
+    #     "timer":
     # }
 }
 
 def reset_standup_data():
+    """ Cancels the active standups, waiting for any that are already ending,
+        so that they cannot save the server data after it is reset.
+    """
+
     global STANDUP_DATA
+    for standup in list(STANDUP_DATA.values()):
+        standup["timer"].cancel()
+        standup["timer"].join()
     STANDUP_DATA = {}
 
 def get_standup_data():
@@ -45,9 +54,13 @@ def standup_end(channel_id, user_id):
     message_id = server_data.get_new_message_id()
     message_obj = data.Message(message_id, user_id, channel_id, standup_body, time_sent)
     server_data.register_message(message_obj)
-    server_data.return_channel(channel_id).add_message(message_id)
-    del standup_data[channel_id]
+    channel = server_data.return_channel(channel_id)
+    channel.add_message(message_id, time_sent)
+    server_data.post_message(message_id)
     data.save_data(server_data)
+    del standup_data[channel_id]
+    events.publish(server_data, channel_id, "standup_finished",
+                   message_id, channel.get_version())
 
 
 def standup_start(token, channel_id, length):
@@ -70,6 +83,7 @@ def standup_start(token, channel_id, length):
     standup_data[channel_id] = {}
     standup_data[channel_id]["time_finish"] = time_finish
     standup_data[channel_id]["message_queue"] = []
+    standup_data[channel_id]["timer"] = standup_timer
     standup_timer.start()
     return {
         "time_finish": time_finish
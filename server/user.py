@@ -9,23 +9,44 @@ from server import auth
 from server import data
 from server.Error import ValueError
 
-def user_profile(token, u_id, static_url="static/"):
-    """ Returns a user's profile details
+def profile_info(view, static_url="static/"):
+    """ Serialises a user's profile details given a read-only view of the user
     """
 
-    server_data = data.load_data()
-    # checks if the token is valid
-    auth.verify_token(token)
-    user = server_data.return_user(u_id)
     return {
-        "u_id": u_id,
-        "email": user.get_email(),
-        "name_first": user.get_name_first(),
-        "name_last": user.get_name_last(),
-        "handle_str": user.get_handle(),
-        "profile_img_url": static_url + user.get_pfp_filename(),
+        "u_id": view.u_id,
+        "email": view.email,
+        "name_first": view.name_first,
+        "name_last": view.name_last,
+        "handle_str": view.handle_str,
+        "profile_img_url": static_url + view.pfp_filename,
     }
 
+def user_profile(token, u_id, static_url="static/", server_data=None):
+    """ Returns a user's profile details. If server_data is given, it is used
+        instead of loading data.p, so that a route can compute the entity tag
+        and the body from the same data.
+    """
+
+    if server_data is None:
+        server_data = data.load_data()
+    # checks if the token is valid
+    auth.verify_token(token)
+    return profile_info(server_data.return_users([u_id])[0], static_url)
+
+def user_profile_etag(token, u_id, static_url="static/", server_data=None):
+    """ Returns the entity tag of a user's profile details, which changes
+        whenever they change their profile. The server data can be given as
+        for user_profile().
+    """
+
+    if server_data is None:
+        server_data = data.load_data()
+    auth.verify_token(token)
+    return server_data.make_etag("user_profile", u_id,
+                                 server_data.return_user(u_id).get_version(),
+                                 static_url)
+
 def user_profile_setname(token, name_first, name_last):
     """ Sets the user's first name and last name
     """
@@ -3,13 +3,47 @@
 from server import auth
 from server import data
 from server import user
+from server.Error import ValueError
 
-def users_all(token, static_url="static/"):
-    """ Returns the profile info of all the users on the Slackr. """
+def users_all(token, static_url="static/", server_data=None):
+    """ Returns the profile info of all the users on the Slackr. If
+        server_data is given, it is used instead of loading data.p, so that a
+        route can compute the entity tag and the body from the same data.
+    """
 
     auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    return {
+        "users": [user.profile_info(view, static_url) for view in
+                  server_data.return_users(server_data.get_all_u_id())]
+    }
+
+def users_all_etag(token, static_url="static/", server_data=None):
+    """ Returns the entity tag of the profiles of all the users, which changes
+        whenever a user registers or changes their profile. The server data
+        can be given as for users_all().
+    """
+
+    auth.verify_token(token)
+    if server_data is None:
+        server_data = data.load_data()
+    return server_data.make_etag("users_all", server_data.get_users_version(),
+                                 static_url)
+
+def users_search(token, query_str, limit=10, static_url="static/"):
+    """ Returns the profile info of up to limit users whose first name, last
+        name, full name, or handle starts with the query string, ignoring case.
+
+    If the limit is less than 1, raises a ValueError.
+    """
+
+    auth.verify_token(token)
+    if limit < 1:
+        raise ValueError("Invalid limit")
     server_data = data.load_data()
     return {
-        "users": [user.user_profile(token, u_id, static_url) \
-                  for u_id in server_data.get_all_u_id()]
+        "users": [user.profile_info(view, static_url) for view in
+                  server_data.return_users(server_data.search_users(query_str,
+                                                                    limit))]
     }
@@ -1,8 +1,11 @@
 """ Unit tests for functions implementing features related to non-specific users. """
 
+import pytest
 from server import data
 from server.auth import auth_register, reset_auth_data
-from server.users import users_all
+from server.user import user_profile_setname, user_profile_sethandle
+from server.users import users_all, users_all_etag, users_search
+from server.Error import ValueError
 
 def test_users_all_successful():
     """ Test that checks if the users_all function is successful, being able to see all the user's
@@ -25,3 +28,48 @@ def test_users_all_successful():
     users_all_names = [user["name_first"] for user in users_info["users"]]
     for name in first_names:
         assert name in users_all_names
+
+def test_users_search_successful():
+    """ Test that users can be found by a prefix of their first name, last name, full name
+    or handle, ignoring case, and that the index follows changes to names and handles.
+    """
+    reset_auth_data()
+    data.initialise_data()
+    user1_info = auth_register("hello0@gmail.com", "oyvdhb585", "Jeffery", "Kondo")
+    user2_info = auth_register("hello1@gmail.com", "oyvdhb586", "Jeremy", "Kale")
+    user3_info = auth_register("hello2@gmail.com", "oyvdhb587", "James", "Kyle")
+
+    def search_u_ids(query_str, limit=10):
+        return [user["u_id"] for user in users_search(user1_info["token"], query_str,
+                                                      limit)["users"]]
+
+    assert search_u_ids("je") == [user1_info["u_id"], user2_info["u_id"]]
+    assert search_u_ids("K", limit=2) == [user2_info["u_id"], user1_info["u_id"]]
+    assert search_u_ids("james k") == [user3_info["u_id"]]
+    assert search_u_ids("jameskyle") == [user3_info["u_id"]]
+    assert search_u_ids("zz") == []
+
+    user_profile_setname(user3_info["token"], "Zoe", "Kyle")
+    user_profile_sethandle(user2_info["token"], "zebra")
+    assert search_u_ids("james ") == []
+    assert search_u_ids("zoe k") == [user3_info["u_id"]]
+    assert search_u_ids("z") == [user2_info["u_id"], user3_info["u_id"]]
+
+    for limit in (0, -1):
+        with pytest.raises(ValueError):
+            search_u_ids("z", limit)
+
+def test_users_all_etag():
+    """ Test that the entity tag of all users' profiles changes when a user registers or changes
+    their profile, and otherwise stays the same.
+    """
+    reset_auth_data()
+    data.initialise_data()
+    user1_info = auth_register("hello0@gmail.com", "oyvdhb585", "Jeffery", "Kondo")
+    etag = users_all_etag(user1_info["token"])
+    assert etag == users_all_etag(user1_info["token"])
+    user2_info = auth_register("hello1@gmail.com", "oyvdhb586", "Jeremy", "Kale")
+    new_etag = users_all_etag(user1_info["token"])
+    assert new_etag != etag
+    user_profile_sethandle(user2_info["token"], "zebra")
+    assert users_all_etag(user1_info["token"]) not in (etag, new_etag)